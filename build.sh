@@ -23,6 +23,12 @@ test () {
   python $dir/test_runner.py
 }
 
+benchmark() {
+  fetch_dependencies
+  echo "Using PYTHONPATH=$PYTHONPATH"
+  python $dir/test_runner.py --benchmark
+}
+
 build() {
   fetch_dependencies
 }
@@ -43,7 +49,10 @@ case "$1" in
   build)
     build
     ;;
+  benchmark)
+    benchmark
+    ;;
   *)
-    echo $"Usage: $0 {test|build}"
+    echo $"Usage: $0 {test|build|benchmark}"
     exit 1
 esac
@@ -0,0 +1,234 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Checksums computed over blob data as it is copied.
+"""
+import base64
+import binascii
+import hashlib
+import struct
+
+from app import config
+
+try:
+  import crcmod
+  import crcmod.predefined
+except ImportError:
+  crcmod = None
+
+# The reversed Castagnoli polynomial used by CRC32C (as reported by GCS).
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+
+def _build_crc32c_table():
+  """Returns the byte-wise lookup table of CRC32C."""
+  table = []
+  for index in range(256):
+    crc = index
+    for _ in range(8):
+      crc = (crc >> 1) ^ (CRC32C_POLYNOMIAL if crc & 1 else 0)
+    table.append(crc)
+  return table
+
+
+_CRC32C_TABLE = _build_crc32c_table()
+
+# crcmod's CRC32C, if its C extension is installed; the pure Python version
+# of crcmod is no faster than crc32c() below.
+_crcmod_crc32c = None
+if crcmod is not None and getattr(crcmod, '_usingExtension', False):
+  _crcmod_crc32c = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+
+
+def crc32c(data, crc=0):
+  """Computes the CRC32C of data, continuing from an earlier CRC.
+
+  Unless crcmod's C extension is installed, this is pure Python and much
+  slower than MD5 (roughly 10MB/s); see CHECKSUMS.
+
+  Args:
+    data: The bytes to checksum.
+    crc: The CRC32C of the preceding bytes, if any.
+
+  Returns:
+    The CRC32C as an unsigned 32-bit integer.
+  """
+  if _crcmod_crc32c is not None:
+    return _crcmod_crc32c(data, crc)
+  table = _CRC32C_TABLE
+  crc ^= 0xFFFFFFFF
+  for byte in bytearray(data):
+    crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+  return crc ^ 0xFFFFFFFF
+
+
+def _gf2_matrix_times(matrix, vector):
+  """Multiplies a 32x32 GF(2) matrix by a vector."""
+  total = 0
+  index = 0
+  while vector:
+    if vector & 1:
+      total ^= matrix[index]
+    vector >>= 1
+    index += 1
+  return total
+
+
+def _gf2_matrix_square(matrix):
+  """Squares a 32x32 GF(2) matrix."""
+  return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def crc32c_combine(crc1, crc2, length2):
+  """Computes the CRC32C of two concatenated byte ranges.
+
+  This follows zlib's crc32_combine(), so the CRC32C of a blob can be built
+  from the CRC32Cs of the parts that were copied in parallel.
+
+  Args:
+    crc1: The CRC32C of the first range.
+    crc2: The CRC32C of the second range.
+    length2: The length of the second range in bytes.
+
+  Returns:
+    The CRC32C of the first range followed by the second.
+  """
+  if length2 <= 0:
+    return crc1
+  # the operator for one zero bit, then for two and four zero bits
+  odd = [CRC32C_POLYNOMIAL] + [1 << row for row in range(31)]
+  even = _gf2_matrix_square(odd)
+  odd = _gf2_matrix_square(even)
+  # apply length2 zero bytes to crc1, squaring the operator for every bit
+  while True:
+    even = _gf2_matrix_square(odd)
+    if length2 & 1:
+      crc1 = _gf2_matrix_times(even, crc1)
+    length2 >>= 1
+    if not length2:
+      break
+    odd = _gf2_matrix_square(even)
+    if length2 & 1:
+      crc1 = _gf2_matrix_times(odd, crc1)
+    length2 >>= 1
+    if not length2:
+      break
+  return crc1 ^ crc2
+
+
+def decode_gcs_crc32c(value):
+  """Decodes a base64, big-endian CRC32C as reported by GCS."""
+  return struct.unpack('>I', base64.b64decode(value))[0]
+
+
+def decode_gcs_md5(value):
+  """Decodes a base64 MD5 as reported by GCS into a hex digest."""
+  return binascii.hexlify(base64.b64decode(value))
+
+
+class StreamingChecksum(object):
+  """Computes the size, MD5 and CRC32C of data as it streams through."""
+
+  def __init__(self, algorithms=None):
+    """Initializes the checksum.
+
+    Args:
+      algorithms: The checksums to compute, 'md5' and/or 'crc32c'; defaults
+        to CHECKSUMS.
+    """
+    if algorithms is None:
+      algorithms = config.config.CHECKSUMS
+    self.size = 0
+    self._md5 = hashlib.md5() if 'md5' in algorithms else None
+    self.crc32c = 0 if 'crc32c' in algorithms else None
+
+  @classmethod
+  def resume(cls, size, crc32c_value):
+    """Continues a checksum from the state of an interrupted copy.
+
+    The state of an MD5 cannot be saved, so only the CRC32C is computed.
+
+    Args:
+      size: The number of bytes seen so far.
+      crc32c_value: The CRC32C of those bytes, or None if not computed.
+
+    Returns:
+      A StreamingChecksum to update with the data that follows.
+    """
+    checksum = cls(['crc32c'] if crc32c_value is not None else [])
+    checksum.size = size
+    checksum.crc32c = crc32c_value
+    return checksum
+
+  def update(self, data):
+    """Adds the next chunk of data.
+
+    Args:
+      data: The bytes that follow the data seen so far.
+    """
+    self.size += len(data)
+    if self._md5 is not None:
+      self._md5.update(data)
+    if self.crc32c is not None:
+      self.crc32c = crc32c(data, self.crc32c)
+
+  @property
+  def md5_hash(self):
+    """The hex MD5 digest of the data so far, or None if not computed."""
+    if self._md5 is None:
+      return None
+    return self._md5.hexdigest()
+
+  def to_dict(self):
+    """Returns the size and the computed checksums, by name."""
+    return get_checksum_dict(self.size, self.md5_hash, self.crc32c)
+
+
+def get_checksum_dict(size=None, md5_hash=None, crc32c_value=None):
+  """Builds a dict of the known checksums of some data.
+
+  Args:
+    size: The size in bytes.
+    md5_hash: The hex MD5 digest.
+    crc32c_value: The CRC32C.
+
+  Returns:
+    A dict with 'size', 'md5' and 'crc32c' entries for the known values.
+  """
+  values = {'size': size, 'md5': md5_hash, 'crc32c': crc32c_value}
+  return dict((name, value) for name, value in values.items()
+              if value is not None)
+
+
+def find_mismatches(copied, reference, reference_name):
+  """Compares the checksums of copied data against a reference.
+
+  Checksums that are missing on either side are not compared.
+
+  Args:
+    copied: A dict of checksums (see get_checksum_dict()) of the copy.
+    reference: A dict of checksums of the data it should match.
+    reference_name: Describes the reference (e.g., 'blobstore').
+
+  Returns:
+    A list describing each mismatch; empty if all compared checksums match.
+  """
+  mismatches = []
+  for name in sorted(copied):
+    if name in reference and reference[name] != copied[name]:
+      mismatches.append('%s %s is %r, copied %r' % (
+          reference_name, name, reference[name], copied[name]))
+  return mismatches
@@ -50,6 +50,143 @@ class _ConfigDefaults(object):
 
   QUEUE_NAME
     Specifies the queue to run the mapper jobs in.
+
+  MAPPING_LOOKUP_BATCH_SIZE
+    The number of BlobInfo records each mapper shard reads as a page. The
+    mapping entities for a whole page are looked up with a single Datastore
+    RPC. Set to 1 to look up every blob individually.
+
+  MAPPING_PUT_BATCH_SIZE
+    The number of mapping entities each mapper shard buffers before writing
+    them with a single asynchronous Datastore put. Buffered entities are
+    always written before a mapper slice completes.
+
+  COMPOSITE_UPLOAD_PARTS
+    Blobs larger than DIRECT_MIGRATION_MAX_SIZE are split into up to this
+    many byte ranges that are copied in parallel and then composed into a
+    single GCS file. At most 32 parts are used. Set to 1 to copy large blobs
+    with a single stream.
+
+  COMPOSITE_UPLOAD_MIN_PART_SIZE
+    The smallest byte range a parallel copy will use for a part.
+
+  INSTANCE_CLASS
+    The instance class the migration runs on (e.g., F1, F4, B4). It bounds
+    the size of the chunks held in memory while copying.
+
+  COPY_BUFFER_MIN_SIZE
+    The smallest chunk size used to copy a blob.
+
+  COPY_BUFFER_MAX_SIZE
+    The largest chunk size used to copy a blob. If 0, it is derived from
+    INSTANCE_CLASS (8MiB on an F1).
+
+  COPY_BUFFER_TARGET_SECONDS
+    Chunks are sized so that fetching one takes about this long at the
+    Blobstore throughput observed on the instance.
+
+  COPY_CHECKPOINT_INTERVAL
+    An inline copy saves its progress every this many bytes, so a copy that
+    is interrupted (e.g., by a task deadline) resumes from its last
+    checkpoint when the task is retried. Set to 0 to always copy from the
+    start.
+
+  CONCURRENT_MIGRATION_MAX_BLOBS
+    Each mapper shard copies up to this many small blobs at the same time.
+    Set to 1 to copy every blob one at a time.
+
+  CONCURRENT_MIGRATION_MAX_BYTES
+    The most blob data a mapper shard holds in memory for its concurrent
+    small-blob copies.
+
+  CONCURRENT_MIGRATION_MAX_SIZE
+    Blobs up to this size (and never more than about 1MB, the Blobstore
+    fetch limit) are copied concurrently; larger blobs are streamed.
+
+  BALANCE_SHARDS_BY_SIZE
+    If True, the BlobInfo records are split among shards so that every shard
+    copies about the same number of bytes (rather than the same number of
+    blobs).
+
+  SIZE_TIERS
+    A list of size classes, each a dict with a "name", a "max_size" in bytes
+    (None for no limit) and optionally a "queue_name" and a "target" module
+    or version. Blobs in a tier with its own queue are copied by a secondary
+    pipeline on that queue, so long copies of large blobs do not hold up
+    the mapper shards that copy small blobs. Blobs in a tier without a queue
+    are copied by the mapper shards. The status page reports the bytes
+    copied per tier.
+
+  INCREMENTAL_MIGRATION_SAFETY_MARGIN
+    Incremental migrations only scan blobs created at least this many
+    seconds before the run starts, since newer BlobInfo records may not be
+    visible to queries yet. Newer blobs are picked up by the next run.
+
+  ESTIMATED_SHARD_THROUGHPUT
+    The bytes per second a single shard is expected to copy; used by the
+    migration planner to estimate the duration of a migration.
+
+  ESTIMATED_SECONDS_PER_BLOB
+    The fixed cost, in seconds, of copying a blob; used by the migration
+    planner to estimate the duration of a migration.
+
+  CHECKSUMS
+    The checksums ('md5' and/or 'crc32c') computed while blobs are copied.
+    They are stored on the mappings and compared against the MD5 Blobstore
+    recorded and the hashes GCS reports; a copy that does not match is
+    recorded as a MigrationFailure instead of being mapped. The MD5 of
+    parts cannot be combined, so blobs copied by secondary pipelines are
+    only checked by size unless 'crc32c' is included. Unless crcmod's C
+    extension is installed, CRC32C is computed in pure Python (roughly
+    10MB/s per instance), so only add it if the copies are not CPU bound.
+    Set to [] to skip verification.
+
+  VERIFICATION_BATCH_SIZE
+    The number of mapping entities a verification shard checks at a time;
+    their BlobInfos are read with one RPC and their GCS files are inspected
+    concurrently.
+
+  BLOB_DELETE_BATCH_SIZE
+    The number of blobs deleted with a single Blobstore call when deleting
+    migrated blobs.
+
+  BLOB_DELETE_MAX_IN_FLIGHT
+    The most Blobstore delete calls a shard has outstanding at a time.
+
+  BLOB_DELETE_MAX_ATTEMPTS
+    A failed delete call is split in halves that are retried; a blob that
+    still cannot be deleted after this many attempts fails the slice, which
+    the MapReduce framework then retries.
+
+  SCRUB_MAX_OPS_PER_SECOND
+    The default ceiling on the mapping entities read per second, across all
+    shards, by the jobs that delete source blobs or mappings; each mapping
+    read may also cost a delete. Set to 0 for no ceiling.
+
+  MIGRATION_GENERATION
+    Tags the mappings a migration creates. Mappings of another generation
+    count as not migrated, so a migration into a new generation copies every
+    blob again without deleting the old mappings first; the new mappings
+    replace them. Defaults to the name of the target bucket, so a migration
+    into another bucket starts a new generation. Mappings created before
+    generations were recorded belong to the generation of their bucket.
+
+  STALE_MAPPING_MAX_OPS_PER_SECOND
+    Once a full migration succeeds, the mappings of other generations that
+    it did not replace are deleted in the background, reading at most this
+    many mappings per second across all shards (0 for no ceiling). The
+    deletion waits for the migration's secondary pipelines to finish.
+    Mappings whose source blob was deleted, or whose blob failed to copy in
+    the new generation, are kept.
+
+  GCS_LISTING_PAGE_SIZE
+    The number of GCS files a shard lists at a time when reconciling a
+    bucket with the mappings; the mappings of a page are read with one RPC.
+
+  ORPHAN_GRACE_PERIOD
+    GCS files younger than this many seconds are never reported or deleted
+    as orphans, since the copy that wrote them may not have stored its
+    mapping yet.
   """
 
   NUM_SHARDS = 16
@@ -62,6 +199,64 @@ class _ConfigDefaults(object):
 
   QUEUE_NAME = 'default'
 
+  MAPPING_LOOKUP_BATCH_SIZE = 50
+
+  MAPPING_PUT_BATCH_SIZE = 50
+
+  COMPOSITE_UPLOAD_PARTS = 16
+
+  COMPOSITE_UPLOAD_MIN_PART_SIZE = 256 * 1024 * 1024
+
+  INSTANCE_CLASS = 'F1'
+
+  COPY_BUFFER_MIN_SIZE = 256 * 1024
+
+  COPY_BUFFER_MAX_SIZE = 0
+
+  COPY_BUFFER_TARGET_SECONDS = 1.0
+
+  COPY_CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
+  CONCURRENT_MIGRATION_MAX_BLOBS = 10
+
+  CONCURRENT_MIGRATION_MAX_BYTES = 8 * 1024 * 1024
+
+  CONCURRENT_MIGRATION_MAX_SIZE = 512 * 1024
+
+  BALANCE_SHARDS_BY_SIZE = True
+
+  SIZE_TIERS = [
+    {'name': 'small', 'max_size': 1024 * 1024},
+    {'name': 'medium', 'max_size': 256 * 1024 * 1024},
+    {'name': 'large', 'max_size': None},
+  ]
+
+  INCREMENTAL_MIGRATION_SAFETY_MARGIN = 10 * 60
+
+  ESTIMATED_SHARD_THROUGHPUT = 4 * 1024 * 1024
+
+  ESTIMATED_SECONDS_PER_BLOB = 0.1
+
+  CHECKSUMS = ['md5']
+
+  VERIFICATION_BATCH_SIZE = 50
+
+  BLOB_DELETE_BATCH_SIZE = 100
+
+  BLOB_DELETE_MAX_IN_FLIGHT = 4
+
+  BLOB_DELETE_MAX_ATTEMPTS = 3
+
+  SCRUB_MAX_OPS_PER_SECOND = 0
+
+  MIGRATION_GENERATION = None
+
+  STALE_MAPPING_MAX_OPS_PER_SECOND = 50
+
+  GCS_LISTING_PAGE_SIZE = 100
+
+  ORPHAN_GRACE_PERIOD = 24 * 60 * 60
+
 
 # This is a bit of a hack but does the trick for the UI.
 CONFIGURATION_KEYS_FOR_INDEX = [k for k in _ConfigDefaults.__dict__
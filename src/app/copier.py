@@ -0,0 +1,269 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streams blob data from Blobstore into Cloud Storage.
+"""
+import time
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from app import config
+from app import gcs
+
+# Approximate memory, in MiB, of the App Engine instance classes.
+INSTANCE_CLASS_MEMORY_MB = {
+  'F1': 128,
+  'F2': 256,
+  'F4': 512,
+  'F4_1G': 1024,
+  'B1': 128,
+  'B2': 256,
+  'B4': 512,
+  'B4_1G': 1024,
+  'B8': 1024,
+}
+
+# The largest chunk is this fraction of the instance memory; a 128MiB F1
+# frontend copies in 8MiB chunks.
+MEMORY_PER_BUFFER_DIVISOR = 16
+
+# A fetch that get_result() has to wait on for at least this long was still
+# in flight, so its duration is known. A fetch that completed while the
+# caller was busy (e.g., writing the previous chunk) is not timed, since it
+# may have finished long before it was collected.
+MIN_FETCH_WAIT_SECONDS = 0.002
+
+
+class ThroughputTracker(object):
+  """Tracks a moving average of the Blobstore fetch throughput.
+
+  One tracker is kept per instance, so the observations of earlier copies
+  inform the chunk size of the next ones.
+  """
+
+  def __init__(self, weight=0.2):
+    """Initializes the tracker.
+
+    Args:
+      weight: The weight of the newest observation in the moving average.
+    """
+    self.weight = weight
+    self.bytes_per_second = None
+
+  def record(self, num_bytes, seconds):
+    """Records the outcome of a fetch.
+
+    Args:
+      num_bytes: The number of bytes fetched.
+      seconds: The wall time the fetch took.
+    """
+    if num_bytes <= 0 or seconds <= 0:
+      return
+    observed = num_bytes / seconds
+    if self.bytes_per_second is None:
+      self.bytes_per_second = observed
+    else:
+      self.bytes_per_second = (self.weight * observed +
+                               (1 - self.weight) * self.bytes_per_second)
+
+
+fetch_throughput = ThroughputTracker()
+
+
+def get_max_buffer_size():
+  """Returns the largest chunk size this instance may use.
+
+  Returns:
+    COPY_BUFFER_MAX_SIZE if configured, otherwise a size derived from the
+    memory of the configured INSTANCE_CLASS.
+  """
+  if config.config.COPY_BUFFER_MAX_SIZE:
+    return config.config.COPY_BUFFER_MAX_SIZE
+  memory_mb = INSTANCE_CLASS_MEMORY_MB.get(
+      (config.config.INSTANCE_CLASS or '').upper(),
+      INSTANCE_CLASS_MEMORY_MB['F1'])
+  return memory_mb * 1024 * 1024 // MEMORY_PER_BUFFER_DIVISOR
+
+
+def get_buffer_size(blob_size):
+  """Chooses the size of the chunks used to copy a blob.
+
+  The chunk is sized so that fetching it takes about
+  COPY_BUFFER_TARGET_SECONDS at the throughput observed on this instance,
+  is never larger than the blob itself (rounded up to a power of two), and
+  is clamped between COPY_BUFFER_MIN_SIZE and the instance's maximum.
+
+  Args:
+    blob_size: The size of the blob in bytes.
+
+  Returns:
+    The chunk size in bytes.
+  """
+  min_size = config.config.COPY_BUFFER_MIN_SIZE
+  size = get_max_buffer_size()
+  if fetch_throughput.bytes_per_second:
+    size = min(size, int(fetch_throughput.bytes_per_second *
+                         config.config.COPY_BUFFER_TARGET_SECONDS))
+  size = min(size, _round_up_to_power_of_two(blob_size or 1))
+  size = _round_down_to_power_of_two(size)
+  return max(size, min_size)
+
+
+def _round_up_to_power_of_two(value):
+  """Returns the smallest power of two that is at least value."""
+  power = 1
+  while power < value:
+    power *= 2
+  return power
+
+
+def _round_down_to_power_of_two(value):
+  """Returns the largest power of two that is at most value (minimum 1)."""
+  power = 1
+  while power * 2 <= value:
+    power *= 2
+  return power
+
+
+class BlobRangeFetch(object):
+  """An in-flight read of a range of bytes from a blob.
+
+  The range is fetched with as many parallel fetch_data_async calls as the
+  MAX_BLOB_FETCH_SIZE limit requires; the throughput is recorded to size
+  later chunks, but only if the fetch was still in flight when its result
+  was collected (see MIN_FETCH_WAIT_SECONDS).
+  """
+
+  def __init__(self, blob_key, start, end):
+    """Starts the fetch.
+
+    Args:
+      blob_key: The BlobKey (or BlobInfo) of the blob to read.
+      start: The first position to read.
+      end: The position to stop reading at (exclusive).
+    """
+    self.start = start
+    self.end = end
+    self._started = time.time()
+    self._rpcs = []
+    for position in range(start, end, blobstore.MAX_BLOB_FETCH_SIZE):
+      last = min(position + blobstore.MAX_BLOB_FETCH_SIZE, end) - 1
+      self._rpcs.append(blobstore.fetch_data_async(blob_key, position, last))
+
+  def get_result(self):
+    """Waits for the fetch to complete.
+
+    Returns:
+      The bytes read; shorter than requested if the blob ends first.
+    """
+    waiting = time.time()
+    data = ''.join(rpc.get_result() for rpc in self._rpcs)
+    finished = time.time()
+    if finished - waiting >= MIN_FETCH_WAIT_SECONDS:
+      fetch_throughput.record(len(data), finished - self._started)
+    return data
+
+
+def fetch_blob_range(blob_key, start, end):
+  """Reads a range of bytes from a blob.
+
+  Args:
+    blob_key: The BlobKey (or BlobInfo) of the blob to read.
+    start: The first position to read.
+    end: The position to stop reading at (exclusive).
+
+  Returns:
+    The bytes read; shorter than requested if the blob ends first.
+  """
+  return BlobRangeFetch(blob_key, start, end).get_result()
+
+
+def copy_blob_to_gcs_file(blob_key, size, gcs_file, buffer_size,
+                          prefetch=True, checksum=None, start=0,
+                          progress=None):
+  """Copies the bytes of a blob to an open GCS file.
+
+  While one chunk is written to GCS, the next chunk is already being
+  fetched from Blobstore, so at most two chunks are held in memory.
+
+  Args:
+    blob_key: The BlobKey (or BlobInfo) of the blob to copy.
+    size: The size of the blob in bytes.
+    gcs_file: A GCS file opened for writing.
+    buffer_size: The size of the chunks to copy.
+    prefetch: If False, each chunk is fetched only after the previous one
+      was written (used to benchmark the pipelined copy).
+    checksum: An optional checksums.StreamingChecksum updated with every
+      chunk.
+    start: The position to copy from; gcs_file must already hold the bytes
+      before it (e.g., when resuming an interrupted copy).
+    progress: An optional callable that is passed the position copied up
+      to after every chunk is written.
+
+  Returns:
+    The position copied up to; the number of bytes copied if start is 0.
+  """
+  def start_fetch(position):
+    if position >= size:
+      return None
+    return BlobRangeFetch(blob_key, position,
+                          min(position + buffer_size, size))
+
+  position = start
+  fetch = start_fetch(position)
+  while fetch is not None:
+    chunk = fetch.get_result()
+    if not chunk:
+      break
+    position += len(chunk)
+    fetch = start_fetch(position) if prefetch else None
+    if checksum is not None:
+      checksum.update(chunk)
+    gcs_file.write(chunk)
+    if progress is not None:
+      progress(position)
+    if not prefetch:
+      fetch = start_fetch(position)
+  return position
+
+
+@ndb.tasklet
+def copy_small_blob_async(blob_key, size, gcs_filename, content_type=None,
+                          options=None, checksum=None):
+  """Copies a blob that fits in a single fetch without blocking.
+
+  Args:
+    blob_key: The BlobKey (or BlobInfo) of the blob to copy.
+    size: The size of the blob in bytes; at most MAX_BLOB_FETCH_SIZE.
+    gcs_filename: The GCS file to write, rooted by "/[bucket_name]/...".
+    content_type: The content-type of the GCS file.
+    options: A dict of additional headers for the GCS file.
+    checksum: An optional checksums.StreamingChecksum updated with the data.
+
+  Returns:
+    A future for the number of bytes copied.
+  """
+  if size > blobstore.MAX_BLOB_FETCH_SIZE:
+    raise ValueError('Blob is too large to copy with a single fetch.')
+  data = ''
+  if size:
+    data = yield blobstore.fetch_data_async(blob_key, 0, size - 1)
+  if checksum is not None:
+    checksum.update(data)
+  copied = yield gcs.write_file_async(gcs_filename, data,
+                                      content_type=content_type,
+                                      options=options)
+  raise ndb.Return(copied)
@@ -0,0 +1,301 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Google Cloud Storage helpers that go beyond reading and writing files.
+"""
+import re
+import urllib
+import urlparse
+import uuid
+
+import cloudstorage
+from cloudstorage import common
+from cloudstorage import errors
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from app import checksums
+
+# GCS accepts at most this many source objects in a single compose request.
+MAX_COMPOSE_COMPONENTS = 32
+
+# Intermediate files of a composition are named "[destination].compose-[id]".
+COMPOSE_SUFFIX = '.compose-'
+
+# The requests this module sends itself go to the GCS XML API, authorized
+# with the application's service account.
+GCS_API_URL = 'https://storage.googleapis.com'
+GCS_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+
+# The deadline of the requests this module sends itself.
+GCS_REQUEST_DEADLINE_SECONDS = 60
+
+# The ETag of a non-composite object is the hex MD5 of its contents.
+_MD5_ETAG_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def split_gcs_filename(gcs_filename):
+  """Splits a GCS filename into its bucket and object name.
+
+  Args:
+    gcs_filename: A GCS filename rooted by "/[bucket_name]/...".
+
+  Returns:
+    A tuple of bucket name and object name (without leading slash).
+  """
+  if not gcs_filename or not gcs_filename.startswith('/'):
+    raise ValueError('gcs_filename must start with "/[bucket_name]/".')
+  bucket_name, _, object_name = gcs_filename[1:].partition('/')
+  if not bucket_name or not object_name:
+    raise ValueError('gcs_filename must include a bucket and object name.')
+  return bucket_name, object_name
+
+
+def compose_files(gcs_filenames, destination, content_type=None):
+  """Concatenates GCS files, in order, into a destination file.
+
+  More than MAX_COMPOSE_COMPONENTS files are composed in rounds through
+  intermediate files, which are deleted afterwards.
+
+  Args:
+    gcs_filenames: The files to concatenate, each rooted by "/[bucket_name]/";
+      all must be in the destination's bucket.
+    destination: The file to create, rooted by "/[bucket_name]/...".
+    content_type: The content-type of the destination file.
+  """
+  if not gcs_filenames:
+    raise ValueError('gcs_filenames is required.')
+  bucket_name, destination_name = split_gcs_filename(destination)
+  object_names = []
+  for gcs_filename in gcs_filenames:
+    part_bucket_name, object_name = split_gcs_filename(gcs_filename)
+    if part_bucket_name != bucket_name:
+      raise ValueError('Cannot compose %s into bucket %s.' % (gcs_filename,
+                                                              bucket_name))
+    object_names.append(object_name)
+
+  intermediates = []
+  try:
+    while len(object_names) > MAX_COMPOSE_COMPONENTS:
+      composed_names = []
+      for index in range(0, len(object_names), MAX_COMPOSE_COMPONENTS):
+        group = object_names[index:index + MAX_COMPOSE_COMPONENTS]
+        if len(group) == 1:
+          composed_names.append(group[0])
+          continue
+        intermediate = '%s%s%s' % (destination_name, COMPOSE_SUFFIX,
+                                   uuid.uuid4().hex.lower())
+        _compose('/%s/%s' % (bucket_name, intermediate), group, content_type)
+        intermediates.append('/%s/%s' % (bucket_name, intermediate))
+        composed_names.append(intermediate)
+      object_names = composed_names
+    _compose(destination, object_names, content_type)
+  finally:
+    delete_files(intermediates)
+
+
+def _compose(destination, object_names, content_type):
+  """Composes object names into the destination; handles a single source."""
+  if len(object_names) == 1:
+    bucket_name = split_gcs_filename(destination)[0]
+    cloudstorage.copy2('/%s/%s' % (bucket_name, object_names[0]), destination,
+                       metadata={'content-type': content_type}
+                       if content_type else None)
+  else:
+    cloudstorage.compose(object_names, destination, content_type=content_type)
+
+
+def delete_files(gcs_filenames):
+  """Deletes GCS files, ignoring any that do not exist.
+
+  Args:
+    gcs_filenames: The files to delete, each rooted by "/[bucket_name]/...".
+  """
+  for gcs_filename in gcs_filenames:
+    try:
+      cloudstorage.delete(gcs_filename)
+    except cloudstorage.NotFoundError:
+      pass
+
+
+@ndb.tasklet
+def _request_async(method, gcs_filename, headers=None, payload=None,
+                   query=None):
+  """Sends a request for a GCS file to the XML API without blocking.
+
+  Only public APIs are used: the request is an ndb urlfetch, authorized
+  with the application's service account, or sent to the GCS emulation of
+  dev_appserver when running locally (as cloudstorage.open() does).
+
+  Args:
+    method: The HTTP method (e.g., 'HEAD').
+    gcs_filename: The file, rooted by "/[bucket_name]/...".
+    headers: A dict of request headers.
+    payload: The body of the request.
+    query: A dict of query parameters.
+
+  Returns:
+    A future for the urlfetch result.
+  """
+  headers = dict(headers or {})
+  token = common.get_access_token()
+  if common.local_run() and not token:
+    url = common.local_api_url()
+  else:
+    url = GCS_API_URL
+    if not token:
+      token, _ = app_identity.get_access_token(GCS_SCOPE)
+    headers['authorization'] = 'OAuth ' + token
+  url += urllib.quote(gcs_filename)
+  if query:
+    url += '?' + urllib.urlencode(query)
+  result = yield ndb.get_context().urlfetch(
+      url, payload=payload, method=method, headers=headers,
+      follow_redirects=False, deadline=GCS_REQUEST_DEADLINE_SECONDS)
+  raise ndb.Return(result)
+
+
+@ndb.tasklet
+def delete_file_async(gcs_filename):
+  """Deletes a GCS file without blocking, ignoring a file that does not exist.
+
+  Args:
+    gcs_filename: The file to delete, rooted by "/[bucket_name]/...".
+
+  Returns:
+    A future for True if the file was deleted, False if it did not exist.
+  """
+  result = yield _request_async('DELETE', gcs_filename)
+  errors.check_status(result.status_code, [204, 404], gcs_filename,
+                      resp_headers=result.headers, body=result.content)
+  raise ndb.Return(result.status_code == 204)
+
+
+@ndb.tasklet
+def write_file_async(gcs_filename, data, content_type=None, options=None):
+  """Writes a whole GCS file without blocking.
+
+  This follows the same resumable upload protocol as cloudstorage.open()
+  (which the dev_appserver emulation requires), but sends all the data in a
+  single request. It is meant for small files, many of which can be written
+  concurrently.
+
+  Args:
+    gcs_filename: The file to write, rooted by "/[bucket_name]/...".
+    data: The complete contents of the file.
+    content_type: The content-type of the file.
+    options: A dict of additional headers (e.g., content-disposition).
+
+  Returns:
+    A future for the number of bytes written.
+  """
+  headers = {'x-goog-resumable': 'start'}
+  if content_type:
+    headers['content-type'] = content_type
+  if options:
+    headers.update(options)
+  result = yield _request_async('POST', gcs_filename, headers=headers)
+  errors.check_status(result.status_code, [201], gcs_filename, headers,
+                      result.headers, body=result.content)
+  location = result.headers.get('location')
+  upload_id = urlparse.parse_qs(urlparse.urlparse(location).query)['upload_id']
+
+  length = len(data)
+  if length:
+    content_range = 'bytes 0-%d/%d' % (length - 1, length)
+  else:
+    content_range = 'bytes */0'
+  headers = {'content-range': content_range}
+  result = yield _request_async('PUT', gcs_filename, headers=headers,
+                                payload=data,
+                                query={'upload_id': upload_id[0]})
+  errors.check_status(result.status_code, [200], gcs_filename, headers,
+                      result.headers, body=result.content)
+  raise ndb.Return(length)
+
+
+@ndb.tasklet
+def get_object_checksums_async(gcs_filename):
+  """Reads the size and hashes GCS reports for a file without blocking.
+
+  Args:
+    gcs_filename: The file to inspect, rooted by "/[bucket_name]/...".
+
+  Returns:
+    A future for a dict of checksums (see checksums.get_checksum_dict()).
+  """
+  result = yield _request_async('HEAD', gcs_filename)
+  errors.check_status(result.status_code, [200], gcs_filename,
+                      resp_headers=result.headers, body=result.content)
+  raise ndb.Return(parse_object_checksums(result.headers))
+
+
+def get_object_checksums(gcs_filename):
+  """Reads the size and hashes GCS reports for a file.
+
+  Args:
+    gcs_filename: The file to inspect, rooted by "/[bucket_name]/...".
+
+  Returns:
+    A dict of checksums (see checksums.get_checksum_dict()).
+  """
+  return get_object_checksums_async(gcs_filename).get_result()
+
+
+def parse_object_checksums(headers):
+  """Extracts the size and hashes from the headers of a GCS object.
+
+  The hashes come from the x-goog-hash headers. Without an MD5 there, the
+  ETag of a non-composite object is used; composite objects have no MD5.
+
+  Args:
+    headers: The response headers of a HEAD or GET request.
+
+  Returns:
+    A dict of checksums (see checksums.get_checksum_dict()).
+  """
+  size = headers.get('x-goog-stored-content-length',
+                     headers.get('content-length'))
+  md5_hash = None
+  crc32c = None
+  for item in (headers.get('x-goog-hash') or '').split(','):
+    name, _, value = item.strip().partition('=')
+    if name == 'md5' and value:
+      md5_hash = checksums.decode_gcs_md5(value)
+    elif name == 'crc32c' and value:
+      crc32c = checksums.decode_gcs_crc32c(value)
+  if md5_hash is None and not headers.get('x-goog-component-count'):
+    md5_hash = get_etag_md5(headers.get('etag'))
+  return checksums.get_checksum_dict(
+      int(size) if size is not None else None, md5_hash, crc32c)
+
+
+def get_etag_md5(etag):
+  """Returns the MD5 an ETag holds, if any.
+
+  The ETag of a non-composite object is the hex MD5 of its contents; the
+  ETag of a composite object is not.
+
+  Args:
+    etag: The ETag of a GCS object (e.g., GCSFileStat.etag), optionally
+      quoted.
+
+  Returns:
+    The hex MD5 digest, or None if the ETag is not one.
+  """
+  etag = (etag or '').strip('"')
+  if _MD5_ETAG_PATTERN.match(etag):
+    return etag
+  return None
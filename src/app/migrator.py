@@ -15,36 +15,315 @@
 """
 Pipeline classes to iterate and migrate blobstore blobs to Cloud Storage.
 """
+import calendar
+import datetime
 import uuid
 import json
 import logging
 
 import cloudstorage
+from google.appengine.api import datastore
 from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import stats as ndb_stats
 from mapreduce import context
 from mapreduce import input_readers
+from mapreduce import key_range
 from mapreduce import mapreduce_pipeline
 from mapreduce.operation import counters
 import pipeline
+from pipeline import common
 
+from app import checksums
 from app import config
+from app import copier
+from app import gcs
 from app import models
+from app import pools
+from app import sharded_counters
+from app import stats
+from app import tiers
 import appengine_config
 
-# Controls the size of the chunk that is copied; i.e., this is the size
-# of the RAM that will hold the chunk of blob while copying.
-# This size has been tuned for a 128MiB F1 frontend.
-BLOB_BUFFER_SIZE = 8 * 1024 * 1024
+# When balancing shards by size, every blob also counts as this many bytes
+# so that ranges of tiny blobs still account for their per-blob overhead.
+SHARD_BALANCE_PER_BLOB_BYTES = 64 * 1024
+
+# The number of scatter samples taken per shard to balance shards by size.
+SHARD_BALANCE_SAMPLES_PER_SHARD = 32
+
+# Each shard of a secondary pipeline reports the CRC32C of its byte range in
+# a counter named after the position the range starts at.
+PART_CRC32C_COUNTER_FORMAT = 'Part_crc32c_at_%d'
+
+# The MigrationFailure reason of copies that do not match their checksums.
+CHECKSUM_MISMATCH = 'checksum_mismatch'
+
+# The MigrationFailure reason of secondary pipelines that were aborted.
+COPY_ABORTED = 'copy_aborted'
+
+# The sharded counters of a migration that count the blobs its secondary
+# pipelines migrated carry this prefix before the name of the mapper
+# counter they add to (e.g., "Mapper_Bytes_migrated").
+SECONDARY_COUNTER_PREFIX = 'Mapper_'
+
+# A composed GCS file records the MD5 of its blob in this metadata header
+# once its copy has been verified, since GCS has no MD5 for composed files.
+SOURCE_MD5_METADATA = 'x-goog-meta-blobstore-md5'
+
+# How often the deletion of stale mappings checks whether the secondary
+# pipelines of its migration have finished.
+STALE_MAPPING_WAIT_SECONDS = 60
 
 
 class BlobstoreDatastoreInputReader(input_readers.DatastoreInputReader):
-  """Override kind lookup method because BlobInfo isn't actually a Model."""
+  """Override kind lookup method because BlobInfo isn't actually a Model.
+
+  When BALANCE_SHARDS_BY_SIZE is set, the key ranges are also chosen so that
+  every shard covers about the same number of bytes, not the same number of
+  blobs.
+  """
 
   @classmethod
   def _get_raw_entity_kind(cls, model_classpath):
     """Return hard-coded BlobInfo kind."""
     return blobstore.BLOB_INFO_KIND
 
+  @classmethod
+  def _split_ns_by_scatter(cls, shard_count, namespace, raw_entity_kind,
+                           *filters_and_app):
+    """Splits the BlobInfo key space into ranges of similar total size.
+
+    A scatter sample of BlobInfo keys is looked up to learn the size of each
+    sampled blob; each sample stands for a similar number of blobs, so its
+    size weights the key range around it.
+
+    Args:
+      shard_count: The number of shards.
+      namespace: The namespace to split.
+      raw_entity_kind: The entity kind to split.
+      *filters_and_app: The app id; MapReduce 1.9.22 and later pass the
+        query filters before it. Filtered splits are left to MapReduce.
+
+    Returns:
+      A list of key_range.KeyRange, padded with None to shard_count.
+    """
+    super_split = super(BlobstoreDatastoreInputReader, cls)._split_ns_by_scatter
+    app = filters_and_app[-1]
+    filters = filters_and_app[0] if len(filters_and_app) > 1 else None
+    if (not config.config.BALANCE_SHARDS_BY_SIZE or shard_count == 1 or
+        filters):
+      return super_split(shard_count, namespace, raw_entity_kind,
+                         *filters_and_app)
+
+    ds_query = datastore.Query(kind=raw_entity_kind,
+                               namespace=namespace,
+                               _app=app,
+                               keys_only=True)
+    ds_query.Order('__scatter__')
+    sample_keys = ds_query.Get(shard_count * SHARD_BALANCE_SAMPLES_PER_SHARD)
+    if not sample_keys:
+      return super_split(shard_count, namespace, raw_entity_kind,
+                         *filters_and_app)
+
+    samples = []
+    for key, entity in zip(sample_keys, datastore.Get(sample_keys)):
+      if entity is not None:
+        samples.append((key, entity.get('size') or 0))
+    samples.sort()
+    split_keys = choose_size_weighted_split_points(samples, shard_count)
+
+    if not split_keys:
+      k_ranges = [key_range.KeyRange(namespace=namespace, _app=app)]
+    else:
+      boundaries = [None] + split_keys + [None]
+      k_ranges = [key_range.KeyRange(key_start=key_start,
+                                     key_end=key_end,
+                                     direction=key_range.KeyRange.ASC,
+                                     include_start=key_start is not None,
+                                     include_end=False,
+                                     namespace=namespace,
+                                     _app=app)
+                  for key_start, key_end in zip(boundaries, boundaries[1:])]
+    return k_ranges + [None] * (shard_count - len(k_ranges))
+
+
+def choose_size_weighted_split_points(samples, shard_count):
+  """Chooses split keys so that shards cover similar cumulative sizes.
+
+  Each sample is assigned to the shard containing the midpoint of its weight
+  along the cumulative size, so a very large blob starts a range of its own.
+
+  Args:
+    samples: A list of (key, size) tuples sorted by key.
+    shard_count: The number of shards.
+
+  Returns:
+    A sorted list of at most shard_count - 1 keys; each key starts a range.
+  """
+  weighted = [(key, size + SHARD_BALANCE_PER_BLOB_BYTES)
+              for key, size in samples]
+  total = float(sum(weight for _, weight in weighted))
+  split_points = []
+  if not total:
+    return split_points
+  current_shard = None
+  cumulative = 0
+  for key, weight in weighted:
+    midpoint = cumulative + weight / 2.0
+    shard = min(int(midpoint / total * shard_count), shard_count - 1)
+    if current_shard is not None and shard > current_shard:
+      split_points.append(key)
+    current_shard = shard
+    cumulative += weight
+  return split_points
+
+
+class BlobstoreDatastoreBatchInputReader(BlobstoreDatastoreInputReader):
+  """Yields pages of BlobInfo records instead of single records.
+
+  Each page holds up to MAPPING_LOOKUP_BATCH_SIZE records, so the mapper can
+  resolve the already-migrated check for the whole page with one RPC.
+  """
+
+  def __iter__(self):
+    """Groups the BlobInfo records of the underlying reader into lists.
+
+    A page is yielded as soon as its last record has been read, so the
+    position checkpointed at the end of a slice never skips past records
+    that have not been handed to the mapper yet.
+    """
+    batch_size = max(1, config.config.MAPPING_LOOKUP_BATCH_SIZE)
+    batch = []
+    for blob_info in super(BlobstoreDatastoreBatchInputReader, self).__iter__():
+      batch.append(blob_info)
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+
+class BlobstoreCreationRangeInputReader(input_readers.InputReader):
+  """Yields pages of the BlobInfo records created within a time window.
+
+  The window is split into equal sub-windows, one per shard. Each shard
+  queries its sub-window in creation order, using the built-in index on
+  BlobInfo.creation, and checkpoints a query cursor.
+  """
+
+  CREATION_START_PARAM = 'creation_start'
+  CREATION_END_PARAM = 'creation_end'
+  CURSOR_PARAM = 'cursor'
+
+  def __init__(self, creation_start, creation_end, cursor=None):
+    """Initializes this instance with the given creation window.
+
+    Args:
+      creation_start: The first creation time to read, as a UTC timestamp.
+      creation_end: The creation time to stop reading at (exclusive), as a
+        UTC timestamp.
+      cursor: The query cursor to resume from.
+    """
+    self.creation_start = creation_start
+    self.creation_end = creation_end
+    self.cursor = cursor
+
+  def __iter__(self):
+    """Yields lists of up to MAPPING_LOOKUP_BATCH_SIZE BlobInfo records."""
+    batch_size = max(1, config.config.MAPPING_LOOKUP_BATCH_SIZE)
+    while True:
+      query = blobstore.BlobInfo.all()
+      query.filter('creation >=', from_timestamp(self.creation_start))
+      query.filter('creation <', from_timestamp(self.creation_end))
+      query.order('creation')
+      if self.cursor:
+        query.with_cursor(self.cursor)
+      blob_infos = query.fetch(batch_size)
+      if not blob_infos:
+        return
+      self.cursor = query.cursor()
+      yield blob_infos
+      if len(blob_infos) < batch_size:
+        return
+
+  @classmethod
+  def from_json(cls, input_shard_state):
+    """Creates an instance of the InputReader for the given input shard state.
+
+    Args:
+      input_shard_state: The InputReader state as a dict-like object.
+
+    Returns:
+      An instance of the InputReader configured using the values of json.
+    """
+    return cls(input_shard_state[cls.CREATION_START_PARAM],
+               input_shard_state[cls.CREATION_END_PARAM],
+               input_shard_state.get(cls.CURSOR_PARAM))
+
+  def to_json(self):
+    """Returns an input shard state for the remaining inputs.
+
+    Returns:
+      A json-izable version of the remaining InputReader.
+    """
+    return {
+      self.CREATION_START_PARAM: self.creation_start,
+      self.CREATION_END_PARAM: self.creation_end,
+      self.CURSOR_PARAM: self.cursor,
+    }
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a list of input readers, one per sub-window of creation times.
+
+    Args:
+      mapper_spec: model.MapperSpec specifies the inputs and additional
+        parameters to define the behavior of input readers.
+
+    Returns:
+      A list of InputReaders. None or [] when no input data can be found.
+    """
+    params = input_readers._get_params(mapper_spec)
+    start = params[cls.CREATION_START_PARAM]
+    end = params[cls.CREATION_END_PARAM]
+    if start >= end:
+      return None
+    shard_count = max(1, mapper_spec.shard_count)
+    width = float(end - start) / shard_count
+    boundaries = [start + width * index for index in range(shard_count)]
+    boundaries.append(end)
+    return [cls(shard_start, shard_end)
+            for shard_start, shard_end in zip(boundaries, boundaries[1:])]
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec and all mapper parameters.
+
+    Args:
+      mapper_spec: The MapperSpec for this InputReader.
+
+    Raises:
+      BadReaderParamsError: required parameters are missing or invalid.
+    """
+    if mapper_spec.input_reader_class() != cls:
+      raise input_readers.BadReaderParamsError('Input reader class mismatch')
+    params = input_readers._get_params(mapper_spec)
+    for param in [cls.CREATION_START_PARAM, cls.CREATION_END_PARAM]:
+      if not isinstance(params.get(param), (int, long, float)):
+        raise input_readers.BadReaderParamsError(
+            "Must specify '%s' as a timestamp for mapper input" % param)
+
+
+def to_timestamp(value):
+  """Converts a naive UTC datetime to a UTC timestamp."""
+  return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def from_timestamp(timestamp):
+  """Converts a UTC timestamp to a naive UTC datetime."""
+  return datetime.datetime.utcfromtimestamp(timestamp)
+
 
 class BlobstoreInputReader(input_readers.InputReader):
   """Reads chunks of blobstore blobs."""
@@ -52,34 +331,56 @@ class BlobstoreInputReader(input_readers.InputReader):
   BLOB_KEY_PARAM = 'blob_key'
   START_POSITION_PARAM = 'start_position'
   END_POSITION_PARAM = 'end_position'
+  PART_START_PARAM = 'part_start'
+  CRC32C_PARAM = 'crc32c'
 
-  def __init__(self, blob_key, start_position, end_position):
+  def __init__(self, blob_key, start_position, end_position, part_start=None,
+               crc32c=0):
     """Initializes this instance with the given blob key and character range.
 
     Args:
       blob_key: the blob key to read
       start_position: the starting position to read the blob from
-      end_position: the last position from the blob to read
+      end_position: the position to stop reading at (exclusive)
+      part_start: the position the shard's byte range starts at; defaults to
+        start_position
+      crc32c: the CRC32C of the bytes from part_start to start_position
     """
     self.blob_key = blob_key
     self.start_position = start_position
     self.end_position = end_position
-    self.blob_reader = blobstore.BlobReader(blob_key,
-                                            position=start_position,
-                                            buffer_size=BLOB_BUFFER_SIZE)
+    self.position = start_position
+    if part_start is None:
+      part_start = start_position
+    self.part_start = part_start
+    self.crc32c = None
+    if 'crc32c' in config.config.CHECKSUMS:
+      # the MD5s of parts cannot be combined, so parts are checked by CRC32C
+      self.crc32c = crc32c or 0
+    self.buffer_size = copier.get_buffer_size(end_position - start_position)
 
   def next(self):
     """Returns the next input from this input reader as a key, value pair.
 
     Returns:
-      A tuple of start_position for the chunk and the chunk of data.
+      A tuple of start_position for the chunk and the chunk of data. For the
+      last chunk of the range, a tuple of the part_start and the CRC32C of
+      the whole range is appended (if CHECKSUMS includes 'crc32c').
     """
-    start_position = self.blob_reader.tell()
-    if start_position > self.end_position:
+    start_position = self.position
+    if start_position >= self.end_position:
       raise StopIteration()
-    chunk = self.blob_reader.read(BLOB_BUFFER_SIZE)
+    chunk = copier.fetch_blob_range(
+        self.blob_key, start_position,
+        min(start_position + self.buffer_size, self.end_position))
     if not chunk:
       raise StopIteration()
+    self.position += len(chunk)
+    if self.crc32c is None:
+      return start_position, chunk
+    self.crc32c = checksums.crc32c(chunk, self.crc32c)
+    if self.position >= self.end_position:
+      return start_position, chunk, (self.part_start, self.crc32c)
     return start_position, chunk
 
   @classmethod
@@ -94,7 +395,9 @@ class BlobstoreInputReader(input_readers.InputReader):
     """
     return cls(input_shard_state[cls.BLOB_KEY_PARAM],
                input_shard_state[cls.START_POSITION_PARAM],
-               input_shard_state[cls.END_POSITION_PARAM])
+               input_shard_state[cls.END_POSITION_PARAM],
+               input_shard_state.get(cls.PART_START_PARAM),
+               input_shard_state.get(cls.CRC32C_PARAM) or 0)
 
   def to_json(self):
     """Returns an input shard state for the remaining inputs.
@@ -102,11 +405,13 @@ class BlobstoreInputReader(input_readers.InputReader):
     Returns:
       A json-izable version of the remaining InputReader.
     """
-    new_position = self.blob_reader.tell()
+    new_position = self.position
     return {
       self.BLOB_KEY_PARAM: self.blob_key,
       self.START_POSITION_PARAM: new_position,
       self.END_POSITION_PARAM: self.end_position,
+      self.PART_START_PARAM: self.part_start,
+      self.CRC32C_PARAM: self.crc32c,
     }
 
   @classmethod
@@ -114,7 +419,8 @@ class BlobstoreInputReader(input_readers.InputReader):
     """Returns a list of input readers.
 
     This method creates a list of input readers, each for one shard.
-    It attempts to split inputs among readers evenly.
+    It splits the blob into contiguous byte ranges of (nearly) equal size,
+    one per shard; shard N reads the N-th range.
 
     Args:
       mapper_spec: model.MapperSpec specifies the inputs and additional
@@ -128,7 +434,9 @@ class BlobstoreInputReader(input_readers.InputReader):
     blob_info = blobstore.BlobInfo.get(blobstore.BlobKey(blob_key))
     if not blob_info:
       return None
-    return [cls(blob_key, 0, blob_info.size)] # one shard per blob
+    return [cls(blob_key, start, end)
+            for start, end in split_byte_range(blob_info.size,
+                                               mapper_spec.shard_count)]
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -159,6 +467,45 @@ class BlobstoreInputReader(input_readers.InputReader):
                                  blob_key)
 
 
+def split_byte_range(size, parts):
+  """Splits the bytes of a blob into contiguous ranges.
+
+  Args:
+    size: The size of the blob in bytes.
+    parts: The maximum number of ranges.
+
+  Returns:
+    A list of (start, end) tuples, end exclusive, covering [0, size).
+  """
+  parts = max(1, min(parts, size))
+  part_size, remainder = divmod(size, parts)
+  ranges = []
+  start = 0
+  for index in range(parts):
+    end = start + part_size + (1 if index < remainder else 0)
+    ranges.append((start, end))
+    start = end
+  return ranges
+
+
+def get_composite_part_count(size):
+  """Returns the number of parts to copy a blob in parallel.
+
+  Args:
+    size: The size of the blob in bytes.
+
+  Returns:
+    The number of byte ranges to copy in parallel; 1 for a single stream.
+  """
+  if not size:
+    return 1
+  min_part_size = max(1, config.config.COMPOSITE_UPLOAD_MIN_PART_SIZE)
+  parts = min(config.config.COMPOSITE_UPLOAD_PARTS,
+              gcs.MAX_COMPOSE_COMPONENTS,
+              (size + min_part_size - 1) // min_part_size)
+  return max(1, parts)
+
+
 def _get_blob_key_str(blob_info_or_key):
   """Gets the BlobKey str from a dynamic input.
 
@@ -176,6 +523,22 @@ def _get_blob_key_str(blob_info_or_key):
   return blob_info_or_key
 
 
+def _is_gcs_simulation(blob_key_str):
+  """Checks if the blob is really a GCS file simulated by dev_appserver.
+
+  dev_appserver's stubs store the GCS blobs in the same place as blobstore
+  blobs. We'll skip these so our testing is cleaner.
+
+  Args:
+    blob_key_str: The blob key string.
+
+  Returns:
+    True if the blob should not be migrated.
+  """
+  return (appengine_config.IS_DEVSERVER and
+          blob_key_str.startswith('encoded_gs_file:'))
+
+
 def migrate_blob(blob_info, _mapper_params=None):
   """Starts a mapper pipeline to migrate single blob to cloud storage object.
 
@@ -188,54 +551,291 @@ def migrate_blob(blob_info, _mapper_params=None):
   """
   params = _mapper_params or context.get().mapreduce_spec.mapper.params
   bucket_name = params['bucket_name']
+  root_pipeline_id = params.get('root_pipeline_id')
 
   yield counters.Increment('BlobInfo_considered_for_migration')
+  yield counters.Increment('Bytes_considered_for_migration', blob_info.size)
 
   blob_key_str = _get_blob_key_str(blob_info)
 
-  # dev_appserver's stubs store the GCS blobs in the same place as blobstore
-  # blobs. We'll skip these so our testing is cleaner.
-  if (appengine_config.IS_DEVSERVER and
-      blob_key_str.startswith('encoded_gs_file:')):
+  if _is_gcs_simulation(blob_key_str):
     yield counters.Increment(
       'BlobInfo_is_really_GCS_file_on_dev_appserver__skipping')
     raise StopIteration()
 
   # look up the blob_key in the migration table; if already migrated, skip it
   already_mapped = models.BlobKeyMapping.build_key(blob_key_str).get()
-  if already_mapped:
+  if is_current_mapping(already_mapped, bucket_name):
     yield counters.Increment('BlobInfo_previously_migrated')
     raise StopIteration()  # no work to do for this blob
+  if already_mapped:
+    yield counters.Increment('BlobInfo_mapped_by_other_generation')
+
+  for operation in _migrate_unmapped_blob(blob_info, bucket_name,
+                                          root_pipeline_id):
+    yield operation
+
+
+def migrate_blob_batch(blob_infos, _mapper_params=None):
+  """Migrates a page of blobs, resolving their mappings with one lookup.
+
+  Args:
+    blob_infos: A list of the BlobInfos to migrate.
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  bucket_name = params['bucket_name']
+  root_pipeline_id = params.get('root_pipeline_id')
+
+  yield counters.Increment('BlobInfo_considered_for_migration',
+                           len(blob_infos))
+  yield counters.Increment('Bytes_considered_for_migration',
+                           sum(blob_info.size for blob_info in blob_infos))
+
+  candidates = []
+  for blob_info in blob_infos:
+    if _is_gcs_simulation(_get_blob_key_str(blob_info)):
+      yield counters.Increment(
+        'BlobInfo_is_really_GCS_file_on_dev_appserver__skipping')
+    else:
+      candidates.append(blob_info)
+  if not candidates:
+    raise StopIteration()
+
+  # look up all the blob_keys in the migration table with a single RPC
+  keys = [models.BlobKeyMapping.build_key(_get_blob_key_str(blob_info))
+          for blob_info in candidates]
+  mappings = ndb.get_multi(keys)
+  yield counters.Increment('BlobKeyMapping_batched_lookups')
+  yield counters.Increment('BlobKeyMapping_lookup_rpcs_saved', len(keys) - 1)
+
+  small_blob_infos = []
+  for blob_info, already_mapped in zip(candidates, mappings):
+    if is_current_mapping(already_mapped, bucket_name):
+      yield counters.Increment('BlobInfo_previously_migrated')
+      continue
+    if already_mapped:
+      yield counters.Increment('BlobInfo_mapped_by_other_generation')
+    if is_concurrent_candidate(blob_info):
+      small_blob_infos.append(blob_info)
+    else:
+      for operation in _migrate_unmapped_blob(blob_info, bucket_name,
+                                              root_pipeline_id):
+        yield operation
+
+  for blob_info, mismatches in migrate_small_blobs_concurrently(
+      small_blob_infos, bucket_name):
+    if mismatches:
+      yield counters.Increment('BlobInfo_checksum_mismatch')
+      continue
+    for operation in _count_migrated(blob_info,
+                                     ['within_mapper', 'concurrently']):
+      yield operation
+
+
+def get_generation(bucket_name):
+  """Returns the generation of the mappings a migration creates.
+
+  Args:
+    bucket_name: The bucket the migration copies the blobs into.
+
+  Returns:
+    MIGRATION_GENERATION if configured, otherwise the bucket name.
+  """
+  return config.config.MIGRATION_GENERATION or bucket_name
+
+
+def is_current_mapping(mapping, bucket_name):
+  """Checks if a mapping counts as migrated for a migration into a bucket.
+
+  Args:
+    mapping: The BlobKeyMapping entity, or None.
+    bucket_name: The bucket the migration copies the blobs into.
+
+  Returns:
+    True if the mapping exists and belongs to the migration's generation.
+  """
+  return bool(mapping and
+              mapping.get_generation() == get_generation(bucket_name))
+
+
+def _migrate_unmapped_blob(blob_info, bucket_name, root_pipeline_id=None):
+  """Copies a blob that is known not to have been migrated yet.
+
+  Args:
+    blob_info: The BlobInfo of the blob to copy.
+    bucket_name: The bucket to copy the blob into.
+    root_pipeline_id: The root pipeline of the migration, which aggregates
+      the progress of its secondary pipelines.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  tier = tiers.get_size_tier(blob_info.size)
 
   # if the blob is "small", migrate it in-line
-  if blob_info.size <= config.config.DIRECT_MIGRATION_MAX_SIZE:
-    migrate_single_blob_inline(blob_info, bucket_name)
-    yield counters.Increment('BlobInfo_migrated_within_mapper')
+  if not uses_secondary_pipeline(blob_info.size):
+    buffer_size = copier.get_buffer_size(blob_info.size)
+    gcs_filename = migrate_single_blob_inline(blob_info, bucket_name,
+                                              buffer_size=buffer_size)
+    yield counters.Increment('Copy_buffer_size_%dKiB' % (buffer_size // 1024))
+    if not gcs_filename:
+      yield counters.Increment('BlobInfo_checksum_mismatch')
+      raise StopIteration()
+    for operation in _count_migrated(blob_info, ['within_mapper'], tier):
+      yield operation
 
   # else start a full-scale pipeline to handle the blob migration
   else:
-    pipeline = MigrateSingleBlobPipeline(blob_key_str,
+    pipeline = MigrateSingleBlobPipeline(_get_blob_key_str(blob_info),
                                          blob_info.filename,
                                          blob_info.content_type,
-                                         bucket_name)
-    pipeline.start(queue_name=config.config.QUEUE_NAME)
-    yield counters.Increment('BlobInfo_migrated_via_secondary_pipeline')
+                                         bucket_name,
+                                         blob_info.size,
+                                         root_pipeline_id)
+    pipeline.target = tier['target']
+    pipeline.start(queue_name=tiers.get_queue_name(tier))
+    record_secondary_pipeline(root_pipeline_id, 'started', blob_info.size)
+    # counted as migrated once the pipeline completes
+    yield counters.Increment('BlobInfo_handed_to_secondary_pipeline')
+    yield counters.Increment('Bytes_handed_to_secondary_pipeline',
+                             blob_info.size)
+
+
+def record_secondary_pipeline(root_pipeline_id, event, size):
+  """Counts a secondary pipeline event against its migration.
+
+  Args:
+    root_pipeline_id: The root pipeline of the migration, or None.
+    event: 'started', 'completed', 'failed', 'mismatched' or 'skipped'.
+    size: The size of the blob the secondary pipeline copies.
+  """
+  if not root_pipeline_id:
+    return
+  sharded_counters.increment(root_pipeline_id, {
+    '%s_blobs' % event: 1,
+    '%s_bytes' % event: size or 0,
+  })
+
+
+def record_secondary_completion(root_pipeline_id, size, skipped=False):
+  """Counts a completed secondary pipeline and the blob it migrated.
+
+  The blob is counted as migrated via_secondary_pipeline (see
+  get_migrated_counts()) in the migration's sharded counters, under
+  SECONDARY_COUNTER_PREFIX.
+
+  Args:
+    root_pipeline_id: The root pipeline of the migration, or None.
+    size: The size of the migrated blob, or None if unknown.
+    skipped: Whether the blob's copy was already in GCS.
+  """
+  if not root_pipeline_id:
+    return
+  deltas = {'completed_blobs': 1, 'completed_bytes': size or 0}
+  if skipped:
+    deltas.update({'skipped_blobs': 1, 'skipped_bytes': size or 0})
+  if size is not None:
+    for name, delta in get_migrated_counts(
+        size, ['via_secondary_pipeline']).iteritems():
+      deltas[SECONDARY_COUNTER_PREFIX + name] = delta
+  sharded_counters.increment(root_pipeline_id, deltas)
+
+
+def count_secondary_pipelines_in_flight(root_pipeline_id):
+  """Returns the number of a migration's secondary pipelines still copying.
+
+  Args:
+    root_pipeline_id: The root pipeline of the migration, or None.
+  """
+  if not root_pipeline_id:
+    return 0
+  totals = sharded_counters.get_totals(root_pipeline_id)
+  return max(0, totals.get('started_blobs', 0) -
+             totals.get('completed_blobs', 0) -
+             totals.get('failed_blobs', 0))
+
+
+def uses_secondary_pipeline(size):
+  """Checks if a blob is copied by a secondary pipeline, not the mapper.
+
+  Args:
+    size: The size of the blob in bytes.
+
+  Returns:
+    True if the blob is larger than DIRECT_MIGRATION_MAX_SIZE or its size
+    tier has its own queue.
+  """
+  return (size > config.config.DIRECT_MIGRATION_MAX_SIZE or
+          bool(tiers.get_size_tier(size)['queue_name']))
+
+
+def _count_migrated(blob_info, paths, tier=None):
+  """Counts a blob migrated by the mapper and its bytes.
+
+  Blobs handed to a secondary pipeline are counted once the pipeline
+  completes (see record_secondary_completion()).
+
+  Args:
+    blob_info: The BlobInfo of the migrated blob.
+    paths: The copy paths the blob took (e.g., 'within_mapper').
+    tier: The blob's size tier, if already known.
+
+  Yields:
+    MapReduce counter operations.
+  """
+  counts = get_migrated_counts(blob_info.size, paths, tier)
+  for name, delta in sorted(counts.iteritems()):
+    yield counters.Increment(name, delta)
 
-  yield counters.Increment('BlobInfo_migrated')
-  raise StopIteration()
+
+def get_migrated_counts(size, paths, tier=None):
+  """Returns the counter deltas of a migrated blob and its bytes.
+
+  The blob is counted in total, for each copy path it took, for its size
+  tier and for its log-scale size bucket.
+
+  Args:
+    size: The size of the migrated blob.
+    paths: The copy paths the blob took (e.g., 'within_mapper').
+    tier: The blob's size tier, if already known.
+
+  Returns:
+    A dict of counter names to deltas.
+  """
+  counts = {}
+  def add(names):
+    blobs_counter, bytes_counter = names
+    counts[blobs_counter] = counts.get(blobs_counter, 0) + 1
+    counts[bytes_counter] = counts.get(bytes_counter, 0) + size
+
+  for path in paths:
+    add(('BlobInfo_migrated_%s' % path, 'Bytes_migrated_%s' % path))
+  add(tiers.get_counter_names(tier or tiers.get_size_tier(size)))
+  add(stats.get_size_bucket_counter_names(size))
+  add(('BlobInfo_migrated', 'Bytes_migrated'))
+  return counts
 
 
 def yield_data(data):
   """Simply yields data.
 
   Args:
-    A tuple of start_position (integer) and a chunk of data.
+    A tuple of start_position (integer) and a chunk of data, followed by the
+    part_start and CRC32C of the shard's byte range for its last chunk.
 
   Yields:
-    The chunk of data from the tuple.
+    The chunk of data from the tuple, and a counter operation holding the
+    CRC32C of the byte range after its last chunk.
   """
-  start_position, chunk = data
+  chunk = data[1]
   yield chunk
+  if len(data) > 2:
+    part_start, crc32c = data[2]
+    yield counters.Increment(PART_CRC32C_COUNTER_FORMAT % part_start, crc32c)
 
 
 def build_gcs_filename(blob_info_or_key,
@@ -289,12 +889,7 @@ def build_gcs_filename(blob_info_or_key,
     gcs_filename += '/' + filename
 
   # prepend the root folder
-  root_folder = config.config.ROOT_GCS_FOLDER
-  if not root_folder:
-    root_folder = ''
-  root_folder = root_folder.strip('/')  # remove any leading/trailing slash
-  if root_folder:
-    gcs_filename = root_folder + '/' + gcs_filename
+  gcs_filename = get_gcs_root_prefix() + gcs_filename
 
   # prepend the bucket including a leading slash, if specified
   if include_bucket:
@@ -309,6 +904,58 @@ def build_gcs_filename(blob_info_or_key,
   return gcs_filename
 
 
+def get_gcs_root_prefix():
+  """Returns the object name prefix of the migrated files, e.g. "root/"."""
+  root_folder = (config.config.ROOT_GCS_FOLDER or '').strip('/')
+  return root_folder + '/' if root_folder else ''
+
+
+def parse_gcs_filename(gcs_filename):
+  """Finds the blob key a GCS file was migrated from.
+
+  This reverses build_gcs_filename(); the part files of parallel copies and
+  the intermediate files of compositions are recognized too.
+
+  Args:
+    gcs_filename: A GCS filename rooted by "/[bucket_name]/...".
+
+  Returns:
+    The blob key string, or None if the file was not named by the migration.
+  """
+  _, object_name = gcs.split_gcs_filename(gcs_filename)
+  root_prefix = get_gcs_root_prefix()
+  if not object_name.startswith(root_prefix):
+    return None
+  segments = object_name[len(root_prefix):].split('/')
+  if len(segments) < 5:
+    return None
+  blob_key_str = segments[4].split(gcs.COMPOSE_SUFFIX)[0]
+  if segments[:4] != [blob_key_str[0:8], blob_key_str[8:10],
+                      blob_key_str[10:12], blob_key_str[12:14]]:
+    return None
+  return blob_key_str
+
+
+# Part files of parallel copies are named "[...]/[blob_key]/_parts/part-N".
+PART_NAME_PREFIX = '_parts/part-'
+
+
+def build_gcs_part_name_format(blob_info_or_key):
+  """Builds the naming format of the part files of a parallel copy.
+
+  The part files are placed next to the final GCS file. The mapreduce output
+  writer substitutes "$num" with the number of the shard writing the part.
+
+  Args:
+    blob_info_or_key: The blob's BlobInfo, BlobKey, or blob key string.
+
+  Returns:
+    A naming format for the GCS output writer, relative to the bucket.
+  """
+  return build_gcs_filename(blob_info_or_key,
+                            filename=PART_NAME_PREFIX + '$num')
+
+
 def build_content_disposition(filename):
   """Builds a content-disposition header.
 
@@ -340,20 +987,287 @@ class MigrateAllBlobsPipeline(pipeline.Pipeline):
     params = {
       'entity_kind': 'google.appengine.ext.blobstore.blobstore.BlobInfo',
       'bucket_name': bucket_name,
+      'root_pipeline_id': self.root_pipeline_id,
     }
-    yield mapreduce_pipeline.MapperPipeline(
+    params['expected_blobs'], params['expected_bytes'] = get_expected_totals()
+    if config.config.MAPPING_LOOKUP_BATCH_SIZE > 1:
+      handler_spec = 'app.migrator.migrate_blob_batch'
+      input_reader_spec = 'app.migrator.BlobstoreDatastoreBatchInputReader'
+    else:
+      handler_spec = 'app.migrator.migrate_blob'
+      input_reader_spec = 'app.migrator.BlobstoreDatastoreInputReader'
+    mapper = yield mapreduce_pipeline.MapperPipeline(
       'iterate_blobs',
-      'app.migrator.migrate_blob',
-      'app.migrator.BlobstoreDatastoreInputReader',
+      handler_spec,
+      input_reader_spec,
       params=params,
       shards=config.config.NUM_SHARDS)
 
+    yield CollectStaleMappings(get_generation(bucket_name),
+                               mapper.result_status, mapper.counters)
+
+
+class CollectStaleMappings(pipeline.Pipeline):
+  """Starts deleting the mappings of other generations after a migration."""
+
+  def run(self, generation, result_status, mapper_counters):
+    """Starts a DeleteStaleMappingsPipeline if the migration needs one.
+
+    The deletion runs as a pipeline of its own, so the migration completes
+    without waiting for it; the deletion waits for the migration's secondary
+    pipelines instead.
+
+    Args:
+      generation: The generation of the migration.
+      result_status: The result status of the migration's mapper job.
+      mapper_counters: The counters of the migration's mapper job.
+    """
+    if result_status != 'success':
+      logging.warning('Not deleting the mappings of other generations; the '
+                      'mapper job finished with status %s.', result_status)
+      return
+    if not (mapper_counters or {}).get('BlobInfo_mapped_by_other_generation'):
+      return
+    collector = DeleteStaleMappingsPipeline(generation, self.root_pipeline_id)
+    collector.start(queue_name=config.config.QUEUE_NAME)
+
+
+class DeleteStaleMappingsPipeline(pipeline.Pipeline):
+  """Launch a MapReduce job to delete the mappings of other generations."""
+
+  def run(self, generation, migration_pipeline_id=None):
+    """Deletes the mappings a migration into a generation left behind.
+
+    Until the secondary pipelines of the migration have finished, the old
+    mappings of their blobs are still the only mappings of those blobs, so
+    the job starts only once none are in flight. It reads at most
+    STALE_MAPPING_MAX_OPS_PER_SECOND mappings per second, so it can run in
+    the background of the application.
+
+    Args:
+      generation: The generation whose mappings are kept.
+      migration_pipeline_id: The root pipeline of the migration.
+
+    Yields:
+      A MapperPipeline for the MapReduce job to delete the stale mappings,
+      or a delay and another DeleteStaleMappingsPipeline while secondary
+      pipelines are in flight.
+    """
+    if count_secondary_pipelines_in_flight(migration_pipeline_id):
+      delay = yield common.Delay(seconds=STALE_MAPPING_WAIT_SECONDS)
+      with pipeline.After(delay):
+        yield DeleteStaleMappingsPipeline(generation, migration_pipeline_id)
+      return
+    params = {
+      'entity_kind': 'app.models.BlobKeyMapping',
+      'root_pipeline_id': self.root_pipeline_id,
+      'generation': generation,
+      'scope': {
+        'max_ops_per_second': config.config.STALE_MAPPING_MAX_OPS_PER_SECOND,
+      },
+    }
+    yield mapreduce_pipeline.MapperPipeline(
+      'delete_stale_mappings',
+      'app.migrator.delete_stale_mappings',
+      'app.scrubber.ScrubInputReader',
+      params=params,
+      shards=config.config.NUM_SHARDS)
+
+
+def delete_stale_mappings(pairs, _mapper_params=None):
+  """Deletes the mappings of a page that belong to another generation.
+
+  Mappings whose source blob was deleted are kept, since they are the only
+  way to find their GCS files, and so are the mappings of blobs whose copy
+  in the generation failed (see MigrationFailure), since the blob has no
+  other working mapping. Each stale mapping is deleted in a transaction
+  that checks its generation again, so a mapping that a copy has just
+  replaced is not lost.
+
+  Args:
+    pairs: A list of tuples of BlobKeyMapping and BlobInfo (or None), as
+      read by scrubber.ScrubInputReader.
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  generation = params['generation']
+  stale = [(mapping, blob_info) for mapping, blob_info in pairs
+           if mapping.get_generation() != generation]
+  failures = ndb.get_multi(
+      [models.MigrationFailure.build_key(mapping.key.id())
+       for mapping, _ in stale])
+  for (mapping, blob_info), failure in zip(stale, failures):
+    if not blob_info:
+      yield counters.Increment('Stale_mappings_kept_without_source_blob')
+    elif _is_failure_of_generation(failure, generation):
+      yield counters.Increment('Stale_mappings_kept_after_failed_copy')
+    elif _delete_if_stale(mapping.key, generation):
+      yield counters.Increment('Stale_mappings_deleted')
+
+
+def _is_failure_of_generation(failure, generation):
+  """Checks if a MigrationFailure was recorded by a copy into a generation."""
+  if not failure or not failure.gcs_filename:
+    return False
+  bucket_name = gcs.split_gcs_filename(failure.gcs_filename)[0]
+  return get_generation(bucket_name) == generation
+
+
+@ndb.transactional
+def _delete_if_stale(key, generation):
+  """Deletes a mapping unless it belongs to the generation."""
+  mapping = key.get()
+  if not mapping or mapping.get_generation() == generation:
+    return False
+  key.delete()
+  return True
+
+
+def get_expected_totals():
+  """Returns the number of blobs and bytes a full migration will consider.
+
+  The totals come from the latest migration plan or, without one, the
+  number of blobs from the Datastore statistics.
+
+  Returns:
+    A tuple of the number of blobs and bytes; either may be None if unknown.
+  """
+  plan = models.MigrationPlan.build_key().get()
+  if plan:
+    return plan.blobs, plan.bytes
+  kind_stat = ndb_stats.KindStat.query(
+      ndb_stats.KindStat.kind_name == blobstore.BLOB_INFO_KIND).get()
+  if kind_stat:
+    return kind_stat.count, None
+  return None, None
+
+
+def start_new_blobs_migration(bucket_name):
+  """Starts an incremental migration unless one is still running.
+
+  Args:
+    bucket_name: The bucket to copy the new blobs into.
+
+  Returns:
+    The started MigrateNewBlobsPipeline, or None if the previous incremental
+    run into the bucket has not finished yet.
+  """
+  watermark = models.MigrationWatermark.build_key(bucket_name).get()
+  if watermark and watermark.pipeline_id:
+    if _is_pipeline_running(watermark.pipeline_id):
+      return None
+  new_blobs_pipeline = MigrateNewBlobsPipeline(bucket_name)
+  new_blobs_pipeline.start(queue_name=config.config.QUEUE_NAME)
+  models.MigrationWatermark.record_pipeline(
+      bucket_name, new_blobs_pipeline.root_pipeline_id)
+  return new_blobs_pipeline
+
+
+def _is_pipeline_running(pipeline_id):
+  """Checks if a root pipeline has neither completed nor been aborted."""
+  try:
+    status_tree = pipeline.get_status_tree(pipeline_id)
+  except pipeline.PipelineStatusError:
+    return False
+  info = status_tree.get('pipelines', {}).get(pipeline_id, {})
+  return info.get('status') not in ('done', 'aborted')
+
+
+class MigrateNewBlobsPipeline(pipeline.Pipeline):
+  """Migrate the blobs created since the last successful incremental run.
+
+  Only BlobInfo records created after the bucket's MigrationWatermark are
+  scanned. The watermark advances only once the mapper job has succeeded, so
+  a failed run is simply scanned again by the next one.
+  """
+
+  def run(self, bucket_name):
+    """Copies the new blobs.
+
+    Args:
+      bucket_name: the bucket to copy the blobs into.
+
+    Yields:
+      A MapperPipeline for the new blobs, then the watermark update.
+    """
+    if not bucket_name:
+      raise ValueError('bucket_name is required.')
+    watermark = models.MigrationWatermark.build_key(bucket_name).get()
+    creation_start = watermark.get_scan_start() if watermark else None
+    retry_from = watermark.retry_from if watermark else None
+    if creation_start is None:
+      oldest = blobstore.BlobInfo.all().order('creation').get()
+      if not oldest:
+        return
+      creation_start = oldest.creation
+
+    # blobs created just before now may not be visible to queries yet
+    creation_end = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=config.config.INCREMENTAL_MIGRATION_SAFETY_MARGIN)
+    if creation_start >= creation_end:
+      return
+
+    params = {
+      'bucket_name': bucket_name,
+      'root_pipeline_id': self.root_pipeline_id,
+      BlobstoreCreationRangeInputReader.CREATION_START_PARAM:
+        to_timestamp(creation_start),
+      BlobstoreCreationRangeInputReader.CREATION_END_PARAM:
+        to_timestamp(creation_end),
+    }
+    mapper = yield mapreduce_pipeline.MapperPipeline(
+      'iterate_new_blobs',
+      'app.migrator.migrate_blob_batch',
+      'app.migrator.BlobstoreCreationRangeInputReader',
+      params=params,
+      shards=config.config.NUM_SHARDS)
+
+    yield AdvanceMigrationWatermark(
+      bucket_name,
+      to_timestamp(creation_end),
+      to_timestamp(retry_from) if retry_from else None,
+      mapper.result_status)
+
+
+class AdvanceMigrationWatermark(pipeline.Pipeline):
+  """Moves a bucket's MigrationWatermark after a successful run."""
+
+  def run(self, bucket_name, creation_end, retry_from, result_status):
+    """Advances the watermark if the mapper job succeeded.
+
+    Args:
+      bucket_name: The bucket the run migrated into.
+      creation_end: The upper creation time the run scanned, as a timestamp.
+      retry_from: The watermark's retry_from when the run started, as a
+        timestamp, or None.
+      result_status: The result status of the mapper job.
+    """
+    if result_status != 'success':
+      logging.warning('Not advancing the watermark of bucket %s; the mapper '
+                      'job finished with status %s.', bucket_name,
+                      result_status)
+      return
+    models.MigrationWatermark.advance(
+      bucket_name,
+      from_timestamp(creation_end),
+      from_timestamp(retry_from) if retry_from is not None else None)
+
 
 class MigrateSingleBlobPipeline(pipeline.Pipeline):
-  """Migrate a single blob into Google Cloud Storage."""
+  """Migrate a single blob into Google Cloud Storage.
+
+  Large blobs are split into byte ranges that are copied by parallel shards
+  into temporary part files, which are then composed into the final file.
+  A blob is not copied again if its file already matches (see
+  find_existing_copy()).
+  """
 
 
-  def run(self, blob_key_str, filename, content_type, bucket_name):
+  def run(self, blob_key_str, filename, content_type, bucket_name, size=None,
+          root_pipeline_id=None):
     """Copies a single blob.
 
     Args:
@@ -361,16 +1275,37 @@ class MigrateSingleBlobPipeline(pipeline.Pipeline):
       filename: An optional filename from the blob being copied.
       content_type: The content-type for the blob.
       bucket_name: The bucket to copy the blob info.
+      size: The size of the blob in bytes; if omitted, the blob is copied
+        with a single shard.
+      root_pipeline_id: The root pipeline of the migration that started this
+        pipeline, which counts its completion or failure.
 
     Yields:
       Pipelines to copy the blob and store the mapping results in Datastore.
     """
+    parts = get_composite_part_count(size)
+    gcs_filename = build_gcs_filename(blob_key_str,
+                                      filename=filename,
+                                      bucket_name=bucket_name,
+                                      include_bucket=True,
+                                      include_leading_slash=True)
+    blob_info = blobstore.BlobInfo.get(blobstore.BlobKey(blob_key_str))
+    existing = blob_info and find_existing_copy(blob_info, gcs_filename)
+    if existing:
+      store_mapping_entity(blob_key_str, gcs_filename, existing)
+      record_secondary_completion(root_pipeline_id, size, skipped=True)
+      return
+
+    if parts > 1:
+      naming_format = build_gcs_part_name_format(blob_key_str)
+    else:
+      naming_format = build_gcs_filename(blob_key_str, filename=filename)
     output_writer_params = {
       'bucket_name': bucket_name,
       'content_type': content_type,
-      'naming_format': build_gcs_filename(blob_key_str, filename=filename),
+      'naming_format': naming_format,
     }
-    if filename:
+    if filename and parts == 1:
       output_writer_params['content_disposition'] = (
           build_content_disposition(filename.encode('utf8')))
 
@@ -381,56 +1316,572 @@ class MigrateSingleBlobPipeline(pipeline.Pipeline):
       'output_writer': output_writer_params,
     }
 
-    output = yield mapreduce_pipeline.MapperPipeline(
+    # without a reducer, each shard writes its own file
+    mapper = yield mapreduce_pipeline.MapperPipeline(
       'copy_blob_to_gcs',
       'app.migrator.yield_data',
       'app.migrator.BlobstoreInputReader',
       output_writer_spec=
         'mapreduce.output_writers.GoogleCloudStorageConsistentOutputWriter',
       params=params,
-      shards=1)  # must be 1 because no reducer in MapperPipeline
+      shards=parts)
+
+    output = mapper
+    if parts > 1:
+      output = yield ComposeBlobParts(blob_key_str, filename, content_type,
+                                      bucket_name, mapper)
+
+    yield StoreMappingEntity(blob_key_str, output, root_pipeline_id, size,
+                             mapper.counters, parts)
+
+  def finalized(self):
+    """Cleans up after a failed copy and makes incremental runs retry it.
+
+    The failure is recorded, and the part files that the copy's shards or a
+    failed composition left behind are deleted.
+    """
+    if not self.was_aborted:
+      return
+    blob_key_str, filename, bucket_name = (self.args[0], self.args[1],
+                                           self.args[3])
+    size = self.args[4] if len(self.args) > 4 else None
+    root_pipeline_id = self.args[5] if len(self.args) > 5 else None
+    gcs_filename = build_gcs_filename(blob_key_str,
+                                      filename=filename,
+                                      bucket_name=bucket_name,
+                                      include_bucket=True,
+                                      include_leading_slash=True)
+    models.MigrationFailure.record(blob_key_str, gcs_filename, COPY_ABORTED,
+                                   ['The secondary pipeline was aborted.'])
+    record_secondary_failure(blob_key_str, bucket_name, size, root_pipeline_id)
+    if get_composite_part_count(size) > 1:
+      delete_part_files(blob_key_str, bucket_name)
+
+
+def delete_part_files(blob_key_str, bucket_name):
+  """Deletes the part files of a parallel copy of a blob.
+
+  Args:
+    blob_key_str: The BlobKey's encrypted string.
+    bucket_name: The bucket the blob was copied into.
+  """
+  prefix = '/%s/%s' % (bucket_name,
+                       build_gcs_filename(blob_key_str,
+                                          filename=PART_NAME_PREFIX))
+  gcs.delete_files([stat.filename
+                    for stat in cloudstorage.listbucket(prefix)])
+
+
+def record_secondary_failure(blob_key_str, bucket_name, size,
+                             root_pipeline_id):
+  """Counts a failed secondary pipeline and makes incremental runs retry it.
 
-    yield StoreMappingEntity(blob_key_str, output)
+  Args:
+    blob_key_str: The BlobKey's encrypted string.
+    bucket_name: The bucket the blob was copied into.
+    size: The size of the blob in bytes.
+    root_pipeline_id: The root pipeline of the migration, or None.
+  """
+  record_secondary_pipeline(root_pipeline_id, 'failed', size)
+  blob_info = blobstore.BlobInfo.get(blobstore.BlobKey(blob_key_str))
+  if blob_info:
+    models.MigrationWatermark.rewind(bucket_name, blob_info.creation)
 
 
-def migrate_single_blob_inline(blob_info, bucket_name):
+class ComposeBlobParts(pipeline.Pipeline):
+  """Stitches the part files of a parallel copy into the final GCS file.
+
+  The part files are deleted once composed. If the composition keeps
+  failing, they are deleted when MigrateSingleBlobPipeline is finalized.
+  """
+
+  def run(self, blob_key_str, filename, content_type, bucket_name,
+          part_filenames):
+    """Composes the part files and deletes them.
+
+    Args:
+      blob_key_str: The BlobKey's encrypted string.
+      filename: An optional filename from the blob being copied.
+      content_type: The content-type for the blob.
+      bucket_name: The bucket the blob was copied into.
+      part_filenames: The GCS filenames of the parts, one per shard.
+
+    Returns:
+      A list holding the GCS filename of the composed file, rooted by
+      "/[bucket_name]/...".
+    """
+    if not part_filenames:
+      logging.info('No output, means there was no blob to migrate.')
+      return []
+    gcs_filename = build_gcs_filename(blob_key_str,
+                                      filename=filename,
+                                      bucket_name=bucket_name,
+                                      include_bucket=True,
+                                      include_leading_slash=True)
+    part_filenames = sorted(part_filenames, key=_get_part_number)
+    gcs.compose_files(part_filenames, gcs_filename.encode('utf8'),
+                      content_type=content_type)
+    if filename:
+      # composing does not carry over the content-disposition of the parts
+      cloudstorage.copy2(gcs_filename.encode('utf8'),
+                         gcs_filename.encode('utf8'),
+                         metadata={
+                           'content-type': content_type,
+                           'content-disposition': build_content_disposition(
+                               filename.encode('utf8')),
+                         })
+    gcs.delete_files(part_filenames)
+    return [gcs_filename]
+
+
+def _get_part_number(part_filename):
+  """Returns the shard number at the end of a part filename."""
+  return int(part_filename.rsplit(PART_NAME_PREFIX, 1)[1])
+
+
+def migrate_single_blob_inline(blob_info, bucket_name, buffer_size=None):
   """Migrates a single, small blob.
 
+  A copy that is interrupted (e.g., by a task deadline) resumes from its
+  last checkpoint when the task is retried (see CopyCheckpointer).
+
   Args:
     blob_info: The BlobInfo for the blob to copy.
     bucket_name: The name of the bucket to copy the blob info.
+    buffer_size: The size of the chunks to copy; chosen from the blob size
+      if omitted.
 
   Returns:
-    The resulting filename for the GCS file, rooted by "/[bucket_name]/..."
+    The resulting filename for the GCS file, rooted by "/[bucket_name]/...",
+    or None if the copy did not match its checksums (see verify_copy()).
+  """
+  gcs_filename = _build_inline_gcs_filename(blob_info, bucket_name)
+
+  checkpointer = CopyCheckpointer(blob_info, gcs_filename)
+  existing = find_existing_copy(blob_info, gcs_filename)
+  if existing:
+    _put_mapping_entity(build_mapping_entity(blob_info, gcs_filename,
+                                             existing))
+    _count_existing_copy(blob_info.size)
+    checkpointer.clear()
+    return gcs_filename
+
+  if not buffer_size:
+    buffer_size = copier.get_buffer_size(blob_info.size)
+
+  if not checkpointer.restore():
+    checkpointer.start(cloudstorage.open(gcs_filename.encode('utf8'),
+                                         mode='w',
+                                         content_type=blob_info.content_type,
+                                         options=_build_gcs_options(blob_info)))
+  gcs_file = checkpointer.gcs_file
+  resumed_from = checkpointer.offset
+
+  completed = False
+  try:
+    copier.copy_blob_to_gcs_file(blob_info.key(), blob_info.size, gcs_file,
+                                 buffer_size, checksum=checkpointer.checksum,
+                                 start=resumed_from, progress=checkpointer)
+    completed = True
+  except cloudstorage.Error:
+    # e.g., the upload of a resumed copy expired; the retry starts over
+    checkpointer.discard()
+    raise
+  finally:
+    # an interrupted copy with a checkpoint leaves its upload open to resume
+    if completed or not checkpointer.offset:
+      gcs_file.close()
+  checkpointer.delete()
+
+  copied = checkpointer.checksum.to_dict()
+  gcs_checksums = None
+  if config.config.CHECKSUMS:
+    gcs_checksums = gcs.get_object_checksums(gcs_filename.encode('utf8'))
+    if resumed_from and gcs_checksums.get('md5'):
+      # a resumed copy has no MD5 of its own; Blobstore's is compared with
+      # the MD5 GCS computed over the whole file instead
+      copied['md5'] = gcs_checksums['md5']
+  if verify_copy(blob_info, gcs_filename, copied, gcs_checksums):
+    return None
+
+  _put_mapping_entity(build_mapping_entity(blob_info, gcs_filename, copied))
+  return gcs_filename
+
+
+class CopyCheckpointer(object):
+  """Saves and restores the progress of an inline copy.
+
+  Every COPY_CHECKPOINT_INTERVAL bytes, the open GCS upload is flushed and
+  stored with the position copied up to as a CopyCheckpoint. A retried copy
+  continues the upload from there, counting the bytes it did not have to
+  copy again as Bytes_resumed. A checkpoint that cannot be used (its upload
+  expired, or the blob is now copied to another file) is deleted and its
+  bytes are counted as Bytes_recopied.
+
+  An instance is passed to copier.copy_blob_to_gcs_file() as its progress
+  callable.
+  """
+
+  def __init__(self, blob_info, gcs_filename, interval=None):
+    """Initializes the checkpointer.
+
+    Args:
+      blob_info: The BlobInfo of the blob being copied.
+      gcs_filename: The GCS file the blob is copied to, rooted by
+        "/[bucket_name]/...".
+      interval: The bytes copied between checkpoints; defaults to
+        COPY_CHECKPOINT_INTERVAL. If 0, no checkpoints are saved.
+    """
+    if interval is None:
+      interval = config.config.COPY_CHECKPOINT_INTERVAL
+    self.key = models.CopyCheckpoint.build_key(_get_blob_key_str(blob_info))
+    self.size = blob_info.size
+    self.gcs_filename = gcs_filename
+    self.interval = interval
+    self.offset = 0  # the position of the last checkpoint
+    self.gcs_file = None
+    self.checksum = None
+
+  def _can_checkpoint(self):
+    """Checks if the blob is large enough for a checkpoint to be saved."""
+    return bool(self.interval) and self.size > self.interval
+
+  def restore(self):
+    """Resumes the copy from its last checkpoint.
+
+    Returns:
+      True if gcs_file, checksum and offset were restored from a checkpoint;
+      False if the copy must start from the beginning.
+    """
+    if not self._can_checkpoint():
+      return False
+    checkpoint = self.key.get()
+    if not checkpoint:
+      return False
+    if checkpoint.gcs_filename != self.gcs_filename or not checkpoint.writer:
+      self.offset = checkpoint.offset or 0
+      self.discard()
+      return False
+    self.offset = checkpoint.offset
+    self.gcs_file = checkpoint.writer
+    self.checksum = checksums.StreamingChecksum.resume(checkpoint.offset,
+                                                       checkpoint.crc32c)
+    _count_copy_progress('Bytes_resumed', checkpoint.offset)
+    return True
+
+  def start(self, gcs_file):
+    """Starts the copy from the beginning.
+
+    Args:
+      gcs_file: The GCS file, newly opened for writing.
+    """
+    self.offset = 0
+    self.gcs_file = gcs_file
+    self.checksum = checksums.StreamingChecksum()
+
+  def __call__(self, position):
+    """Saves a checkpoint if enough bytes were copied since the last one.
+
+    Args:
+      position: The position in the blob copied up to.
+    """
+    if (not self._can_checkpoint() or position >= self.size or
+        position - self.offset < self.interval):
+      return
+    # GCS only accepts whole 256KB blocks before the end of an upload, so
+    # less than one block stays buffered in the pickled writer
+    self.gcs_file.flush()
+    models.CopyCheckpoint(key=self.key,
+                          gcs_filename=self.gcs_filename,
+                          offset=position,
+                          writer=self.gcs_file,
+                          crc32c=self.checksum.crc32c).put()
+    self.offset = position
+
+  def delete(self):
+    """Deletes the checkpoint of a completed copy."""
+    if self.offset:
+      self.key.delete()
+      self.offset = 0
+
+  def clear(self):
+    """Deletes any checkpoint left by a copy that completed in the end."""
+    if self._can_checkpoint():
+      self.key.delete()
+
+  def discard(self):
+    """Deletes a checkpoint that cannot be resumed from."""
+    if self.offset:
+      _count_copy_progress('Bytes_recopied', self.offset)
+    self.key.delete()
+    self.offset = 0
+
+
+def _count_copy_progress(counter_name, num_bytes):
+  """Counts resumed or recopied bytes against the mapper job."""
+  ctx = context.get()
+  if ctx:
+    ctx.counters.increment(counter_name, num_bytes)
+
+
+def find_existing_copy(blob_info, gcs_filename):
+  """Checks if a GCS file already holds a complete copy of a blob.
+
+  A copy that was interrupted after its file was written, but before its
+  mapping was stored, does not have to be copied again. A composed file has
+  no MD5 of its own; the MD5 recorded on it once its copy was verified
+  (see record_source_md5()) is compared instead.
+
+  Args:
+    blob_info: The BlobInfo of the blob.
+    gcs_filename: The GCS file the blob is copied to, rooted by
+      "/[bucket_name]/...".
+
+  Returns:
+    The checksums of the file (see checksums.get_checksum_dict()) if its
+    size and MD5 match the BlobInfo, otherwise None.
+  """
+  if not blob_info.md5_hash:
+    return None
+  try:
+    gcs_checksums = gcs.get_object_checksums(gcs_filename.encode('utf8'))
+  except cloudstorage.NotFoundError:
+    return None
+  if gcs_checksums.get('size') != blob_info.size:
+    return None
+  md5_hash = gcs_checksums.get('md5')
+  if md5_hash is None:
+    md5_hash = cloudstorage.stat(
+        gcs_filename.encode('utf8')).metadata.get(SOURCE_MD5_METADATA)
+  if md5_hash != blob_info.md5_hash:
+    return None
+  return gcs_checksums
+
+
+def record_source_md5(blob_key_str, gcs_filename):
+  """Records the MD5 of a blob on the composed GCS file it was copied to.
+
+  The file's metadata is replaced, so its content-type and
+  content-disposition are set again from the BlobInfo.
+
+  Args:
+    blob_key_str: The BlobKey's encrypted string.
+    gcs_filename: The composed GCS file, whose copy has been verified,
+      rooted by "/[bucket_name]/...".
+  """
+  blob_info = blobstore.BlobInfo.get(blobstore.BlobKey(blob_key_str))
+  if not blob_info or not blob_info.md5_hash:
+    return
+  metadata = _build_gcs_options(blob_info)
+  metadata['content-type'] = blob_info.content_type
+  metadata[SOURCE_MD5_METADATA] = blob_info.md5_hash
+  cloudstorage.copy2(gcs_filename.encode('utf8'), gcs_filename.encode('utf8'),
+                     metadata=metadata)
+
+
+def _count_existing_copy(size):
+  """Counts a blob whose copy was already in GCS against the mapper job."""
+  ctx = context.get()
+  if ctx:
+    ctx.counters.increment('BlobInfo_copy_already_present')
+    ctx.counters.increment('Bytes_copy_saved', size)
+
+
+def migrate_small_blobs_concurrently(blob_infos, bucket_name):
+  """Migrates small blobs, keeping a bounded window of copies in flight.
+
+  At most CONCURRENT_MIGRATION_MAX_BLOBS copies, holding at most
+  CONCURRENT_MIGRATION_MAX_BYTES of blob data, run at the same time.
+
+  Args:
+    blob_infos: The BlobInfos of the blobs to copy; each must be small enough
+      to be fetched with a single call (see is_concurrent_candidate()).
+    bucket_name: The name of the bucket to copy the blobs into.
+
+  Yields:
+    A tuple of each BlobInfo and the list of its checksum mismatches (see
+    verify_copy()) once its copy has completed; its mapping was stored
+    unless there were mismatches.
+
+  Raises:
+    The error of the first copy that failed, once the copies in flight with
+    it have completed and their mappings have been written, so that the
+    retried slice does not copy them again. No further copies are started.
+  """
+  max_blobs = max(1, config.config.CONCURRENT_MIGRATION_MAX_BLOBS)
+  max_bytes = config.config.CONCURRENT_MIGRATION_MAX_BYTES
+  in_flight = []  # tuples of (future, blob_info, gcs_filename, checksum)
+  failures = []  # futures of the copies that failed
+
+  def finish_completed():
+    """Verifies and maps completed copies; returns their outcomes."""
+    ndb.Future.wait_any([item[0] for item in in_flight])
+    completed = [item for item in in_flight if item[0].done()]
+    outcomes = []
+    for item in completed:
+      future, blob_info, gcs_filename, checksum = item
+      in_flight.remove(item)
+      if future.get_exception() is not None:
+        failures.append(future)
+        continue
+      mismatches = verify_copy(blob_info, gcs_filename, checksum.to_dict(),
+                               future.get_result())
+      if not mismatches:
+        _put_mapping_entity(build_mapping_entity(blob_info, gcs_filename,
+                                                 checksum.to_dict()))
+      outcomes.append((blob_info, mismatches))
+    return outcomes
+
+  for blob_info in blob_infos:
+    while in_flight and (
+        len(in_flight) >= max_blobs or
+        sum(item[1].size for item in in_flight) + blob_info.size > max_bytes):
+      for outcome in finish_completed():
+        yield outcome
+    if failures:
+      break
+    gcs_filename = _build_inline_gcs_filename(blob_info, bucket_name)
+    checksum = checksums.StreamingChecksum()
+    future = _copy_small_blob_async(blob_info, gcs_filename, checksum)
+    in_flight.append((future, blob_info, gcs_filename, checksum))
+
+  while in_flight:
+    for outcome in finish_completed():
+      yield outcome
+
+  if failures:
+    pool = pools.get_mapping_put_pool()
+    if pool is not None:
+      pool.flush()  # the failed slice would otherwise drop these mappings
+    failures[0].check_success()  # raises the error of the failed copy
+
+
+@ndb.tasklet
+def _copy_small_blob_async(blob_info, gcs_filename, checksum):
+  """Copies a small blob, then reads the checksums GCS reports for it.
+
+  Args:
+    blob_info: The BlobInfo of the blob to copy.
+    gcs_filename: The GCS file to write, rooted by "/[bucket_name]/...".
+    checksum: A checksums.StreamingChecksum updated with the blob data.
+
+  Returns:
+    A future for the GCS checksums of the file, or None if CHECKSUMS is
+    empty.
+  """
+  yield copier.copy_small_blob_async(
+      blob_info.key(), blob_info.size, gcs_filename.encode('utf8'),
+      content_type=blob_info.content_type,
+      options=_build_gcs_options(blob_info),
+      checksum=checksum)
+  gcs_checksums = None
+  if config.config.CHECKSUMS:
+    gcs_checksums = yield gcs.get_object_checksums_async(
+        gcs_filename.encode('utf8'))
+  raise ndb.Return(gcs_checksums)
+
+
+def verify_copy(blob_info_or_key, gcs_filename, copied, gcs_checksums=None):
+  """Checks the checksums of a copy and records a failure if they differ.
+
+  The checksums computed while copying are compared with the size and MD5
+  Blobstore recorded for the blob, and with the size and hashes GCS
+  reports for the file. A mismatch is stored as a MigrationFailure.
+
+  Args:
+    blob_info_or_key: The BlobInfo of the blob, or its BlobKey string if
+      only GCS can be compared.
+    gcs_filename: The GCS file the blob was copied to.
+    copied: A dict of the checksums computed while copying (see
+      checksums.get_checksum_dict()).
+    gcs_checksums: A dict of the checksums GCS reports, if known.
+
+  Returns:
+    A list describing each mismatch; empty if the copy matches.
+  """
+  mismatches = []
+  if isinstance(blob_info_or_key, blobstore.BlobInfo):
+    mismatches.extend(checksums.find_mismatches(
+        copied,
+        checksums.get_checksum_dict(blob_info_or_key.size,
+                                    blob_info_or_key.md5_hash),
+        'blobstore'))
+  if gcs_checksums:
+    mismatches.extend(checksums.find_mismatches(copied, gcs_checksums, 'gcs'))
+  if mismatches:
+    logging.error('Copy of blob_key "%s" to "%s" does not match: %s',
+                  _get_blob_key_str(blob_info_or_key), gcs_filename,
+                  '; '.join(mismatches))
+    models.MigrationFailure.record(_get_blob_key_str(blob_info_or_key),
+                                   gcs_filename, CHECKSUM_MISMATCH,
+                                   mismatches)
+  return mismatches
+
+
+def is_concurrent_candidate(blob_info):
+  """Checks if a blob should be copied with the concurrent small-blob copies.
+
+  Args:
+    blob_info: The BlobInfo of the blob.
+
+  Returns:
+    True if concurrent copies are enabled, the blob is small enough and its
+    size tier is copied within the mapper.
+  """
+  if config.config.CONCURRENT_MIGRATION_MAX_BLOBS <= 1:
+    return False
+  if tiers.get_size_tier(blob_info.size)['queue_name']:
+    return False
+  max_size = min(config.config.CONCURRENT_MIGRATION_MAX_SIZE,
+                 config.config.CONCURRENT_MIGRATION_MAX_BYTES,
+                 blobstore.MAX_BLOB_FETCH_SIZE)
+  return blob_info.size <= max_size
+
+
+def _build_inline_gcs_filename(blob_info, bucket_name):
+  """Builds the GCS filename an inline copy writes to.
+
+  Args:
+    blob_info: The BlobInfo for the blob to copy.
+    bucket_name: The name of the bucket to copy the blob into.
+
+  Returns:
+    The GCS filename, rooted by "/[bucket_name]/...".
+  """
+  return build_gcs_filename(blob_info,
+                            filename=blob_info.filename,
+                            bucket_name=bucket_name,
+                            include_bucket=True,
+                            include_leading_slash=True)
+
+
+def _build_gcs_options(blob_info):
+  """Builds the GCS file headers for a blob.
+
+  Args:
+    blob_info: The BlobInfo for the blob to copy.
+
+  Returns:
+    A dict of headers, with a content-disposition if the blob has a filename.
   """
   options = {}
   if blob_info.filename:
     options['content-disposition'] = (
         build_content_disposition(blob_info.filename.encode('utf8')))
+  return options
 
-  gcs_filename = build_gcs_filename(blob_info,
-                                    filename=blob_info.filename,
-                                    bucket_name=bucket_name,
-                                    include_bucket=True,
-                                    include_leading_slash=True)
-
-  blob_reader = blobstore.BlobReader(blob_info, buffer_size=BLOB_BUFFER_SIZE)
 
-  gcs_file = cloudstorage.open(gcs_filename.encode('utf8'),
-                               mode='w',
-                               content_type=blob_info.content_type,
-                               options=options)
-
-  try:
-    chunk = blob_reader.read(BLOB_BUFFER_SIZE)
-    while chunk:
-      gcs_file.write(chunk)
-      chunk = blob_reader.read(BLOB_BUFFER_SIZE)
-  finally:
-    gcs_file.close()
+def _put_mapping_entity(entity):
+  """Stores a mapping entity, behind the copies when within a mapper.
 
-  store_mapping_entity(blob_info, gcs_filename)
-  return gcs_filename
+  Args:
+    entity: The mapping entity to store.
+  """
+  pool = pools.get_mapping_put_pool()
+  if pool is not None:
+    pool.put(entity)  # written behind the copy of the next blob
+  else:
+    entity.put()
 
 
 def write_test_file(bucket_name, delete=True):
@@ -463,33 +1914,110 @@ def write_test_file(bucket_name, delete=True):
 class StoreMappingEntity(pipeline.Pipeline):
   """Stores the mapping from old blob key to GCS (and new blob key)."""
 
-  def run(self, old_blob_key_str, output):
+  def run(self, old_blob_key_str, output, root_pipeline_id=None, size=None,
+          mapper_counters=None, parts=None):
     """Runs the pipeline to store the mapping entity in Datastore.
 
+    If the counters of the copy are given, the CRC32C of the blob is
+    combined from the CRC32Cs of its parts and checked against the file in
+    GCS before the mapping is stored. A composed file that passes is marked
+    with the MD5 of its blob (see record_source_md5()).
+
     Args:
       old_blob_key_str: The old blob's BlobKey encrypted string.
       output: a list of GCS filenames (will be a single file because there is
         only one shard per blob).
+      root_pipeline_id: The root pipeline of the migration, which counts the
+        completed copy.
+      size: The size of the copied blob.
+      mapper_counters: The counters of the copy's mapper job.
+      parts: The number of byte ranges the blob was copied in.
     """
     if not output:
       logging.info('No output, means there was no blob to migrate.')
       return
     assert len(output) == 1
     gcs_filename = output[0]
-    store_mapping_entity(old_blob_key_str, gcs_filename)
+    if not gcs_filename.startswith('/'):
+      gcs_filename = '/' + gcs_filename
+    copied = None
+    if mapper_counters is not None and size is not None:
+      copied = checksums.get_checksum_dict(
+          size, crc32c_value=combine_part_crc32cs(mapper_counters, size,
+                                                  parts or 1))
+      gcs_checksums = None
+      if config.config.CHECKSUMS:
+        gcs_checksums = gcs.get_object_checksums(gcs_filename.encode('utf8'))
+      if verify_copy(old_blob_key_str, gcs_filename, copied, gcs_checksums):
+        record_secondary_pipeline(root_pipeline_id, 'mismatched', size)
+        record_secondary_failure(old_blob_key_str,
+                                 gcs.split_gcs_filename(gcs_filename)[0],
+                                 size, root_pipeline_id)
+        return
+      if parts > 1 and gcs_checksums:
+        record_source_md5(old_blob_key_str, gcs_filename)
+    store_mapping_entity(old_blob_key_str, gcs_filename, copied)
+    record_secondary_completion(root_pipeline_id, size)
+
+
+def combine_part_crc32cs(mapper_counters, size, parts):
+  """Combines the CRC32Cs the shards of a copy reported for their parts.
+
+  Args:
+    mapper_counters: The counters of the copy's mapper job.
+    size: The size of the blob in bytes.
+    parts: The number of byte ranges the blob was copied in.
 
+  Returns:
+    The CRC32C of the blob, or None if a part did not report its CRC32C
+    (e.g., CRC32C checksums are disabled).
+  """
+  crc32c = 0
+  for start, end in split_byte_range(size, parts):
+    part_crc32c = mapper_counters.get(PART_CRC32C_COUNTER_FORMAT % start)
+    if part_crc32c is None:
+      return None
+    crc32c = checksums.crc32c_combine(crc32c, part_crc32c, end - start)
+  return crc32c
 
-def store_mapping_entity(old_blob_info_or_key, gcs_filename):
+
+def store_mapping_entity(old_blob_info_or_key, gcs_filename, copied=None):
   """Store the mapping in Datastore.
 
   Args:
     old_blob_info_or_key: The old blob's BlobInfo, BlobKey, or BlobKey's
       encrypted string.
     gcs_filename: the GCS filenames where the blob was copied.
+    copied: An optional dict of the size and checksums of the copy (see
+      checksums.get_checksum_dict()).
 
   Returns:
     The datastore mapping entity that was written.
   """
+  entity = build_mapping_entity(old_blob_info_or_key, gcs_filename, copied)
+  entity.put()
+  logging.debug('Migrated blob_key "%s" to "%s" (GCS file "%s").' % (
+                entity.old_blob_key, entity.new_blob_key,
+                entity.gcs_filename))
+  return entity
+
+
+def build_mapping_entity(old_blob_info_or_key, gcs_filename, copied=None):
+  """Builds, but does not store, the mapping entity.
+
+  The mapping belongs to the generation of a migration into the bucket of
+  the GCS file (see get_generation()).
+
+  Args:
+    old_blob_info_or_key: The old blob's BlobInfo, BlobKey, or BlobKey's
+      encrypted string.
+    gcs_filename: the GCS filenames where the blob was copied.
+    copied: An optional dict of the size and checksums of the copy (see
+      checksums.get_checksum_dict()).
+
+  Returns:
+    The unsaved datastore mapping entity.
+  """
   if not old_blob_info_or_key:
     raise ValueError('old_blob_info_or_key is required.')
   if not gcs_filename:
@@ -502,9 +2030,10 @@ def store_mapping_entity(old_blob_info_or_key, gcs_filename):
     'key': models.BlobKeyMapping.build_key(old_blob_key_str),
     'gcs_filename': gcs_filename,
     'new_blob_key': new_blob_key_str,
+    'generation': get_generation(gcs.split_gcs_filename(gcs_filename)[0]),
   }
-  entity = models.BlobKeyMapping(**kwargs)
-  entity.put()
-  logging.info('Migrated blob_key "%s" to "%s" (GCS file "%s").' % (
-               old_blob_key_str, new_blob_key_str, gcs_filename))
-  return entity
+  if copied:
+    kwargs['size'] = copied.get('size')
+    kwargs['md5_hash'] = copied.get('md5')
+    kwargs['crc32c'] = copied.get('crc32c')
+  return models.BlobKeyMapping(**kwargs)
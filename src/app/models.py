@@ -25,10 +25,28 @@ class BlobKeyMapping(ndb.Model):
   Stores a mapping from the old blob key to a new Google Cloud Storage
   filename, as well as a new blob key for the Cloud Storage file that can
   be used in legacy blobstore APIs.
+
+  The size and the checksums computed while the blob was copied are stored
+  too (the MD5 is not known for blobs copied in parallel parts), as well as
+  the time a verification job last found the GCS file to match.
+
+  The generation tags the migration that created the mapping (see
+  MIGRATION_GENERATION); a migration treats the mappings of other
+  generations as not migrated.
+
+  Mappings rebuilt from the names of GCS files record the creation time of
+  their file as file_ctime, so that of several files of one blob the
+  newest ends up mapped.
   """
   old_blob_key = ndb.ComputedProperty(lambda self: self.key.id())
   gcs_filename = ndb.StringProperty(required=True)
   new_blob_key = ndb.StringProperty(required=True)
+  generation = ndb.StringProperty()
+  size = ndb.IntegerProperty(indexed=False)
+  md5_hash = ndb.StringProperty(indexed=False)
+  crc32c = ndb.IntegerProperty(indexed=False)
+  verified = ndb.DateTimeProperty(indexed=False)
+  file_ctime = ndb.FloatProperty(indexed=False)
 
   _use_cache = False
   _use_memcache = False
@@ -44,3 +62,286 @@ class BlobKeyMapping(ndb.Model):
     if not key_str:
       raise ValueError('key_str is required.')
     return ndb.Key(cls, key_str)
+
+  def get_generation(self):
+    """Returns the generation of the mapping.
+
+    Mappings stored before generations were recorded belong to the
+    generation named after the bucket of their GCS file.
+    """
+    if self.generation:
+      return self.generation
+    return self.gcs_filename.lstrip('/').partition('/')[0]
+
+
+class MigrationWatermark(ndb.Model):
+  """
+  Records how far incremental migrations into a bucket have progressed.
+
+  Keyed by bucket name. Blobs created before `creation` have been migrated
+  by an earlier successful run, except that a secondary pipeline that failed
+  moves `retry_from` back to the creation time of its blob, so the next run
+  scans that blob again.
+  """
+  creation = ndb.DateTimeProperty()
+  retry_from = ndb.DateTimeProperty()
+  pipeline_id = ndb.StringProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_MigrationWatermark'
+
+  @classmethod
+  def build_key(cls, bucket_name):
+    """Builds a key."""
+    if not bucket_name:
+      raise ValueError('bucket_name is required.')
+    return ndb.Key(cls, bucket_name)
+
+  def get_scan_start(self):
+    """Returns the creation time the next incremental run starts from."""
+    if not self.creation:
+      return None  # no successful run yet; scan every blob
+    if self.retry_from and self.retry_from < self.creation:
+      return self.retry_from
+    return self.creation
+
+  @classmethod
+  @ndb.transactional
+  def record_pipeline(cls, bucket_name, pipeline_id):
+    """Records the pipeline of the incremental run that was just started."""
+    key = cls.build_key(bucket_name)
+    watermark = key.get() or cls(key=key)
+    watermark.pipeline_id = pipeline_id
+    watermark.put()
+
+  @classmethod
+  @ndb.transactional
+  def advance(cls, bucket_name, creation, retry_from_at_start):
+    """Moves the watermark forward after a successful run.
+
+    Args:
+      bucket_name: The bucket the run migrated into.
+      creation: The (exclusive) upper creation time the run scanned.
+      retry_from_at_start: The watermark's retry_from when the run started;
+        the run scanned from there, so it is cleared unless a failure moved
+        it while the run was in progress.
+    """
+    key = cls.build_key(bucket_name)
+    watermark = key.get() or cls(key=key)
+    watermark.creation = creation
+    if watermark.retry_from == retry_from_at_start:
+      watermark.retry_from = None
+    watermark.put()
+
+  @classmethod
+  @ndb.transactional
+  def rewind(cls, bucket_name, creation):
+    """Makes the next incremental run scan blobs from a creation time again.
+
+    Args:
+      bucket_name: The bucket of the watermark.
+      creation: The creation time of a blob whose migration failed.
+    """
+    watermark = cls.build_key(bucket_name).get()
+    if not watermark:
+      return  # no incremental runs yet; the first run scans everything
+    # even a blob above the watermark must be recorded; a run that is still
+    # in progress would otherwise advance past it
+    if not watermark.retry_from or creation < watermark.retry_from:
+      watermark.retry_from = creation
+      watermark.put()
+
+
+class MigrationPlan(ndb.Model):
+  """
+  Stores the outcome of the most recent planning job.
+
+  Holds the number and bytes of the blobs that would be migrated, split by
+  copy path and by log-scale size bucket, and the estimated duration of the
+  migration with the configuration at planning time.
+  """
+  LATEST_ID = 'latest'
+
+  pipeline_id = ndb.StringProperty()
+  completed = ndb.DateTimeProperty(auto_now=True)
+  blobs = ndb.IntegerProperty(default=0)
+  bytes = ndb.IntegerProperty(default=0)
+  inline_blobs = ndb.IntegerProperty(default=0)
+  inline_bytes = ndb.IntegerProperty(default=0)
+  pipeline_blobs = ndb.IntegerProperty(default=0)
+  pipeline_bytes = ndb.IntegerProperty(default=0)
+  histogram = ndb.JsonProperty(default=[])
+  num_shards = ndb.IntegerProperty()
+  estimated_seconds = ndb.IntegerProperty()
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_MigrationPlan'
+
+  @classmethod
+  def build_key(cls):
+    """Builds the key of the latest plan."""
+    return ndb.Key(cls, cls.LATEST_ID)
+
+
+class CounterShard(ndb.Model):
+  """
+  One shard of a group of counters that are updated from many tasks.
+
+  The counts of a group are spread over a fixed number of shard entities,
+  so concurrent updates rarely contend for the same entity group.
+  """
+  counts = ndb.JsonProperty(default={})
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_CounterShard'
+
+  @classmethod
+  def build_key(cls, group, index):
+    """Builds a key."""
+    if not group:
+      raise ValueError('group is required.')
+    return ndb.Key(cls, '%s-%d' % (group, index))
+
+
+class MigrationFailure(ndb.Model):
+  """
+  Records a blob whose copy did not match its checksums, or whose secondary
+  pipeline was aborted.
+
+  Keyed by the old blob key. No mapping is stored for such a blob, so the
+  next migration copies it again.
+  """
+  gcs_filename = ndb.StringProperty(indexed=False)
+  reason = ndb.StringProperty()
+  details = ndb.JsonProperty(default=[])
+  created = ndb.DateTimeProperty(auto_now=True)
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_MigrationFailure'
+
+  @classmethod
+  def build_key(cls, key_str):
+    """Builds a key."""
+    if not key_str:
+      raise ValueError('key_str is required.')
+    return ndb.Key(cls, key_str)
+
+  @classmethod
+  def record(cls, key_str, gcs_filename, reason, details):
+    """Stores (or replaces) the failure of a blob.
+
+    Args:
+      key_str: The old blob key string.
+      gcs_filename: The GCS file the blob was copied to.
+      reason: A short, stable name of the failure (e.g., 'checksum_mismatch').
+      details: A list of strings describing the failure.
+
+    Returns:
+      The stored entity.
+    """
+    entity = cls(key=cls.build_key(key_str),
+                 gcs_filename=gcs_filename,
+                 reason=reason,
+                 details=list(details))
+    entity.put()
+    return entity
+
+
+class VerificationFailure(ndb.Model):
+  """
+  Records a mapping whose GCS file did not match during a verification.
+
+  Keyed by the old blob key; a later verification that fails again replaces
+  the record.
+  """
+  gcs_filename = ndb.StringProperty(indexed=False)
+  pipeline_id = ndb.StringProperty()
+  details = ndb.JsonProperty(default=[])
+  created = ndb.DateTimeProperty(auto_now=True)
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_VerificationFailure'
+
+  @classmethod
+  def build_key(cls, key_str):
+    """Builds a key."""
+    if not key_str:
+      raise ValueError('key_str is required.')
+    return ndb.Key(cls, key_str)
+
+  @classmethod
+  def record(cls, key_str, gcs_filename, pipeline_id, details):
+    """Stores (or replaces) the failure of a mapping.
+
+    Args:
+      key_str: The old blob key string.
+      gcs_filename: The GCS file of the mapping.
+      pipeline_id: The verification pipeline that found the failure.
+      details: A list of strings describing the failure.
+
+    Returns:
+      The stored entity.
+    """
+    entity = cls(key=cls.build_key(key_str),
+                 gcs_filename=gcs_filename,
+                 pipeline_id=pipeline_id,
+                 details=list(details))
+    entity.put()
+    return entity
+
+
+class CopyCheckpoint(ndb.Model):
+  """
+  Records the progress of an inline copy, so that a retried task resumes it.
+
+  Keyed by old blob key. Holds the position in the blob copied up to, the
+  cloudstorage writer of the open GCS upload (pickled; it holds less than
+  one 256KB block of unsent data) and the CRC32C of the bytes copied, if
+  computed. The checkpoint is deleted once the copy completes.
+  """
+  gcs_filename = ndb.StringProperty(indexed=False)
+  offset = ndb.IntegerProperty(indexed=False)
+  writer = ndb.PickleProperty()
+  crc32c = ndb.IntegerProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  _use_cache = False
+  _use_memcache = False
+
+  @classmethod
+  def _get_kind(cls):
+    """Returns the kind name."""
+    return '_blobmigrator_CopyCheckpoint'
+
+  @classmethod
+  def build_key(cls, key_str):
+    """Builds a key."""
+    if not key_str:
+      raise ValueError('key_str is required.')
+    return ndb.Key(cls, key_str)
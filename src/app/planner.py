@@ -0,0 +1,317 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Estimates the size and duration of a migration before it is started.
+
+The BlobInfo records are scanned with projection queries on their size,
+which only read the built-in index. The scan is sharded by size range
+rather than by key range, since a key range filter would need a composite
+index on a kind this tool does not own. Since blob sizes are heavily
+skewed, the size ranges are chosen from the quantiles of a sample of the
+BlobInfo records, so that each shard scans a similar number of them.
+"""
+import logging
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import blobstore
+from mapreduce import input_readers
+from mapreduce import mapreduce_pipeline
+from mapreduce.operation import counters
+import pipeline
+
+from app import config
+from app import migrator
+from app import models
+from app import stats
+
+# Size ranges of the scan when no BlobInfo records can be sampled; each
+# shard scans one or more of these.
+SIZE_RANGE_BOUNDARIES = [0] + [2 ** power for power in range(10, 33)] + [None]
+
+# The number of sizes each projection query page reads.
+PLAN_PAGE_SIZE = 500
+
+# The estimated fixed cost, in seconds, of a secondary pipeline.
+SECONDARY_PIPELINE_OVERHEAD_SECONDS = 60
+
+
+class BlobSizeInputReader(input_readers.InputReader):
+  """Yields pages of BlobInfo sizes within a size range.
+
+  Only the size is read, with a projection query ordered by size.
+  """
+
+  MIN_SIZE_PARAM = 'min_size'
+  MAX_SIZE_PARAM = 'max_size'
+  CURSOR_PARAM = 'cursor'
+
+  def __init__(self, min_size, max_size, cursor=None):
+    """Initializes this instance with the given size range.
+
+    Args:
+      min_size: The smallest size to read.
+      max_size: The size to stop reading at (exclusive), or None.
+      cursor: The websafe query cursor to resume from.
+    """
+    self.min_size = min_size
+    self.max_size = max_size
+    self.cursor = cursor
+
+  def __iter__(self):
+    """Yields lists of up to PLAN_PAGE_SIZE blob sizes."""
+    while True:
+      filters = {'size >=': self.min_size}
+      if self.max_size is not None:
+        filters['size <'] = self.max_size
+      cursor = None
+      if self.cursor:
+        cursor = datastore_query.Cursor.from_websafe_string(self.cursor)
+      query = datastore.Query(blobstore.BLOB_INFO_KIND, filters,
+                              projection=('size',), cursor=cursor)
+      query.Order('size')
+      sizes = [entity['size'] for entity in query.Run(limit=PLAN_PAGE_SIZE)]
+      if not sizes:
+        return
+      self.cursor = query.GetCursor().to_websafe_string()
+      yield sizes
+      if len(sizes) < PLAN_PAGE_SIZE:
+        return
+
+  @classmethod
+  def from_json(cls, input_shard_state):
+    """Creates an instance of the InputReader for the given input shard state.
+
+    Args:
+      input_shard_state: The InputReader state as a dict-like object.
+
+    Returns:
+      An instance of the InputReader configured using the values of json.
+    """
+    return cls(input_shard_state[cls.MIN_SIZE_PARAM],
+               input_shard_state[cls.MAX_SIZE_PARAM],
+               input_shard_state.get(cls.CURSOR_PARAM))
+
+  def to_json(self):
+    """Returns an input shard state for the remaining inputs.
+
+    Returns:
+      A json-izable version of the remaining InputReader.
+    """
+    return {
+      self.MIN_SIZE_PARAM: self.min_size,
+      self.MAX_SIZE_PARAM: self.max_size,
+      self.CURSOR_PARAM: self.cursor,
+    }
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a list of input readers, each for contiguous size ranges.
+
+    Args:
+      mapper_spec: model.MapperSpec specifies the inputs and additional
+        parameters to define the behavior of input readers.
+
+    Returns:
+      A list of InputReaders.
+    """
+    boundaries = choose_size_boundaries(
+      _sample_blob_sizes(mapper_spec.shard_count *
+                         migrator.SHARD_BALANCE_SAMPLES_PER_SHARD),
+      mapper_spec.shard_count)
+    if not boundaries:
+      num_ranges = len(SIZE_RANGE_BOUNDARIES) - 1
+      boundaries = [SIZE_RANGE_BOUNDARIES[start]
+                    for start, _ in migrator.split_byte_range(
+                      num_ranges, mapper_spec.shard_count)] + [None]
+    return [cls(min_size, max_size)
+            for min_size, max_size in zip(boundaries, boundaries[1:])]
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec.
+
+    Args:
+      mapper_spec: The MapperSpec for this InputReader.
+
+    Raises:
+      BadReaderParamsError: the input reader class does not match.
+    """
+    if mapper_spec.input_reader_class() != cls:
+      raise input_readers.BadReaderParamsError('Input reader class mismatch')
+
+
+def _sample_blob_sizes(count):
+  """Returns the sizes of a random sample of BlobInfo records.
+
+  Args:
+    count: The number of records to sample.
+
+  Returns:
+    A list of up to count blob sizes, empty if none could be sampled.
+  """
+  query = datastore.Query(blobstore.BLOB_INFO_KIND, keys_only=True)
+  query.Order('__scatter__')
+  sample_keys = query.Get(count)
+  if not sample_keys:
+    return []
+  return [entity.get('size') or 0
+          for entity in datastore.Get(sample_keys) if entity is not None]
+
+
+def choose_size_boundaries(sizes, shard_count):
+  """Chooses size range boundaries at the quantiles of a sample of sizes.
+
+  Sizes shared by many blobs can make neighbouring quantiles equal; those
+  ranges are merged, so fewer than shard_count ranges may be returned.
+
+  Args:
+    sizes: A list of sampled blob sizes.
+    shard_count: The number of size ranges wanted.
+
+  Returns:
+    A list of boundaries, starting with 0 and ending with None, or an empty
+    list if there are no sizes.
+  """
+  if not sizes:
+    return []
+  sizes = sorted(sizes)
+  boundaries = [0]
+  for shard in range(1, shard_count):
+    boundary = sizes[shard * len(sizes) // shard_count]
+    if boundary > boundaries[-1]:
+      boundaries.append(boundary)
+  return boundaries + [None]
+
+
+def plan_blob_sizes(sizes):
+  """Counts a page of blob sizes by copy path and size bucket.
+
+  Args:
+    sizes: A list of blob sizes.
+
+  Yields:
+    MapReduce counter operations.
+  """
+  totals = {}
+  def add(names, size):
+    blobs_counter, bytes_counter = names
+    totals[blobs_counter] = totals.get(blobs_counter, 0) + 1
+    totals[bytes_counter] = totals.get(bytes_counter, 0) + size
+
+  for size in sizes:
+    add(('Plan_blobs', 'Plan_bytes'), size)
+    if migrator.uses_secondary_pipeline(size):
+      add(('Plan_pipeline_blobs', 'Plan_pipeline_bytes'), size)
+    else:
+      add(('Plan_inline_blobs', 'Plan_inline_bytes'), size)
+    add(stats.get_size_bucket_counter_names(size, prefix='Plan_'), size)
+
+  for name, delta in sorted(totals.iteritems()):
+    yield counters.Increment(name, delta)
+
+
+def estimate_seconds(inline_blobs, inline_bytes, pipeline_blobs,
+                     pipeline_bytes, num_shards):
+  """Estimates how long a migration takes.
+
+  All shards are assumed to copy at ESTIMATED_SHARD_THROUGHPUT, with a fixed
+  cost per blob (shared by the small blobs copied concurrently) and per
+  secondary pipeline; the secondary pipelines also copy their parts in
+  parallel.
+
+  Args:
+    inline_blobs: The number of blobs copied by the mapper shards.
+    inline_bytes: The bytes copied by the mapper shards.
+    pipeline_blobs: The number of blobs copied by secondary pipelines.
+    pipeline_bytes: The bytes copied by secondary pipelines.
+    num_shards: The number of mapper shards.
+
+  Returns:
+    The estimated number of seconds.
+  """
+  throughput = float(config.config.ESTIMATED_SHARD_THROUGHPUT)
+  concurrency = max(1, config.config.CONCURRENT_MIGRATION_MAX_BLOBS)
+  parts = max(1, config.config.COMPOSITE_UPLOAD_PARTS)
+  shard_seconds = (inline_bytes / throughput +
+                   inline_blobs * config.config.ESTIMATED_SECONDS_PER_BLOB /
+                   concurrency) / max(1, num_shards)
+  pipeline_seconds = (pipeline_bytes / (throughput * parts) +
+                      pipeline_blobs * SECONDARY_PIPELINE_OVERHEAD_SECONDS)
+  return int(shard_seconds + pipeline_seconds)
+
+
+def build_plan(mapper_counters, num_shards):
+  """Builds a MigrationPlan from the counters of a planning job.
+
+  Args:
+    mapper_counters: The counters of the planning job, by name.
+    num_shards: The number of shards the migration will use.
+
+  Returns:
+    An unsaved MigrationPlan.
+  """
+  get = lambda name: mapper_counters.get(name, 0)
+  histogram = stats.get_size_histogram(mapper_counters, prefix='Plan_')
+  return models.MigrationPlan(
+    key=models.MigrationPlan.build_key(),
+    blobs=get('Plan_blobs'),
+    bytes=get('Plan_bytes'),
+    inline_blobs=get('Plan_inline_blobs'),
+    inline_bytes=get('Plan_inline_bytes'),
+    pipeline_blobs=get('Plan_pipeline_blobs'),
+    pipeline_bytes=get('Plan_pipeline_bytes'),
+    histogram=histogram,
+    num_shards=num_shards,
+    estimated_seconds=estimate_seconds(get('Plan_inline_blobs'),
+                                       get('Plan_inline_bytes'),
+                                       get('Plan_pipeline_blobs'),
+                                       get('Plan_pipeline_bytes'),
+                                       num_shards))
+
+
+class PlanMigrationPipeline(pipeline.Pipeline):
+  """Launch a MapReduce job to size up a migration of all blobs."""
+
+  def run(self):
+    """Scans the blob sizes and stores the plan.
+
+    Yields:
+      A MapperPipeline to count the blobs, then the plan storage.
+    """
+    mapper = yield mapreduce_pipeline.MapperPipeline(
+      'plan_migration',
+      'app.planner.plan_blob_sizes',
+      'app.planner.BlobSizeInputReader',
+      params={},
+      shards=len(SIZE_RANGE_BOUNDARIES) - 1)
+    yield StoreMigrationPlan(mapper.counters)
+
+
+class StoreMigrationPlan(pipeline.Pipeline):
+  """Stores the plan from the counters of the planning job."""
+
+  def run(self, mapper_counters):
+    """Stores the plan.
+
+    Args:
+      mapper_counters: The counters of the planning job.
+    """
+    plan = build_plan(mapper_counters, config.config.NUM_SHARDS)
+    plan.pipeline_id = self.root_pipeline_id
+    plan.put()
+    logging.info('Stored migration plan for %d blobs (%d bytes).',
+                 plan.blobs, plan.bytes)
@@ -0,0 +1,222 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shard-local pools that batch Datastore and Blobstore work within a mapper
+slice.
+"""
+import logging
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+from mapreduce import context
+
+from app import config
+
+
+class MappingPutPool(context.Pool):
+  """Write-behind buffer for BlobKeyMapping entities.
+
+  Entities are collected and written with ndb.put_multi_async once
+  MAPPING_PUT_BATCH_SIZE of them are pending, so the write for one batch
+  overlaps with copying the next blobs. At most one batch is in flight at a
+  time.
+
+  The MapReduce framework flushes registered pools at the end of every
+  slice, before the slice is acknowledged. A slice that fails before its
+  flush completes is retried in full, so no mapping can be lost.
+  """
+
+  POOL_NAME = 'blobmigrator_mapping_puts'
+
+  def __init__(self, max_entities=None):
+    """Initializes the pool.
+
+    Args:
+      max_entities: The number of entities that triggers a write; defaults
+        to MAPPING_PUT_BATCH_SIZE.
+    """
+    self.max_entities = max_entities or config.config.MAPPING_PUT_BATCH_SIZE
+    self._entities = []
+    self._futures = []
+
+  def put(self, entity):
+    """Buffers an entity to be written.
+
+    Args:
+      entity: The ndb entity to write.
+    """
+    self._entities.append(entity)
+    if len(self._entities) >= self.max_entities:
+      self._write_async()
+
+  def flush(self):
+    """Writes all buffered entities and waits for every pending write."""
+    self._write_async()
+    self._wait()
+
+  def _write_async(self):
+    """Starts writing the buffered entities after the previous batch."""
+    self._wait()
+    if self._entities:
+      self._futures = ndb.put_multi_async(self._entities)
+      self._entities = []
+
+  def _wait(self):
+    """Waits for the in-flight batch; errors propagate to fail the slice."""
+    futures, self._futures = self._futures, []
+    for future in futures:
+      future.get_result()
+
+
+def get_mapping_put_pool():
+  """Returns the MappingPutPool of the current mapper slice.
+
+  Returns:
+    The pool registered with the current MapReduce context, or None if not
+    running within a mapper.
+  """
+  ctx = context.get()
+  if not ctx:
+    return None
+  pool = ctx.get_pool(MappingPutPool.POOL_NAME)
+  if pool is None:
+    pool = MappingPutPool()
+    ctx.register_pool(MappingPutPool.POOL_NAME, pool)
+  return pool
+
+
+class BlobDeletePool(context.Pool):
+  """Batches Blobstore deletes and keeps a bounded number in flight.
+
+  Blob keys are collected and deleted with one blobstore.delete_async call
+  per BLOB_DELETE_BATCH_SIZE keys, with at most BLOB_DELETE_MAX_IN_FLIGHT
+  calls outstanding. A failed call is split in halves that are retried, so
+  a single bad key cannot keep the rest of its batch from being deleted; a
+  key that still fails after BLOB_DELETE_MAX_ATTEMPTS fails the slice, which
+  is then retried in full.
+
+  The sizes of the deleted blobs are added to the Bytes_freed counter.
+  """
+
+  POOL_NAME = 'blobmigrator_blob_deletes'
+
+  def __init__(self, batch_size=None, max_in_flight=None, max_attempts=None):
+    """Initializes the pool.
+
+    Args:
+      batch_size: The number of keys per delete call; defaults to
+        BLOB_DELETE_BATCH_SIZE.
+      max_in_flight: The most delete calls outstanding at a time; defaults to
+        BLOB_DELETE_MAX_IN_FLIGHT.
+      max_attempts: The number of times a key is tried; defaults to
+        BLOB_DELETE_MAX_ATTEMPTS.
+    """
+    self.batch_size = max(1, batch_size or
+                          config.config.BLOB_DELETE_BATCH_SIZE)
+    self.max_in_flight = max(1, max_in_flight or
+                             config.config.BLOB_DELETE_MAX_IN_FLIGHT)
+    self.max_attempts = max(1, max_attempts or
+                            config.config.BLOB_DELETE_MAX_ATTEMPTS)
+    self.blobs_deleted = 0
+    self.bytes_freed = 0
+    self._blobs = []  # tuples of (blob_key, size or None)
+    self._in_flight = []  # tuples of (rpc, blobs, attempt)
+
+  def delete(self, blob_key, size=None):
+    """Buffers a blob to be deleted.
+
+    Args:
+      blob_key: The BlobKey (or its string) of the blob.
+      size: The size of the blob, if known; otherwise it is looked up.
+    """
+    self._blobs.append((blobstore.BlobKey(str(blob_key)), size))
+    if len(self._blobs) >= self.batch_size:
+      self._send(self._blobs, 1)
+      self._blobs = []
+
+  def flush(self):
+    """Deletes all buffered blobs and waits for every pending delete."""
+    if self._blobs:
+      self._send(self._blobs, 1)
+      self._blobs = []
+    while self._in_flight:
+      self._wait_for_oldest()
+
+  def _send(self, blobs, attempt):
+    """Starts deleting blobs once fewer than max_in_flight calls are out."""
+    while len(self._in_flight) >= self.max_in_flight:
+      self._wait_for_oldest()
+    blobs = _fill_in_sizes(blobs)
+    rpc = blobstore.delete_async([blob_key for blob_key, _ in blobs])
+    self._in_flight.append((rpc, blobs, attempt))
+
+  def _wait_for_oldest(self):
+    """Waits for the oldest delete call, retrying the keys if it failed."""
+    rpc, blobs, attempt = self._in_flight.pop(0)
+    try:
+      rpc.get_result()
+    except (blobstore.Error, apiproxy_errors.Error) as e:
+      if attempt >= self.max_attempts:
+        raise
+      logging.warning('Deleting %d blobs failed (attempt %d): %s',
+                      len(blobs), attempt, e)
+      half = (len(blobs) + 1) // 2
+      for part in [blobs[:half], blobs[half:]]:
+        if part:
+          self._send(part, attempt + 1)
+      return
+    freed = sum(size for _, size in blobs)
+    self.blobs_deleted += len(blobs)
+    self.bytes_freed += freed
+    ctx = context.get()
+    if ctx:
+      ctx.counters.increment('Bytes_freed', freed)
+
+
+def _fill_in_sizes(blobs):
+  """Looks up the sizes the blobs lack with one BlobInfo RPC.
+
+  Args:
+    blobs: A list of tuples of BlobKey and size (or None).
+
+  Returns:
+    The list with every size filled in; 0 for blobs that no longer exist.
+  """
+  unknown = [blob_key for blob_key, size in blobs if size is None]
+  if not unknown:
+    return blobs
+  sizes = {}
+  for blob_key, blob_info in zip(unknown, blobstore.BlobInfo.get(unknown)):
+    sizes[blob_key] = blob_info.size if blob_info else 0
+  return [(blob_key, sizes[blob_key] if size is None else size)
+          for blob_key, size in blobs]
+
+
+def get_blob_delete_pool():
+  """Returns the BlobDeletePool of the current mapper slice.
+
+  Returns:
+    The pool registered with the current MapReduce context, or None if not
+    running within a mapper.
+  """
+  ctx = context.get()
+  if not ctx:
+    return None
+  pool = ctx.get_pool(BlobDeletePool.POOL_NAME)
+  if pool is None:
+    pool = BlobDeletePool()
+    ctx.register_pool(BlobDeletePool.POOL_NAME, pool)
+  return pool
@@ -15,9 +15,162 @@
 """
 Status details for the UI.
 """
+import datetime
+import hashlib
+import json
+import time
+
+from google.appengine.api import memcache
 from mapreduce import model as mr_model
 import pipeline
 
+from app import migrator
+from app import sharded_counters
+from app import stats
+from app import tiers
+from app import verifier
+
+# Rolling throughput is measured over (about) this many seconds.
+THROUGHPUT_WINDOW_SECONDS = 60
+
+_THROUGHPUT_SAMPLES_KEY = 'blobmigrator-throughput-samples-%s'
+
+# The ETA is based on the throughput over (about) this many seconds, so it
+# is not thrown off by large blobs completing in bursts.
+ETA_WINDOW_SECONDS = 5 * 60
+
+# Until samples cover this many seconds, the average throughput is used.
+ETA_MIN_WINDOW_SECONDS = 30
+
+# The weight of the newest estimate in the moving average of the ETA.
+ETA_SMOOTHING = 0.3
+
+_ETA_SAMPLES_KEY = 'blobmigrator-eta-samples-%s'
+_ETA_KEY = 'blobmigrator-eta-%s'
+
+# The status of a running job is recomputed at most this often.
+STATUS_CACHE_SECONDS = 5
+
+# The status of a finished job no longer changes; it is kept this long.
+FINISHED_STATUS_CACHE_SECONDS = 60 * 60
+
+# The last computed status is served while another request recomputes it.
+STALE_STATUS_CACHE_SECONDS = 10 * 60
+
+# A request recomputing the status holds the lock for at most this long.
+STATUS_LOCK_SECONDS = 30
+
+# How long, and how often, a request without a stale status waits for
+# another request to finish recomputing it.
+STATUS_WAIT_SECONDS = 2.0
+STATUS_WAIT_INTERVAL_SECONDS = 0.1
+
+# The job result reported for a pipeline that finished without starting a
+# mapper job, e.g. an incremental run that found no new blobs. A pipeline
+# aborted before starting its mapper job is reported as failed instead.
+NO_MAPREDUCE_RESULT_STATUS = 'nothing to migrate'
+
+# Only these parts of a status make up its version; the rates and the ETA
+# are derived from the clock and change on every recompute.
+VERSIONED_STATUS_KEYS = [
+  'pipeline_id',
+  'pipeline_status',
+  'mapreduce_id',
+  'mapreduce_active',
+  'mapreduce_result_status',
+  'mapreduce_counters',
+  'secondary_pipelines',
+]
+
+_STATUS_KEY = 'blobmigrator-status-%s'
+_STALE_STATUS_KEY = 'blobmigrator-status-stale-%s'
+_STATUS_LOCK_KEY = 'blobmigrator-status-lock-%s'
+
+# The copy paths that have their own counters.
+COPY_PATHS = ['within_mapper', 'concurrently', 'via_secondary_pipeline']
+
+# The per-shard counter compared by the shard balance, unless the job names
+# another one in its 'shard_balance_counter' mapper parameter.
+DEFAULT_SHARD_BALANCE_COUNTER = 'Bytes_considered_for_migration'
+
+
+def get_cached_status(pipeline_id):
+  """Returns the status of a pipeline, recomputing it at most every few secs.
+
+  Concurrent requests are coalesced: only the request that acquires a
+  memcache lock recomputes the status, while the others serve the last
+  computed status (or briefly wait for the new one).
+
+  Args:
+    pipeline_id: The root pipeline id.
+
+  Returns:
+    The status dict from get_status().
+  """
+  status_key = _STATUS_KEY % pipeline_id
+  stale_key = _STALE_STATUS_KEY % pipeline_id
+  lock_key = _STATUS_LOCK_KEY % pipeline_id
+
+  status = memcache.get(status_key)
+  if status is not None:
+    return status
+
+  locked = memcache.add(lock_key, 1, time=STATUS_LOCK_SECONDS)
+  if not locked:
+    status = memcache.get(stale_key) or _wait_for_status(status_key)
+    if status is not None:
+      return status
+
+  try:
+    status = get_status(pipeline_id)
+    memcache.set(status_key, status, time=get_cache_seconds(status))
+    memcache.set(stale_key, status, time=max(STALE_STATUS_CACHE_SECONDS,
+                                             get_cache_seconds(status)))
+  finally:
+    if locked:
+      memcache.delete(lock_key)
+  return status
+
+
+def get_status_version(status):
+  """Returns a version string that changes whenever the status changes.
+
+  Only the counters and the pipeline state are compared (see
+  VERSIONED_STATUS_KEYS), so the version stays the same while nothing but
+  time passes.
+  """
+  versioned = dict((key, status.get(key)) for key in VERSIONED_STATUS_KEYS)
+  return hashlib.md5(json.dumps(versioned, sort_keys=True)).hexdigest()
+
+
+def _wait_for_status(status_key):
+  """Waits for another request to store the status; None if it does not."""
+  deadline = time.time() + STATUS_WAIT_SECONDS
+  while time.time() < deadline:
+    time.sleep(STATUS_WAIT_INTERVAL_SECONDS)
+    status = memcache.get(status_key)
+    if status is not None:
+      return status
+  return None
+
+
+def get_cache_seconds(status):
+  """Returns how long a status may be cached.
+
+  Args:
+    status: A status dict from get_status().
+
+  Returns:
+    FINISHED_STATUS_CACHE_SECONDS if the pipeline, its job and its secondary
+    pipelines have finished, otherwise STATUS_CACHE_SECONDS.
+  """
+  secondary_pipelines = status.get('secondary_pipelines') or {}
+  if (status.get('pipeline_status') in ('done', 'aborted') and
+      not status.get('mapreduce_active') and
+      not secondary_pipelines.get('in_flight_blobs')):
+    return FINISHED_STATUS_CACHE_SECONDS
+  return STATUS_CACHE_SECONDS
+
 
 def get_status(pipeline_id):
   """Hack into the pipelines models to gather pipeline and mapreduce details."""
@@ -28,6 +181,9 @@ def get_status(pipeline_id):
   status_tree = pipeline.get_status_tree(pipeline_id)
   if not status_tree:
     return status_dict
+  secondary_totals = sharded_counters.get_totals(pipeline_id)
+  status_dict['secondary_pipelines'] = get_secondary_pipelines(
+      pipeline_id, secondary_totals)
   for info in status_tree.get('pipelines', {}).itervalues():
     if info.get('classPath') == 'mapreduce.mapper_pipeline.MapperPipeline':
       status_dict['pipeline_status'] = info['status']
@@ -42,10 +198,380 @@ def get_status(pipeline_id):
       counters = mr_job.counters_map.to_json().get('counters', {})
       counters = {key.replace('-', '_'): value
                   for key, value in counters.iteritems()}
+      counters = add_secondary_counters(counters, secondary_totals)
+      params = mr_job.mapreduce_spec.mapper.params
+      if 'sample_rate' in params:
+        status_dict['verification'] = verifier.get_verification_summary(
+            counters, params['sample_rate'])
       status_dict.update({
         'mapreduce_counters': counters,
         'mapreduce_active': mr_job.active,
         'mapreduce_result_status': mr_job.result_status,
+        'shard_balance': get_shard_balance(
+            mr_job, params.get('shard_balance_counter',
+                               DEFAULT_SHARD_BALANCE_COUNTER)),
+        'tiers': get_tier_breakdown(counters, _get_elapsed_seconds(mr_job)),
+        'sizes': stats.get_size_histogram(counters),
+        'paths': get_path_breakdown(counters),
+        'throughput': get_throughput(mapreduce_id, counters,
+                                     _get_elapsed_seconds(mr_job),
+                                     mr_job.active),
+        'completion': get_completion(
+            mapreduce_id, mr_job, counters,
+            status_dict.get('secondary_pipelines') or {},
+            _get_elapsed_seconds(mr_job)),
       })
       return status_dict
+  # a pipeline that found nothing to copy finishes without a mapper job
+  root_status = status_tree.get('pipelines', {}).get(pipeline_id, {}).get(
+      'status')
+  if root_status in ('done', 'aborted'):
+    status_dict.update({
+      'pipeline_status': root_status,
+      'mapreduce_active': False,
+      'mapreduce_result_status': (
+          NO_MAPREDUCE_RESULT_STATUS if root_status == 'done'
+          else mr_model.MapreduceState.RESULT_FAILED),
+      'mapreduce_counters': {},
+    })
   return status_dict
+
+
+def get_shard_balance(mr_job, counter_name=DEFAULT_SHARD_BALANCE_COUNTER):
+  """Summarizes how evenly the work is spread among the shards of a job.
+
+  Args:
+    mr_job: The MapreduceState of the job.
+    counter_name: The per-shard counter to compare.
+
+  Returns:
+    A dict with the number of active shards, the skew (the largest shard's
+    counter divided by the mean), which is 1.0 when balanced, and the
+    counter per second of each shard, by shard number.
+  """
+  shard_states = sorted(
+      mr_model.ShardState.find_all_by_mapreduce_state(mr_job),
+      key=lambda shard_state: shard_state.shard_number)
+  now = datetime.datetime.utcnow()
+  values = []
+  rates = []
+  active = 0
+  for shard_state in shard_states:
+    value = shard_state.counters_map.get(counter_name)
+    values.append(value)
+    end_time = now
+    if not shard_state.active and shard_state.update_time:
+      end_time = shard_state.update_time
+    rates.append(_rate(value, (end_time - mr_job.start_time).total_seconds()))
+    if shard_state.active:
+      active += 1
+  return {
+    'shards_total': len(values),
+    'shards_active': active,
+    'skew': compute_skew(values),
+    'counter_name': counter_name,
+    'per_second': rates,
+  }
+
+
+def compute_skew(values):
+  """Returns the largest value divided by the mean, or None if all are 0."""
+  if not values:
+    return None
+  mean = float(sum(values)) / len(values)
+  if not mean:
+    return None
+  return round(max(values) / mean, 2)
+
+
+def _get_elapsed_seconds(mr_job):
+  """Returns the seconds a job has run (until its last poll, once done)."""
+  end_time = datetime.datetime.utcnow()
+  if not mr_job.active and mr_job.last_poll_time:
+    end_time = mr_job.last_poll_time
+  return max((end_time - mr_job.start_time).total_seconds(), 0)
+
+
+def get_tier_breakdown(counters, elapsed_seconds):
+  """Breaks the migrated blobs, bytes and throughput down by size tier.
+
+  Args:
+    counters: The job's counters, by name.
+    elapsed_seconds: The time the job has been running.
+
+  Returns:
+    A list of dicts with the name, queue, blobs, bytes and bytes per second
+    of each size tier.
+  """
+  breakdown = []
+  for tier in tiers.get_size_tiers():
+    blobs_counter, bytes_counter = tiers.get_counter_names(tier)
+    num_bytes = counters.get(bytes_counter, 0)
+    breakdown.append({
+      'name': tier['name'],
+      'queue_name': tiers.get_queue_name(tier),
+      'blobs': counters.get(blobs_counter, 0),
+      'bytes': num_bytes,
+      'bytes_per_second': (int(num_bytes / elapsed_seconds)
+                           if elapsed_seconds else 0),
+    })
+  return breakdown
+
+
+def get_path_breakdown(counters):
+  """Returns the migrated blobs and bytes of each copy path.
+
+  Args:
+    counters: The job's counters, by name.
+
+  Returns:
+    A list of dicts with the path, blobs and bytes.
+  """
+  return [{
+    'path': path,
+    'blobs': counters.get('BlobInfo_migrated_%s' % path, 0),
+    'bytes': counters.get('Bytes_migrated_%s' % path, 0),
+  } for path in COPY_PATHS]
+
+
+def get_throughput(mapreduce_id, counters, elapsed_seconds, active):
+  """Computes the average and rolling throughput of a job.
+
+  Every status request records a sample of the migrated bytes and blobs in
+  memcache; the rolling throughput is measured between the oldest sample
+  within THROUGHPUT_WINDOW_SECONDS and now.
+
+  Args:
+    mapreduce_id: The id of the job.
+    counters: The job's counters, by name.
+    elapsed_seconds: The time the job has been running.
+    active: Whether the job is still running.
+
+  Returns:
+    A dict with the bytes and blobs per second, both on average and over
+    the rolling window.
+  """
+  num_bytes = counters.get('Bytes_migrated', 0)
+  blobs = counters.get('BlobInfo_migrated', 0)
+  result = {
+    'average_bytes_per_second': _rate(num_bytes, elapsed_seconds),
+    'average_blobs_per_second': _rate(blobs, elapsed_seconds),
+    'bytes_per_second': 0,
+    'blobs_per_second': 0,
+    'window_seconds': 0,
+  }
+  if not active:
+    return result
+
+  now = time.time()
+  samples = _record_sample(_THROUGHPUT_SAMPLES_KEY % mapreduce_id,
+                           (now, num_bytes, blobs), THROUGHPUT_WINDOW_SECONDS)
+
+  oldest_time, oldest_bytes, oldest_blobs = samples[0]
+  window = now - oldest_time
+  if window > 0:
+    result.update({
+      'bytes_per_second': _rate(num_bytes - oldest_bytes, window),
+      'blobs_per_second': _rate(blobs - oldest_blobs, window),
+      'window_seconds': int(window),
+    })
+  else:
+    result.update({
+      'bytes_per_second': result['average_bytes_per_second'],
+      'blobs_per_second': result['average_blobs_per_second'],
+    })
+  return result
+
+
+def _record_sample(key, sample, window_seconds):
+  """Adds a sample to a list of samples in memcache that covers a window.
+
+  Args:
+    key: The memcache key of the samples.
+    sample: A (timestamp, ...) tuple.
+    window_seconds: The length of the window.
+
+  Returns:
+    The samples within the window, oldest first.
+  """
+  samples = memcache.get(key) or []
+  samples.append(sample)
+  samples = trim_samples(samples, sample[0], window_seconds)
+  memcache.set(key, samples, time=window_seconds * 2)
+  return samples
+
+
+def trim_samples(samples, now, window_seconds):
+  """Drops the samples older than needed to cover the window.
+
+  The newest sample at or before the start of the window is kept, so the
+  window stays fully covered.
+
+  Args:
+    samples: A list of (timestamp, ...) tuples, oldest first.
+    now: The current timestamp.
+    window_seconds: The length of the window.
+
+  Returns:
+    The remaining samples, oldest first.
+  """
+  window_start = now - window_seconds
+  first = 0
+  for index, sample in enumerate(samples):
+    if sample[0] <= window_start:
+      first = index
+  return samples[first:]
+
+
+def _rate(amount, seconds):
+  """Returns amount per second, rounded to two decimals."""
+  if seconds <= 0:
+    return 0
+  return round(amount / float(seconds), 2)
+
+
+def add_secondary_counters(counters, totals):
+  """Adds the blobs completed by secondary pipelines to a job's counters.
+
+  A blob handed to a secondary pipeline counts as migrated only once the
+  pipeline completes, in the migration's sharded counters (see
+  migrator.record_secondary_completion()).
+
+  Args:
+    counters: The job's counters, by name.
+    totals: The totals of the migration's sharded counters.
+
+  Returns:
+    A new dict of the counters, by name.
+  """
+  counters = dict(counters)
+  prefix = migrator.SECONDARY_COUNTER_PREFIX
+  for name, value in totals.iteritems():
+    if name.startswith(prefix):
+      name = name[len(prefix):]
+      counters[name] = counters.get(name, 0) + value
+  return counters
+
+
+def get_secondary_pipelines(root_pipeline_id, totals=None):
+  """Summarizes the secondary pipelines started by a migration.
+
+  The totals are kept in sharded counters updated as the pipelines start,
+  complete or fail, so no pipeline records have to be read.
+
+  Args:
+    root_pipeline_id: The root pipeline of the migration.
+    totals: The totals of the migration's sharded counters, if already read.
+
+  Returns:
+    A dict with the started, completed, failed and in-flight blobs and bytes;
+    the failed ones include those that did not match their checksums, which
+    are also counted as mismatched, and the completed ones include those
+    whose copy was already in GCS, which are also counted as skipped.
+  """
+  if totals is None:
+    totals = sharded_counters.get_totals(root_pipeline_id)
+  summary = {}
+  for unit in ['blobs', 'bytes']:
+    for event in ['started', 'completed', 'failed', 'mismatched',
+                  'skipped']:
+      summary['%s_%s' % (event, unit)] = totals.get('%s_%s' % (event, unit), 0)
+    summary['in_flight_%s' % unit] = max(0, summary['started_%s' % unit] -
+                                         summary['completed_%s' % unit] -
+                                         summary['failed_%s' % unit])
+  return summary
+
+
+def get_completion(mapreduce_id, mr_job, counters, secondary_pipelines,
+                   elapsed_seconds):
+  """Computes how much of a migration is complete and when it will finish.
+
+  The expected totals are captured in the mapper parameters when the
+  migration starts. A blob counts as done once the mapper has considered
+  it, unless a secondary pipeline is still copying it. The ETA divides the
+  remaining bytes (or blobs, without an expected byte total) by the
+  throughput over ETA_WINDOW_SECONDS and is then smoothed with a moving
+  average.
+
+  Args:
+    mapreduce_id: The id of the job.
+    mr_job: The MapreduceState of the job.
+    counters: The job's counters, by name.
+    secondary_pipelines: The summary from get_secondary_pipelines().
+    elapsed_seconds: The time the job has been running.
+
+  Returns:
+    A dict with the expected and done blobs and bytes, the percentages
+    complete and the ETA in seconds (None if unknown).
+  """
+  params = mr_job.mapreduce_spec.mapper.params
+  expected_blobs = params.get('expected_blobs')
+  expected_bytes = params.get('expected_bytes')
+  done_blobs = max(0, counters.get('BlobInfo_considered_for_migration', 0) -
+                   secondary_pipelines.get('in_flight_blobs', 0))
+  done_bytes = max(0, counters.get('Bytes_considered_for_migration', 0) -
+                   secondary_pipelines.get('in_flight_bytes', 0))
+  result = {
+    'expected_blobs': expected_blobs,
+    'expected_bytes': expected_bytes,
+    'done_blobs': done_blobs,
+    'done_bytes': done_bytes,
+    'percent_blobs': _percent(done_blobs, expected_blobs),
+    'percent_bytes': _percent(done_bytes, expected_bytes),
+    'eta_seconds': None,
+  }
+  if expected_bytes:
+    done, remaining = done_bytes, max(0, expected_bytes - done_bytes)
+  elif expected_blobs:
+    done, remaining = done_blobs, max(0, expected_blobs - done_blobs)
+  else:
+    return result
+  if not mr_job.active and not secondary_pipelines.get('in_flight_blobs'):
+    result['eta_seconds'] = 0
+    return result
+
+  now = time.time()
+  samples = _record_sample(_ETA_SAMPLES_KEY % mapreduce_id, (now, done),
+                           ETA_WINDOW_SECONDS)
+  oldest_time, oldest_done = samples[0]
+  if now - oldest_time >= ETA_MIN_WINDOW_SECONDS:
+    rate = (done - oldest_done) / (now - oldest_time)
+  else:
+    rate = done / float(elapsed_seconds) if elapsed_seconds else 0
+  raw_eta = remaining / rate if rate > 0 else None
+
+  eta_key = _ETA_KEY % mapreduce_id
+  smoothed = smooth_eta(memcache.get(eta_key), raw_eta, now)
+  if smoothed:
+    memcache.set(eta_key, smoothed, time=ETA_WINDOW_SECONDS * 2)
+    result['eta_seconds'] = int(smoothed[1])
+  return result
+
+
+def smooth_eta(previous, raw_eta, now):
+  """Blends a new ETA with the previous one, aged by the time since.
+
+  Args:
+    previous: The previous (timestamp, eta_seconds), or None.
+    raw_eta: The ETA from the current throughput, or None if unknown.
+    now: The current timestamp.
+
+  Returns:
+    The new (timestamp, eta_seconds), or None if there is no estimate.
+  """
+  predicted = None
+  if previous:
+    previous_time, previous_eta = previous
+    predicted = max(0, previous_eta - (now - previous_time))
+  if raw_eta is None:
+    return (now, predicted) if predicted is not None else None
+  if predicted is None:
+    return (now, raw_eta)
+  return (now, ETA_SMOOTHING * raw_eta + (1 - ETA_SMOOTHING) * predicted)
+
+
+def _percent(done, expected):
+  """Returns done as a percentage of expected (at most 100), or None."""
+  if not expected:
+    return None
+  return min(100.0, round(100.0 * done / expected, 1))
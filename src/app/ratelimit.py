@@ -0,0 +1,67 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+A rate limit shared by all the shards of a job, kept in memcache.
+"""
+import time
+
+from google.appengine.api import memcache
+
+# Budget keys expire after this many seconds.
+_BUDGET_KEY_SECONDS = 10
+
+_BUDGET_KEY = 'blobmigrator-ratelimit-%s-%d'
+
+
+def acquire(name, ops, max_ops_per_second):
+  """Blocks until ops fit in the per-second budget of a named limit.
+
+  Every second has its own budget in memcache, which all callers draw from.
+  A caller that would exceed the budget takes its ops back and waits for the
+  next second; a request for more ops than the budget is split into chunks
+  of at most the budget, one second after the other. If memcache is
+  unavailable, the limit is not enforced.
+
+  Args:
+    name: The name of the limit (e.g., the root pipeline id).
+    ops: The number of operations about to be made.
+    max_ops_per_second: The budget per second; 0 or None for no limit.
+
+  Returns:
+    The number of seconds spent waiting.
+  """
+  if not max_ops_per_second or ops <= 0:
+    return 0
+  started = time.time()
+  while ops > 0:
+    chunk = min(ops, max_ops_per_second)
+    _acquire_chunk(name, chunk, max_ops_per_second)
+    ops -= chunk
+  return time.time() - started
+
+
+def _acquire_chunk(name, ops, max_ops_per_second):
+  """Blocks until ops (at most max_ops_per_second) fit in a second."""
+  while True:
+    now = time.time()
+    second = int(now)
+    key = _BUDGET_KEY % (name, second)
+    memcache.add(key, 0, time=_BUDGET_KEY_SECONDS)
+    used = memcache.incr(key, ops, initial_value=0)
+    if used is None or used <= max_ops_per_second:
+      return
+    memcache.decr(key, ops)
+    time.sleep(second + 1 - now)
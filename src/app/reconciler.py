@@ -0,0 +1,435 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Pipelines that reconcile the GCS files of a migration with the mappings.
+"""
+import logging
+import time
+
+import cloudstorage
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from mapreduce import context
+from mapreduce import input_readers
+from mapreduce import mapreduce_pipeline
+from mapreduce.operation import counters
+import pipeline
+
+from app import checksums
+from app import config
+from app import gcs
+from app import migrator
+from app import models
+
+# The number of directory levels below the root folder that are listed to
+# split the bucket; build_gcs_filename() names the first levels after the
+# leading characters of the blob key.
+PREFIX_LEVELS = 2
+
+
+def list_gcs_prefixes(bucket_name, levels=PREFIX_LEVELS):
+  """Lists the directories of the migrated files in a bucket.
+
+  Args:
+    bucket_name: The bucket to list.
+    levels: The number of directory levels below the root folder to descend.
+
+  Returns:
+    A sorted list of object name prefixes, each ending with "/".
+  """
+  prefixes = [migrator.get_gcs_root_prefix()]
+  for _ in range(levels):
+    children = []
+    for prefix in prefixes:
+      path = '/%s/%s' % (bucket_name, prefix) if prefix else '/' + bucket_name
+      for stat in cloudstorage.listbucket(path, delimiter='/'):
+        if stat.is_dir:
+          children.append(gcs.split_gcs_filename(stat.filename)[1])
+    prefixes = children
+  return sorted(prefixes)
+
+
+class GcsPrefixInputReader(input_readers.InputReader):
+  """Yields pages of the GCS files of a migration.
+
+  The directories named after the leading characters of the blob keys are
+  dealt to the shards in turn, so the shards list disjoint parts of the
+  bucket in parallel. Each page holds up to GCS_LISTING_PAGE_SIZE
+  cloudstorage.GCSFileStat objects.
+  """
+
+  BUCKET_NAME_PARAM = 'bucket_name'
+  PREFIXES_PARAM = 'prefixes'
+  MARKER_PARAM = 'marker'
+
+  def __init__(self, bucket_name, prefixes, marker=None):
+    """Initializes this instance with the given parameters.
+
+    Args:
+      bucket_name: The bucket to list.
+      prefixes: The object name prefixes still to list.
+      marker: The last file listed under the first prefix, if any.
+    """
+    self.bucket_name = bucket_name
+    self.prefixes = list(prefixes)
+    self.marker = marker
+
+  def __iter__(self):
+    """Lists the prefixes in pages, resuming after the marker."""
+    page_size = max(1, config.config.GCS_LISTING_PAGE_SIZE)
+    while self.prefixes:
+      stats = list(cloudstorage.listbucket(
+          '/%s/%s' % (self.bucket_name, self.prefixes[0]),
+          marker=self.marker, max_keys=page_size))
+      if stats:
+        self.marker = stats[-1].filename
+        yield stats
+      if len(stats) < page_size:
+        self.prefixes.pop(0)
+        self.marker = None
+
+  @classmethod
+  def from_json(cls, input_shard_state):
+    """Creates an instance of the InputReader for the given input shard state.
+
+    Args:
+      input_shard_state: The InputReader state as a dict-like object.
+
+    Returns:
+      An instance of the InputReader configured using the values of json.
+    """
+    return cls(input_shard_state[cls.BUCKET_NAME_PARAM],
+               input_shard_state[cls.PREFIXES_PARAM],
+               input_shard_state.get(cls.MARKER_PARAM))
+
+  def to_json(self):
+    """Returns an input shard state for the remaining inputs.
+
+    Returns:
+      A json-izable version of the remaining InputReader.
+    """
+    return {
+      self.BUCKET_NAME_PARAM: self.bucket_name,
+      self.PREFIXES_PARAM: self.prefixes,
+      self.MARKER_PARAM: self.marker,
+    }
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a list of input readers, each with its share of the prefixes.
+
+    Args:
+      mapper_spec: model.MapperSpec specifies the inputs and additional
+        parameters to define the behavior of input readers.
+
+    Returns:
+      A list of InputReaders. None when no input data can be found.
+    """
+    params = input_readers._get_params(mapper_spec)
+    bucket_name = params[cls.BUCKET_NAME_PARAM]
+    prefixes = list_gcs_prefixes(bucket_name)
+    if not prefixes:
+      return None
+    shard_count = min(max(1, mapper_spec.shard_count), len(prefixes))
+    return [cls(bucket_name, prefixes[index::shard_count])
+            for index in range(shard_count)]
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec and all mapper parameters.
+
+    Args:
+      mapper_spec: The MapperSpec for this InputReader.
+
+    Raises:
+      BadReaderParamsError: required parameters are missing or invalid.
+    """
+    if mapper_spec.input_reader_class() != cls:
+      raise input_readers.BadReaderParamsError('Input reader class mismatch')
+    params = input_readers._get_params(mapper_spec)
+    if not params.get(cls.BUCKET_NAME_PARAM):
+      raise input_readers.BadReaderParamsError(
+          "Must specify '%s' for mapper input" % cls.BUCKET_NAME_PARAM)
+
+
+def _to_str(value):
+  """Encodes unicode as UTF-8, so filenames compare equal."""
+  if isinstance(value, unicode):
+    return value.encode('utf8')
+  return value
+
+
+def find_orphans(stats, bucket_name):
+  """Finds the GCS files of a page that no mapping points to.
+
+  A file is an orphan if its mapping points to another file in the same
+  bucket (e.g., a part file or a copy that was retried under another name),
+  or if no mapping exists for its blob key and the file is either a part or
+  compose intermediate or a copy of a blob that is still in Blobstore. A
+  final copy without a mapping whose blob is gone may be the only copy of
+  the data left, so it is kept for RebuildMappingsPipeline to map again.
+  Files younger than ORPHAN_GRACE_PERIOD are skipped, since their copy may
+  still be running, and files whose mapping points to another bucket are
+  kept. The mappings and the BlobInfos of the page are each read with one
+  RPC.
+
+  Args:
+    stats: A list of cloudstorage.GCSFileStat objects.
+    bucket_name: The bucket the files are in.
+
+  Returns:
+    A tuple of the list of orphaned GCSFileStats and a list of MapReduce
+    counter operations.
+  """
+  operations = [counters.Increment('Objects_listed', len(stats))]
+  cutoff = time.time() - config.config.ORPHAN_GRACE_PERIOD
+  candidates = []
+  for stat in stats:
+    blob_key_str = migrator.parse_gcs_filename(_to_str(stat.filename))
+    if not blob_key_str:
+      operations.append(counters.Increment('Objects_not_named_by_migration'))
+    elif stat.st_ctime > cutoff:
+      operations.append(counters.Increment('Objects_within_grace_period'))
+    else:
+      candidates.append((stat, blob_key_str))
+  mappings = ndb.get_multi([models.BlobKeyMapping.build_key(blob_key_str)
+                            for _, blob_key_str in candidates])
+  orphans = []
+  unmapped = []
+  for (stat, blob_key_str), mapping in zip(candidates, mappings):
+    if mapping and _to_str(mapping.gcs_filename) == _to_str(stat.filename):
+      operations.append(counters.Increment('Objects_mapped'))
+    elif (mapping and
+          gcs.split_gcs_filename(mapping.gcs_filename)[0] != bucket_name):
+      operations.append(counters.Increment('Objects_mapped_to_other_bucket'))
+    elif mapping or is_intermediate_file(_to_str(stat.filename)):
+      orphans.append(stat)
+    else:
+      unmapped.append((stat, blob_key_str))
+
+  blob_infos = blobstore.BlobInfo.get(
+      [blobstore.BlobKey(blob_key_str) for _, blob_key_str in unmapped])
+  for (stat, _), blob_info in zip(unmapped, blob_infos):
+    if blob_info:
+      orphans.append(stat)
+    else:
+      operations.append(
+          counters.Increment('Objects_unmapped_source_missing'))
+      logging.warning('GCS file "%s" is not mapped and its blob is gone; '
+                      'it is kept.', stat.filename)
+  return orphans, operations
+
+
+def reconcile_gcs_files(stats, _mapper_params=None):
+  """Reports, and optionally deletes, the orphans of a page of GCS files.
+
+  Every orphan is logged; with the delete parameter, the orphans of the page
+  are deleted concurrently.
+
+  Args:
+    stats: A list of cloudstorage.GCSFileStat objects.
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  orphans, operations = find_orphans(stats, params['bucket_name'])
+  for operation in operations:
+    yield operation
+  if not orphans:
+    raise StopIteration()
+  yield counters.Increment('Orphaned_objects', len(orphans))
+  yield counters.Increment('Orphaned_bytes',
+                           sum(stat.st_size for stat in orphans))
+  for stat in orphans:
+    logging.info('GCS file "%s" (%d bytes) is not mapped.', stat.filename,
+                 stat.st_size)
+  if not params.get('delete'):
+    raise StopIteration()
+  futures = [gcs.delete_file_async(_to_str(stat.filename))
+             for stat in orphans]
+  deleted = sum(1 for future in futures if future.get_result())
+  yield counters.Increment('Orphaned_objects_deleted', deleted)
+
+
+class ReconcileGcsFilesPipeline(pipeline.Pipeline):
+  """Launch a MapReduce job to find the GCS files no mapping points to."""
+
+  def run(self, bucket_name, delete=False):
+    """Lists the migrated files of a bucket and reports the orphans.
+
+    Args:
+      bucket_name: The bucket to reconcile.
+      delete: If True, the orphans are deleted too.
+
+    Yields:
+      A MapperPipeline for the MapReduce job to reconcile the files.
+    """
+    if not bucket_name:
+      raise ValueError('bucket_name is required.')
+    params = {
+      GcsPrefixInputReader.BUCKET_NAME_PARAM: bucket_name,
+      'delete': delete,
+      'root_pipeline_id': self.root_pipeline_id,
+    }
+    yield mapreduce_pipeline.MapperPipeline(
+      'reconcile_gcs_files',
+      'app.reconciler.reconcile_gcs_files',
+      'app.reconciler.GcsPrefixInputReader',
+      params=params,
+      shards=config.config.NUM_SHARDS)
+
+
+def is_intermediate_file(gcs_filename):
+  """Checks if a GCS file is a part or compose intermediate of a copy.
+
+  Args:
+    gcs_filename: A GCS filename rooted by "/[bucket_name]/...".
+
+  Returns:
+    True if the file is not the final copy of a blob.
+  """
+  return ('/' + migrator.PART_NAME_PREFIX in gcs_filename or
+          gcs.COMPOSE_SUFFIX in gcs_filename)
+
+
+def rebuild_mappings(stats, _mapper_params=None):
+  """Stores the missing mappings of a page of GCS files.
+
+  The blob key is parsed from the name of every final copy (see
+  migrator.parse_gcs_filename()). A file is not mapped if its blob has a
+  MigrationFailure, or if its blob is still in Blobstore and the size or
+  the MD5 (from the ETag) of the file differ from the BlobInfo. Mappings
+  stored by a migration are left alone; of several files of one blob key
+  the newest is mapped, across pages too, since every mapping is stored
+  with a transaction that compares file creation times (see
+  _put_newest_mapping_async()). The mappings, failures and BlobInfos of
+  the page are read with one RPC each and the mappings are stored
+  concurrently.
+
+  Args:
+    stats: A list of cloudstorage.GCSFileStat objects.
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  yield counters.Increment('Objects_listed', len(stats))
+  newest = {}
+  for stat in stats:
+    gcs_filename = _to_str(stat.filename)
+    blob_key_str = migrator.parse_gcs_filename(gcs_filename)
+    if not blob_key_str or is_intermediate_file(gcs_filename):
+      yield counters.Increment('Objects_not_named_by_migration')
+    elif (blob_key_str not in newest or
+          stat.st_ctime >= newest[blob_key_str].st_ctime):
+      newest[blob_key_str] = stat
+  if not newest:
+    raise StopIteration()
+
+  blob_key_strs = sorted(newest)
+  mapping_futures = ndb.get_multi_async(
+      [models.BlobKeyMapping.build_key(blob_key_str)
+       for blob_key_str in blob_key_strs])
+  failure_futures = ndb.get_multi_async(
+      [models.MigrationFailure.build_key(blob_key_str)
+       for blob_key_str in blob_key_strs])
+  blob_infos = blobstore.BlobInfo.get(
+      [blobstore.BlobKey(blob_key_str) for blob_key_str in blob_key_strs])
+
+  entities = []
+  for blob_key_str, mapping_future, failure_future, blob_info in zip(
+      blob_key_strs, mapping_futures, failure_futures, blob_infos):
+    stat = newest[blob_key_str]
+    mapping = mapping_future.get_result()
+    if mapping and (mapping.file_ctime is None or
+                    mapping.file_ctime >= stat.st_ctime):
+      yield counters.Increment('Mappings_already_present')
+      continue
+    if failure_future.get_result():
+      yield counters.Increment('Objects_with_migration_failure')
+      continue
+    md5_hash = gcs.get_etag_md5(stat.etag)
+    if blob_info and (stat.st_size != blob_info.size or
+                      (md5_hash and blob_info.md5_hash and
+                       md5_hash != blob_info.md5_hash)):
+      logging.warning('GCS file "%s" does not match blob_key "%s"; it is '
+                      'not mapped.', stat.filename, blob_key_str)
+      yield counters.Increment('Objects_not_matching_source')
+      continue
+    entity = migrator.build_mapping_entity(
+        blob_key_str, _to_str(stat.filename),
+        checksums.get_checksum_dict(stat.st_size, md5_hash))
+    entity.file_ctime = stat.st_ctime
+    entities.append(entity)
+
+  futures = [_put_newest_mapping_async(entity) for entity in entities]
+  rebuilt = 0
+  for entity, future in zip(entities, futures):
+    if future.get_result():
+      rebuilt += 1
+      yield counters.Increment('Bytes_mapped', entity.size)
+    else:
+      yield counters.Increment('Mappings_already_present')
+  yield counters.Increment('Mappings_rebuilt', rebuilt)
+
+
+@ndb.transactional_tasklet
+def _put_newest_mapping_async(entity):
+  """Stores a rebuilt mapping unless a better one exists.
+
+  Args:
+    entity: A BlobKeyMapping with its file_ctime set.
+
+  Returns:
+    A future for True if the mapping was stored; False if a mapping from a
+    migration, or one rebuilt from a file at least as new, exists.
+  """
+  existing = yield entity.key.get_async()
+  if existing and (existing.file_ctime is None or
+                   existing.file_ctime >= entity.file_ctime):
+    raise ndb.Return(False)
+  yield entity.put_async()
+  raise ndb.Return(True)
+
+
+class RebuildMappingsPipeline(pipeline.Pipeline):
+  """Launch a MapReduce job to rebuild the mappings from GCS file names."""
+
+  def run(self, bucket_name):
+    """Stores a mapping for every migrated file in a bucket that lacks one.
+
+    Only metadata is written; no blob is copied again.
+
+    Args:
+      bucket_name: The bucket the blobs were migrated into.
+
+    Yields:
+      A MapperPipeline for the MapReduce job to rebuild the mappings.
+    """
+    if not bucket_name:
+      raise ValueError('bucket_name is required.')
+    params = {
+      GcsPrefixInputReader.BUCKET_NAME_PARAM: bucket_name,
+      'root_pipeline_id': self.root_pipeline_id,
+    }
+    yield mapreduce_pipeline.MapperPipeline(
+      'rebuild_mappings',
+      'app.reconciler.rebuild_mappings',
+      'app.reconciler.GcsPrefixInputReader',
+      params=params,
+      shards=config.config.NUM_SHARDS)
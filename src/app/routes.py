@@ -34,6 +34,16 @@ ROUTES = [
   # webapp2.Route('/create-test-blobs', 'app.testviews.CreateTestBlob'),
   # webapp2.Route('/view-blobs', 'app.testviews.ViewBlobs'),
 
+  ###
+  # Verifies the blobstore -> GCS mapping entities before blobs are deleted.
+  ###
+  webapp2.Route('/verify-mappings', 'app.views.VerifyMappingsView'),
+
+  ###
+  # Finds (and optionally deletes) GCS files that no mapping points to.
+  ###
+  webapp2.Route('/reconcile-gcs-files', 'app.views.ReconcileGcsFilesView'),
+
   ###
   # The following views can be enabled to delete blobstore -> GCS mapping
   # entities as well as all blobstore blobs.
@@ -49,6 +59,11 @@ ROUTES = [
   ###
   webapp2.Route('/status-info', 'app.views.StatusInfoHandler'),
 
+  ###
+  # Incremental migration of blobs created since the last run; see README.
+  ###
+  webapp2.Route('/cron/migrate-new-blobs', 'app.views.MigrateNewBlobsHandler'),
+
   ###
   # Use this page to actually migrate blobs (you will get to submit a form).
   ###
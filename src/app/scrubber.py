@@ -17,32 +17,232 @@ Pipeline classes to delete Datastore entities and Blobstore entities.
 """
 
 from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from mapreduce import context
+from mapreduce import input_readers
 from mapreduce import mapreduce_pipeline
 from mapreduce.operation import counters
-from mapreduce.operation import db
 import pipeline
 
 from app import config
-from app import models
+from app import migrator
+from app import pools
+from app import ratelimit
+from app import verifier
 
 
-def delete_mapping_entity(mapping_entity_key):
-  """Deletes the mapping entity.
+class ScrubInputReader(verifier.BlobKeyMappingBatchInputReader):
+  """Yields pages of the mappings within the scope of a scrubbing pass.
+
+  Each page is a list of tuples of a BlobKeyMapping and the BlobInfo of its
+  source blob (None if the blob was deleted); the BlobInfos of a page are
+  read with one RPC. Mappings outside the scope (see in_scope()) are left
+  out, so a page may be empty.
+
+  The maximum count of the scope is split between the shards up front and
+  the remainder of each shard is part of its state, so the count holds
+  across slice retries; a shard that runs out of mappings does not hand its
+  share to the others. Every mapping read counts against the ops/sec
+  ceiling of the scope, which all shards share (see ratelimit.acquire()).
+  """
+
+  SCOPE_PARAM = 'scope'
+  REMAINING_PARAM = 'remaining'
+
+  _scope = {}
+  _remaining = None
+
+  def __iter__(self):
+    """Filters the pages of the underlying reader."""
+    max_ops_per_second = self._scope.get('max_ops_per_second')
+    for mappings in super(ScrubInputReader, self).__iter__():
+      if self._remaining is not None and self._remaining <= 0:
+        return
+      waited = ratelimit.acquire(self._scope.get('pipeline_id'),
+                                 len(mappings), max_ops_per_second)
+      if waited:
+        ctx = context.get()
+        if ctx:
+          ctx.counters.increment('Throttled_milliseconds',
+                                 int(waited * 1000))
+      blob_infos = blobstore.BlobInfo.get(
+          [blobstore.BlobKey(mapping.old_blob_key) for mapping in mappings])
+      page = [(mapping, blob_info)
+              for mapping, blob_info in zip(mappings, blob_infos)
+              if in_scope(mapping, blob_info, self._scope)]
+      if self._remaining is not None:
+        page = page[:self._remaining]
+        self._remaining -= len(page)
+      yield page
+
+  @classmethod
+  def from_json(cls, input_shard_state):
+    """Creates an instance of the InputReader for the given input shard state.
+
+    Args:
+      input_shard_state: The InputReader state as a dict-like object.
+
+    Returns:
+      An instance of the InputReader configured using the values of json.
+    """
+    reader = super(ScrubInputReader, cls).from_json(input_shard_state)
+    reader._scope = input_shard_state.get(cls.SCOPE_PARAM) or {}
+    reader._remaining = input_shard_state.get(cls.REMAINING_PARAM)
+    return reader
+
+  def to_json(self):
+    """Returns an input shard state for the remaining inputs.
+
+    Returns:
+      A json-izable version of the remaining InputReader.
+    """
+    state = super(ScrubInputReader, self).to_json()
+    state[self.SCOPE_PARAM] = self._scope
+    state[self.REMAINING_PARAM] = self._remaining
+    return state
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a list of input readers, each with its share of the scope.
+
+    Args:
+      mapper_spec: model.MapperSpec specifies the inputs and additional
+        parameters to define the behavior of input readers.
+
+    Returns:
+      A list of InputReaders; None or [] when no input data can be found.
+    """
+    readers = super(ScrubInputReader, cls).split_input(mapper_spec)
+    if not readers:
+      return readers
+    params = input_readers._get_params(mapper_spec)
+    scope = dict(params.get(cls.SCOPE_PARAM) or {},
+                 pipeline_id=params.get('root_pipeline_id'))
+    max_count = scope.get('max_count')
+    for index, reader in enumerate(readers):
+      reader._scope = scope
+      if max_count is not None:
+        share, extra = divmod(max_count, len(readers))
+        reader._remaining = share + (1 if index < extra else 0)
+    return readers
+
+
+def build_scope(key_start=None, key_end=None, created_start=None,
+                created_end=None, max_count=None, dry_run=False,
+                max_ops_per_second=None):
+  """Builds the scope of a scrubbing pass.
+
+  Args:
+    key_start: The first old blob key in scope (inclusive).
+    key_end: The old blob key the scope ends at (exclusive).
+    created_start: A naive UTC datetime; only blobs created at or after it
+      are in scope.
+    created_end: A naive UTC datetime; only blobs created before it are in
+      scope.
+    max_count: The most mappings the pass handles.
+    dry_run: If True, what is in scope is only counted and sized.
+    max_ops_per_second: The most mappings read per second, across all shards;
+      defaults to SCRUB_MAX_OPS_PER_SECOND.
+
+  Returns:
+    A JSON-serializable dict for the scrubbing pipelines.
+  """
+  if max_ops_per_second is None:
+    max_ops_per_second = config.config.SCRUB_MAX_OPS_PER_SECOND
+  return {
+    'key_start': key_start,
+    'key_end': key_end,
+    'created_start': (migrator.to_timestamp(created_start)
+                      if created_start else None),
+    'created_end': (migrator.to_timestamp(created_end)
+                    if created_end else None),
+    'max_count': max_count,
+    'dry_run': bool(dry_run),
+    'max_ops_per_second': max_ops_per_second,
+  }
+
+
+def in_scope(mapping, blob_info, scope):
+  """Checks if a mapping is within the scope of a scrubbing pass.
+
+  When the scope has a creation window, mappings whose source blob was
+  deleted are out of scope.
 
   Args:
-    mapping_entity_key: The key of the mapping entity to delete.
+    mapping: The BlobKeyMapping entity.
+    blob_info: The BlobInfo of its source blob, or None if it was deleted.
+    scope: The scope of the pass (see build_scope()).
+
+  Returns:
+    True if the pass should handle the mapping.
+  """
+  key_start = scope.get('key_start')
+  if key_start and mapping.old_blob_key < key_start:
+    return False
+  key_end = scope.get('key_end')
+  if key_end and mapping.old_blob_key >= key_end:
+    return False
+  created_start = scope.get('created_start')
+  created_end = scope.get('created_end')
+  if created_start is None and created_end is None:
+    return True
+  if not blob_info:
+    return False
+  if (created_start is not None and
+      blob_info.creation < migrator.from_timestamp(created_start)):
+    return False
+  if (created_end is not None and
+      blob_info.creation >= migrator.from_timestamp(created_end)):
+    return False
+  return True
+
+
+def get_scrub_params(scope, root_pipeline_id):
+  """Returns the mapper parameters of a scrubbing pass.
+
+  Args:
+    scope: The scope of the pass (see build_scope()); None for everything.
+    root_pipeline_id: The id of the pipeline running the pass.
+
+  Returns:
+    A dict of mapper parameters for ScrubInputReader.
+  """
+  return {
+    'entity_kind': 'app.models.BlobKeyMapping',
+    'root_pipeline_id': root_pipeline_id,
+    ScrubInputReader.SCOPE_PARAM: scope or build_scope(),
+  }
+
+
+def _get_total_size(pairs):
+  """Sums the sizes of the source blobs of (mapping, BlobInfo) tuples."""
+  return sum(blob_info.size for _, blob_info in pairs if blob_info)
+
+
+def delete_mapping_entities(pairs, _mapper_params=None):
+  """Deletes a page of mapping entities within the scope of the pass.
+
+  Args:
+    pairs: A list of tuples of BlobKeyMapping and BlobInfo (or None).
+    _mapper_params: Allows injection of mapper parameters for testing.
 
   Yields:
-    A MapReduce datastore delete operation.
+    Various MapReduce counter operations.
   """
-  yield db.Delete(mapping_entity_key)
-  yield counters.Increment('Mapping_entities_deleted')
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  scope = params.get(ScrubInputReader.SCOPE_PARAM) or {}
+  yield counters.Increment('Mappings_in_scope', len(pairs))
+  yield counters.Increment('Bytes_in_scope', _get_total_size(pairs))
+  if scope.get('dry_run') or not pairs:
+    raise StopIteration()
+  ndb.delete_multi([mapping.key for mapping, _ in pairs])
+  yield counters.Increment('Mapping_entities_deleted', len(pairs))
 
 
 class DeleteBlobstoreToGcsFilenameMappings(pipeline.Pipeline):
   """Launch a MapReduce job to delete the blobstore->GCS mapping entities."""
 
-  def run(self):
+  def run(self, scope=None):
     """Deletes the mapping entiies created in Datastore.
 
     Be extremely careful with this pipeline. This pipeline is provided
@@ -53,55 +253,125 @@ class DeleteBlobstoreToGcsFilenameMappings(pipeline.Pipeline):
     no way to map from old blob keys to new GCS files and it may be
     extremely difficult to use the new GCS files.
 
+    Args:
+      scope: Limits the mappings deleted (see build_scope()); None deletes
+        them all.
+
     Yields:
       A MapperPipeline for the MapReduce job to delete the mapping entities.
     """
-    params = {
-      'entity_kind': models.BlobKeyMapping._get_kind(),
-    }
     yield mapreduce_pipeline.MapperPipeline(
       'delete_mapping_entities',
-      'app.scrubber.delete_mapping_entity',
-      'mapreduce.input_readers.DatastoreKeyInputReader',
-      params=params,
+      'app.scrubber.delete_mapping_entities',
+      'app.scrubber.ScrubInputReader',
+      params=get_scrub_params(scope, self.root_pipeline_id),
       shards=config.config.NUM_SHARDS)
 
 
-def delete_blobstore_blob(mapping_entity_key):
-  """Deletes the blobstore blob for the mapping_entity_key.
+def select_verified(pairs, pipeline_id, record=True):
+  """Selects the mappings whose GCS copy is verified.
+
+  Mappings that a verification job has not marked as verified are checked
+  against Blobstore and GCS first (see verifier.check_mappings()).
 
   Args:
-    mapping_entity_key: The key of the mapping entity pointing to the blob
-      to delete.
+    pairs: A list of tuples of BlobKeyMapping and BlobInfo (or None).
+    pipeline_id: The pipeline checking the mappings.
+    record: If False, the outcome of the checks is not stored.
+
+  Returns:
+    A tuple of the list of verified tuples and a list of MapReduce counter
+    operations.
   """
-  blob_key = blobstore.BlobKey(mapping_entity_key.name())
-  blobstore.delete(blob_key)
-  yield counters.Increment('Blobs_deleted')
+  selected = [(mapping, blob_info) for mapping, blob_info in pairs
+              if mapping.verified]
+  operations = [counters.Increment('Blobs_previously_verified',
+                                   len(selected))]
+  unverified = [(mapping, blob_info) for mapping, blob_info in pairs
+                if not mapping.verified]
+  checked = verifier.check_mappings(
+      [mapping for mapping, _ in unverified],
+      blob_infos=[blob_info for _, blob_info in unverified])
+  for mapping, blob_info, _, mismatches in checked:
+    operations.append(counters.Increment('Mappings_verified'))
+    if record:
+      verifier.record_verification(mapping, mismatches, pipeline_id)
+    if mismatches:
+      operations.append(counters.Increment('Blobs_not_deleted_unverified'))
+    else:
+      selected.append((mapping, blob_info))
+  return selected, operations
+
+
+def delete_blobstore_blobs(pairs, _mapper_params=None):
+  """Deletes the blobstore blobs of a page of mappings.
+
+  With the verified_only parameter, only the blobs of verified mappings are
+  deleted (see select_verified()); a dry run checks the mappings without
+  recording the outcome. The blobs of the page are deleted through the
+  slice's BlobDeletePool.
+
+  Args:
+    pairs: A list of tuples of BlobKeyMapping and BlobInfo (or None).
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  scope = params.get(ScrubInputReader.SCOPE_PARAM) or {}
+  dry_run = scope.get('dry_run')
+  pairs = [(mapping, blob_info) for mapping, blob_info in pairs if blob_info]
+  if params.get('verified_only'):
+    pairs, operations = select_verified(pairs,
+                                        params.get('root_pipeline_id'),
+                                        record=not dry_run)
+    for operation in operations:
+      yield operation
+  yield counters.Increment('Blobs_in_scope', len(pairs))
+  yield counters.Increment('Bytes_in_scope', _get_total_size(pairs))
+  if dry_run or not pairs:
+    raise StopIteration()
+
+  pool = pools.get_blob_delete_pool()
+  own_pool = pool is None
+  if own_pool:
+    pool = pools.BlobDeletePool()
+  for mapping, blob_info in pairs:
+    pool.delete(mapping.old_blob_key, blob_info.size)
+  if own_pool:
+    pool.flush()
+  yield counters.Increment('Blobs_deleted', len(pairs))
 
 
 class DeleteBlobstoreBlobs(pipeline.Pipeline):
   """Launch a MapReduce job to delete the blobstore blobs."""
 
-  def run(self):
+  def run(self, verified_only=False, scope=None):
     """Deletes the blobstore blobs.
 
     Be extremely careful with this pipeline. This pipeline is used
     to delete the blobstore blobs that have been migrated.
 
     You must ensure that the blobs have been correctly migrated before
-    invoking this pipeline.
+    invoking this pipeline, or set verified_only.
 
     THERE IS NO TURNING BACK!
 
+    Args:
+      verified_only: If True, only the blobs whose GCS copy was verified
+        (by a verification job, or by this job before deleting) are deleted.
+      scope: Limits the blobs deleted (see build_scope()); None deletes the
+        blobs of all mappings.
+
     Yields:
       A MapperPipeline for the MapReduce job to delete the source blobs.
     """
-    params = {
-      'entity_kind': models.BlobKeyMapping._get_kind(),
-    }
+    params = get_scrub_params(scope, self.root_pipeline_id)
+    params['verified_only'] = verified_only
     yield mapreduce_pipeline.MapperPipeline(
-      'delete_mapping_entities',
-      'app.scrubber.delete_blobstore_blob',
-      'mapreduce.input_readers.DatastoreKeyInputReader',
+      'delete_blobstore_blobs',
+      'app.scrubber.delete_blobstore_blobs',
+      'app.scrubber.ScrubInputReader',
       params=params,
       shards=config.config.NUM_SHARDS)
@@ -0,0 +1,67 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Counters that many tasks can update concurrently.
+"""
+import random
+
+from google.appengine.ext import ndb
+
+from app import models
+
+# The number of shard entities per group of counters.
+NUM_SHARDS = 20
+
+
+@ndb.transactional
+def _increment_shard(key, deltas):
+  """Adds deltas to the counts of one shard."""
+  shard = key.get() or models.CounterShard(key=key)
+  counts = dict(shard.counts or {})
+  for name, delta in deltas.iteritems():
+    counts[name] = counts.get(name, 0) + delta
+  shard.counts = counts
+  shard.put()
+
+
+def increment(group, deltas):
+  """Increments counters of a group.
+
+  Args:
+    group: The name of the group of counters (e.g., a root pipeline id).
+    deltas: A dict of counter names to the amounts to add.
+  """
+  index = random.randint(0, NUM_SHARDS - 1)
+  _increment_shard(models.CounterShard.build_key(group, index), deltas)
+
+
+def get_totals(group):
+  """Returns the totals of a group of counters.
+
+  Args:
+    group: The name of the group of counters.
+
+  Returns:
+    A dict of counter names to their totals.
+  """
+  keys = [models.CounterShard.build_key(group, index)
+          for index in range(NUM_SHARDS)]
+  totals = {}
+  for shard in ndb.get_multi(keys):
+    if shard:
+      for name, count in (shard.counts or {}).iteritems():
+        totals[name] = totals.get(name, 0) + count
+  return totals
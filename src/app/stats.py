@@ -0,0 +1,94 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Helpers to summarize blob sizes.
+"""
+
+_BYTE_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']
+
+# Sizes of this bucket and above share the last bucket (2GiB and larger).
+MAX_SIZE_BUCKET = 32
+
+SIZE_BUCKET_COUNTER_FORMAT = 'Size_%02d_%s'
+
+
+def size_bucket(size):
+  """Returns the log-scale histogram bucket of a size.
+
+  Bucket 0 holds empty blobs and bucket N holds sizes in [2**(N-1), 2**N).
+
+  Args:
+    size: A size in bytes.
+
+  Returns:
+    The bucket number.
+  """
+  return int(size).bit_length()
+
+
+def get_size_bucket_counter_names(size, prefix=''):
+  """Returns the names of the blob and byte counters of a size's bucket."""
+  bucket = min(size_bucket(size), MAX_SIZE_BUCKET)
+  return (prefix + SIZE_BUCKET_COUNTER_FORMAT % (bucket, 'blobs'),
+          prefix + SIZE_BUCKET_COUNTER_FORMAT % (bucket, 'bytes'))
+
+
+def get_size_histogram(counters, prefix=''):
+  """Builds a size histogram from size bucket counters.
+
+  Args:
+    counters: Counter values by name, as counted with the names from
+      get_size_bucket_counter_names().
+    prefix: The prefix the counter names were given.
+
+  Returns:
+    A list of dicts with the bucket, label, blobs and bytes of each
+    non-empty bucket, smallest first.
+  """
+  histogram = []
+  for bucket in range(MAX_SIZE_BUCKET + 1):
+    name = prefix + SIZE_BUCKET_COUNTER_FORMAT % (bucket, '%s')
+    blobs = counters.get(name % 'blobs', 0)
+    if blobs:
+      histogram.append({
+        'bucket': bucket,
+        'label': size_bucket_label(bucket),
+        'blobs': blobs,
+        'bytes': counters.get(name % 'bytes', 0),
+      })
+  return histogram
+
+
+def size_bucket_label(bucket):
+  """Returns a human readable label for a size_bucket()."""
+  if bucket == 0:
+    return '0 B'
+  if bucket >= MAX_SIZE_BUCKET:
+    return '%s and larger' % format_bytes(2 ** (MAX_SIZE_BUCKET - 1))
+  return '%s - %s' % (format_bytes(2 ** (bucket - 1)),
+                      format_bytes(2 ** bucket - 1))
+
+
+def format_bytes(num_bytes):
+  """Formats a number of bytes with a binary unit (e.g., "1.5 MiB")."""
+  value = float(num_bytes)
+  for unit in _BYTE_UNITS:
+    if value < 1024 or unit == _BYTE_UNITS[-1]:
+      break
+    value /= 1024
+  if unit == 'B':
+    return '%d B' % num_bytes
+  return '%.1f %s' % (value, unit)
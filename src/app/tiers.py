@@ -0,0 +1,73 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Size tiers that route blobs to task queues by size.
+"""
+from app import config
+
+# The tier used when SIZE_TIERS is empty.
+DEFAULT_TIER_NAME = 'all'
+
+
+def get_size_tiers():
+  """Returns the configured size tiers with their defaults filled in.
+
+  Returns:
+    A list of dicts with name, max_size, queue_name and target, ordered by
+    max_size; the last tier has no max_size. A queue_name of None means the
+    tier's blobs are copied within the main mapper shards.
+  """
+  tiers = []
+  for tier in config.config.SIZE_TIERS or []:
+    tiers.append({
+      'name': tier['name'],
+      'max_size': tier.get('max_size'),
+      'queue_name': tier.get('queue_name'),
+      'target': tier.get('target'),
+    })
+  tiers.sort(key=lambda tier: (tier['max_size'] is None, tier['max_size']))
+  if not tiers or tiers[-1]['max_size'] is not None:
+    tiers.append({
+      'name': DEFAULT_TIER_NAME,
+      'max_size': None,
+      'queue_name': None,
+      'target': None,
+    })
+  return tiers
+
+
+def get_size_tier(size):
+  """Returns the tier a blob of the given size belongs to.
+
+  Args:
+    size: The size of the blob in bytes.
+
+  Returns:
+    The smallest tier whose max_size is at least size.
+  """
+  for tier in get_size_tiers():
+    if tier['max_size'] is None or size <= tier['max_size']:
+      return tier
+
+
+def get_queue_name(tier):
+  """Returns the queue that copies the blobs of a tier."""
+  return tier['queue_name'] or config.config.QUEUE_NAME
+
+
+def get_counter_names(tier):
+  """Returns the names of the blob and byte counters of a tier."""
+  return 'Tier_%s_blobs' % tier['name'], 'Tier_%s_bytes' % tier['name']
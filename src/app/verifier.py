@@ -0,0 +1,291 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Pipeline to verify that the mapping entities point to correct GCS files.
+"""
+import datetime
+import hashlib
+import logging
+import math
+
+import cloudstorage
+from google.appengine.ext import blobstore
+from mapreduce import context
+from mapreduce import input_readers
+from mapreduce import mapreduce_pipeline
+from mapreduce.operation import counters
+import pipeline
+
+from app import checksums
+from app import config
+from app import gcs
+from app import models
+from app import pools
+
+# The z-score of the confidence level of the sampled mismatch estimate (95%).
+CONFIDENCE_Z = 1.96
+
+
+class BlobKeyMappingBatchInputReader(input_readers.DatastoreInputReader):
+  """Yields pages of mapping entities instead of single entities.
+
+  Each page holds up to VERIFICATION_BATCH_SIZE entities, so the mapper can
+  look up their BlobInfos with one RPC and check their GCS files
+  concurrently.
+  """
+
+  def __iter__(self):
+    """Groups the entities of the underlying reader into lists."""
+    batch_size = max(1, config.config.VERIFICATION_BATCH_SIZE)
+    batch = []
+    for mapping in super(BlobKeyMappingBatchInputReader, self).__iter__():
+      batch.append(mapping)
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+
+def is_sampled(key_str, sample_rate):
+  """Checks if a mapping belongs to the sample of a verification.
+
+  The decision is a hash of the key, so the sample is spread evenly over the
+  key space and the same mappings are sampled again by a later run with the
+  same rate.
+
+  Args:
+    key_str: The old blob key string of the mapping.
+    sample_rate: The fraction of mappings to verify, from 0 to 1.
+
+  Returns:
+    True if the mapping should be verified.
+  """
+  if sample_rate >= 1:
+    return True
+  digest = hashlib.md5(key_str).hexdigest()
+  return int(digest[:8], 16) < sample_rate * 0x100000000
+
+
+def verify_mapping_batch(mappings, _mapper_params=None):
+  """Verifies a page of mappings against Blobstore and GCS.
+
+  Each verified mapping gets its `verified` time updated (or cleared, if it
+  does not match), and every mismatch is stored as a VerificationFailure.
+
+  Args:
+    mappings: A list of BlobKeyMapping entities.
+    _mapper_params: Allows injection of mapper parameters for testing.
+
+  Yields:
+    Various MapReduce counter operations.
+  """
+  params = _mapper_params or context.get().mapreduce_spec.mapper.params
+  sample_rate = params.get('sample_rate', 1.0)
+  pipeline_id = params.get('root_pipeline_id')
+
+  yield counters.Increment('Mappings_considered', len(mappings))
+  mappings = [mapping for mapping in mappings
+              if is_sampled(mapping.old_blob_key, sample_rate)]
+  if not mappings:
+    raise StopIteration()
+
+  for mapping, blob_info, gcs_checksums, mismatches in check_mappings(
+      mappings):
+    yield counters.Increment('Mappings_verified')
+    yield counters.Increment('Bytes_verified',
+                             (gcs_checksums or {}).get('size', 0))
+    if not blob_info:
+      yield counters.Increment('Mappings_without_source_blob')
+    if mismatches:
+      yield counters.Increment('Mappings_mismatched')
+    record_verification(mapping, mismatches, pipeline_id)
+
+
+def check_mappings(mappings, blob_infos=None):
+  """Checks a page of mappings against Blobstore and GCS.
+
+  The BlobInfos of the page are read with a single RPC and the GCS files
+  are inspected with concurrent HEAD requests.
+
+  Args:
+    mappings: A list of BlobKeyMapping entities.
+    blob_infos: The BlobInfos of the mappings (None for deleted blobs), if
+      they were already read.
+
+  Returns:
+    A list with a tuple of each mapping, its BlobInfo (None if the blob was
+    deleted), its GCS checksums (None if the file does not exist) and its
+    list of mismatches (see check_mapping()).
+  """
+  if not mappings:
+    return []
+  if blob_infos is None:
+    blob_infos = blobstore.BlobInfo.get(
+        [blobstore.BlobKey(mapping.old_blob_key) for mapping in mappings])
+  futures = [gcs.get_object_checksums_async(
+                 mapping.gcs_filename.encode('utf8'))
+             for mapping in mappings]
+  results = []
+  for mapping, blob_info, future in zip(mappings, blob_infos, futures):
+    try:
+      gcs_checksums = future.get_result()
+    except cloudstorage.NotFoundError:
+      gcs_checksums = None
+    results.append((mapping, blob_info, gcs_checksums,
+                    check_mapping(mapping, blob_info, gcs_checksums)))
+  return results
+
+
+def record_verification(mapping, mismatches, pipeline_id):
+  """Records the outcome of checking a mapping.
+
+  The mapping's `verified` time is set (or cleared, if there are
+  mismatches) and written behind, and mismatches are stored as a
+  VerificationFailure.
+
+  Args:
+    mapping: The BlobKeyMapping entity.
+    mismatches: The list of mismatches (see check_mapping()).
+    pipeline_id: The pipeline that checked the mapping.
+  """
+  if mismatches:
+    logging.error('Mapping of blob_key "%s" to "%s" does not verify: %s',
+                  mapping.old_blob_key, mapping.gcs_filename,
+                  '; '.join(mismatches))
+    models.VerificationFailure.record(mapping.old_blob_key,
+                                      mapping.gcs_filename, pipeline_id,
+                                      mismatches)
+    mapping.verified = None
+  else:
+    mapping.verified = datetime.datetime.utcnow()
+  pool = pools.get_mapping_put_pool()
+  if pool is not None:
+    pool.put(mapping)
+  else:
+    mapping.put()
+
+
+def check_mapping(mapping, blob_info, gcs_checksums):
+  """Compares the GCS file of a mapping with its source.
+
+  The size and MD5 of the GCS file are compared with the BlobInfo, and its
+  size and hashes with those stored on the mapping when it was copied.
+
+  Args:
+    mapping: The BlobKeyMapping entity.
+    blob_info: The BlobInfo of the source blob, or None if it was deleted.
+    gcs_checksums: The checksums GCS reports for the file, or None if the
+      file does not exist.
+
+  Returns:
+    A list describing each mismatch; empty if the file matches.
+  """
+  if gcs_checksums is None:
+    return ['gcs file does not exist']
+  mismatches = []
+  if blob_info:
+    mismatches.extend(checksums.find_mismatches(
+        gcs_checksums,
+        checksums.get_checksum_dict(blob_info.size, blob_info.md5_hash),
+        'blobstore'))
+  mismatches.extend(checksums.find_mismatches(
+      gcs_checksums,
+      checksums.get_checksum_dict(mapping.size, mapping.md5_hash,
+                                  mapping.crc32c),
+      'mapping'))
+  return mismatches
+
+
+def get_verification_summary(counters_by_name, sample_rate):
+  """Summarizes the outcome of a verification job.
+
+  For a sampled verification, the mismatch rate of all mappings is estimated
+  from the sample, with the upper bound of its confidence interval.
+
+  Args:
+    counters_by_name: The counters of the verification job.
+    sample_rate: The fraction of mappings the job verified.
+
+  Returns:
+    A dict with the mappings considered, verified and mismatched, the
+    observed mismatch rate and its upper bound (both None if no mapping was
+    verified yet).
+  """
+  verified = counters_by_name.get('Mappings_verified', 0)
+  mismatched = counters_by_name.get('Mappings_mismatched', 0)
+  rate = None
+  upper_bound = None
+  if verified:
+    rate = float(mismatched) / verified
+    upper_bound = rate if sample_rate >= 1 else wilson_upper_bound(mismatched,
+                                                                   verified)
+  return {
+    'sample_rate': sample_rate,
+    'considered': counters_by_name.get('Mappings_considered', 0),
+    'verified': verified,
+    'mismatched': mismatched,
+    'mismatch_rate': rate,
+    'mismatch_rate_upper_bound': upper_bound,
+  }
+
+
+def wilson_upper_bound(failures, trials, z=CONFIDENCE_Z):
+  """Returns the upper bound of the Wilson score interval of a proportion.
+
+  Unlike the normal approximation, the bound stays meaningful when no
+  failures were observed.
+
+  Args:
+    failures: The number of failures observed.
+    trials: The number of trials, at least 1.
+    z: The z-score of the confidence level.
+
+  Returns:
+    The upper bound of the failure rate, from 0 to 1.
+  """
+  rate = float(failures) / trials
+  z2 = z * z
+  center = rate + z2 / (2 * trials)
+  margin = z * math.sqrt(rate * (1 - rate) / trials +
+                         z2 / (4 * trials * trials))
+  return min(1.0, (center + margin) / (1 + z2 / trials))
+
+
+class VerifyMappingsPipeline(pipeline.Pipeline):
+  """Launch a MapReduce job to verify the mapping entities."""
+
+  def run(self, sample_rate=1.0):
+    """Verifies all (or a sample of) the mapping entities.
+
+    Args:
+      sample_rate: The fraction of mappings to verify; 1.0 verifies all.
+
+    Yields:
+      A MapperPipeline for the MapReduce job to verify the mappings.
+    """
+    params = {
+      'entity_kind': 'app.models.BlobKeyMapping',
+      'sample_rate': sample_rate,
+      'root_pipeline_id': self.root_pipeline_id,
+      'shard_balance_counter': 'Bytes_verified',
+    }
+    yield mapreduce_pipeline.MapperPipeline(
+      'verify_mappings',
+      'app.verifier.verify_mapping_batch',
+      'app.verifier.BlobKeyMappingBatchInputReader',
+      params=params,
+      shards=config.config.NUM_SHARDS)
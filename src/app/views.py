@@ -15,6 +15,7 @@
 """
 Views for blob-migrator tool.
 """
+import datetime
 import os
 import json
 
@@ -27,8 +28,12 @@ import webapp2
 
 from app import config
 from app import migrator
+from app import models
+from app import planner
 from app import progress
+from app import reconciler
 from app import scrubber
+from app import verifier
 import appengine_config
 
 
@@ -72,6 +77,7 @@ class IndexView(UserView):
       'mapping_kind': config.config.MAPPING_DATASTORE_KIND_NAME,
       'config': config.config,
       'config_keys': config.CONFIGURATION_KEYS_FOR_INDEX,
+      'plan': models.MigrationPlan.build_key().get(),
     }
     return context
 
@@ -85,9 +91,17 @@ class IndexView(UserView):
     """
     POST
 
-    'bucket' is required.
+    'bucket' is required, unless 'plan' is posted to start a planning job.
     """
     context = self._get_base_context()
+    if 'plan' in self.request.POST:
+      pipeline = planner.PlanMigrationPipeline()
+      pipeline.start(queue_name=config.config.QUEUE_NAME)
+      context['bucket'] = self.request.POST.get('bucket', '').strip()
+      context['plan_pipeline_id'] = pipeline.root_pipeline_id
+      self.render_response('index.html', **context)
+      return
+
     bucket = self.request.POST.get('bucket', '').strip()
     context['bucket'] = bucket
 
@@ -126,6 +140,52 @@ class IndexView(UserView):
     self.render_response('started.html', **context)
 
 
+def get_scrub_scope(post):
+  """Reads the scope of a scrubbing pass from a posted form.
+
+  Args:
+    post: The POST parameters of the request.
+
+  Returns:
+    A tuple of the scope (see scrubber.build_scope()) and a list of errors.
+  """
+  errors = []
+
+  def get_date(name):
+    value = post.get(name, '').strip()
+    if not value:
+      return None
+    try:
+      return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+      errors.append('Dates must be formatted as YYYY-MM-DD.')
+      return None
+
+  def get_count(name, default=None):
+    value = post.get(name, '').strip()
+    if not value:
+      return default
+    try:
+      count = int(value)
+    except ValueError:
+      count = -1
+    if count < 0:
+      errors.append('Counts and rates must be whole numbers of at least 0.')
+      return default
+    return count
+
+  scope = scrubber.build_scope(
+      key_start=post.get('key_start', '').strip() or None,
+      key_end=post.get('key_end', '').strip() or None,
+      created_start=get_date('created_start'),
+      created_end=get_date('created_end'),
+      max_count=get_count('max_count'),
+      dry_run='dry_run' in post,
+      max_ops_per_second=get_count(
+          'max_ops_per_second', config.config.SCRUB_MAX_OPS_PER_SECOND))
+  return scope, errors
+
+
 class DeleteMappingEntitiesView(UserView):
   """Forms to delete the Blobstore->GCS mapping entities from Datastore.
 
@@ -136,6 +196,9 @@ class DeleteMappingEntitiesView(UserView):
     """Generates a context for both GET and POST."""
     context = {
       'mapping_kind': config.config.MAPPING_DATASTORE_KIND_NAME,
+      'form': {
+        'max_ops_per_second': config.config.SCRUB_MAX_OPS_PER_SECOND,
+      },
     }
     return context
 
@@ -147,15 +210,16 @@ class DeleteMappingEntitiesView(UserView):
   def post(self):
     """POST"""
     context = self._get_base_context()
+    context['form'] = self.request.POST
+    scope, errors = get_scrub_scope(self.request.POST)
     confirm = 'confirm' in self.request.POST
-    errors = []
-    if not confirm:
+    if not confirm and not scope['dry_run']:
       errors.append('You must select the checkbox if you want to delete the ' +
                     'Blobstore to Cloud Storage mapping entities.')
     if errors:
       context['errors'] = errors
     else:
-      pipeline = scrubber.DeleteBlobstoreToGcsFilenameMappings()
+      pipeline = scrubber.DeleteBlobstoreToGcsFilenameMappings(scope)
       pipeline.start(queue_name=config.config.QUEUE_NAME)
       context['pipeline_id'] = pipeline.root_pipeline_id
     self.render_response('delete-mappings.html', **context)
@@ -171,6 +235,9 @@ class DeleteSourceBlobsView(UserView):
     """Generates a context for both GET and POST."""
     context = {
       'mapping_kind': config.config.MAPPING_DATASTORE_KIND_NAME,
+      'form': {
+        'max_ops_per_second': config.config.SCRUB_MAX_OPS_PER_SECOND,
+      },
     }
     return context
 
@@ -182,22 +249,163 @@ class DeleteSourceBlobsView(UserView):
   def post(self):
     """POST"""
     context = self._get_base_context()
+    context['form'] = self.request.POST
+    scope, errors = get_scrub_scope(self.request.POST)
     confirm = 'confirm' in self.request.POST
-    errors = []
-    if not confirm:
+    if not confirm and not scope['dry_run']:
       errors.append('You must select the checkbox if you want to delete the ' +
                     'source blobs.')
     if errors:
       context['errors'] = errors
     else:
-      pipeline = scrubber.DeleteBlobstoreBlobs()
+      verified_only = 'verified_only' in self.request.POST
+      pipeline = scrubber.DeleteBlobstoreBlobs(verified_only, scope)
       pipeline.start(queue_name=config.config.QUEUE_NAME)
       context['pipeline_id'] = pipeline.root_pipeline_id
     self.render_response('delete-blobs.html', **context)
 
 
+class VerifyMappingsView(UserView):
+  """Forms to verify the mapping entities against Blobstore and GCS."""
+
+  # The number of recent verification failures listed.
+  MAX_FAILURES_SHOWN = 20
+
+  # The default percentage of mappings verified in sampled mode.
+  DEFAULT_SAMPLE_PERCENT = 1
+
+  def _get_base_context(self):
+    """Generates a context for both GET and POST."""
+    failures = models.VerificationFailure.query().order(
+        -models.VerificationFailure.created).fetch(self.MAX_FAILURES_SHOWN)
+    context = {
+      'mapping_kind': config.config.MAPPING_DATASTORE_KIND_NAME,
+      'failure_kind': models.VerificationFailure._get_kind(),
+      'failures': failures,
+      'sample_percent': self.DEFAULT_SAMPLE_PERCENT,
+    }
+    return context
+
+  def get(self):
+    """GET"""
+    context = self._get_base_context()
+    self.render_response('verify.html', **context)
+
+  def post(self):
+    """POST"""
+    context = self._get_base_context()
+    sample_rate = 1.0
+    errors = []
+    if self.request.POST.get('mode') == 'sampled':
+      sample_percent = self.request.POST.get('sample_percent', '').strip()
+      context['sample_percent'] = sample_percent
+      try:
+        sample_rate = float(sample_percent) / 100
+      except ValueError:
+        sample_rate = 0
+      if not 0 < sample_rate <= 1:
+        errors.append('The sample must be more than 0 and at most 100 ' +
+                      'percent.')
+    if errors:
+      context['errors'] = errors
+    else:
+      pipeline = verifier.VerifyMappingsPipeline(sample_rate)
+      pipeline.start(queue_name=config.config.QUEUE_NAME)
+      context['pipeline_id'] = pipeline.root_pipeline_id
+    self.render_response('verify.html', **context)
+
+
+class ReconcileGcsFilesView(UserView):
+  """Forms to reconcile the migrated GCS files with the mappings.
+
+  The files without a mapping are reported or deleted, or the missing
+  mappings are rebuilt from the file names.
+  """
+
+  def _get_base_context(self):
+    """Generates a context for both GET and POST."""
+    context = {
+      'mapping_kind': config.config.MAPPING_DATASTORE_KIND_NAME,
+      'root_folder': config.config.ROOT_GCS_FOLDER,
+      'grace_hours': config.config.ORPHAN_GRACE_PERIOD // 3600,
+    }
+    return context
+
+  def get(self):
+    """GET"""
+    context = self._get_base_context()
+    context['bucket'] = app_identity.get_default_gcs_bucket_name() or ''
+    self.render_response('reconcile.html', **context)
+
+  def post(self):
+    """POST"""
+    context = self._get_base_context()
+    bucket = self.request.POST.get('bucket', '').strip()
+    context['bucket'] = bucket
+    mode = self.request.POST.get('mode')
+    delete = mode == 'delete'
+    errors = []
+    try:
+      cloudstorage.validate_bucket_name(bucket)
+    except ValueError as e:
+      errors.append('Invalid bucket name. %s' % e.message)
+    if delete and 'confirm' not in self.request.POST:
+      errors.append('You must select the checkbox if you want to delete the ' +
+                    'orphaned Cloud Storage files.')
+    if errors:
+      context['errors'] = errors
+    else:
+      if mode == 'rebuild':
+        pipeline = reconciler.RebuildMappingsPipeline(bucket)
+      else:
+        pipeline = reconciler.ReconcileGcsFilesPipeline(bucket, delete)
+      pipeline.start(queue_name=config.config.QUEUE_NAME)
+      context['pipeline_id'] = pipeline.root_pipeline_id
+    self.render_response('reconcile.html', **context)
+
+
+class MigrateNewBlobsHandler(JsonHandler):
+  """Starts an incremental migration; meant to be called by cron.
+
+  The bucket is given by the 'bucket' parameter and defaults to the
+  application's default bucket.
+  """
+  def get(self):
+    bucket = (self.request.GET.get('bucket', '').strip() or
+              app_identity.get_default_gcs_bucket_name())
+    try:
+      cloudstorage.validate_bucket_name(bucket)
+    except ValueError as e:
+      self.response.set_status(400)
+      self.emit_json({'error': 'Invalid bucket name. %s' % e.message})
+      return
+    pipeline = migrator.start_new_blobs_migration(bucket)
+    self.emit_json({
+      'bucket': bucket,
+      'started': pipeline is not None,
+      'pipeline_id': pipeline.root_pipeline_id if pipeline else None,
+    })
+
+
 class StatusInfoHandler(JsonHandler):
+  """Emits the status of a pipeline.
+
+  The response carries the status version as its ETag, and a request whose
+  If-None-Match (or 'version' parameter) matches gets a 304. The request
+  never waits for the status to change; the migration workers share this
+  module's single-threaded instances, so clients poll with a backoff
+  instead.
+  """
   def get(self):
     pipeline_id = self.request.GET['pipelineId'].strip()
-    status = progress.get_status(pipeline_id)
+    known_version = self.request.GET.get('version', '').strip() or None
+    status = progress.get_cached_status(pipeline_id)
+
+    version = progress.get_status_version(status)
+    self.response.headers['ETag'] = '"%s"' % version
+    self.response.headers['Cache-Control'] = 'no-cache'
+    if version == known_version or version in self.request.if_none_match:
+      self.response.set_status(304)
+      return
+    status = dict(status, version=version)
     self.emit_json(status)
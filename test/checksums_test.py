@@ -0,0 +1,123 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.checksums
+"""
+import hashlib
+
+from app import checksums
+from app import config
+
+from test import mock
+from test import base
+
+
+class Crc32cTests(base.BlobMigratorTestCase):
+  """
+  Tests for checksums.crc32c() and checksums.crc32c_combine()
+  """
+  def test_check_value(self):
+    self.assertEquals(0xE3069283, checksums.crc32c('123456789'))
+    self.assertEquals(0, checksums.crc32c(''))
+
+  def test_incremental(self):
+    self.assertEquals(checksums.crc32c('123456789'),
+                      checksums.crc32c('6789', checksums.crc32c('12345')))
+
+  def test_pure_python_matches(self):
+    with mock.patch('app.checksums._crcmod_crc32c', None):
+      self.assertEquals(0xE3069283, checksums.crc32c('123456789'))
+      self.assertEquals(0xE3069283,
+                        checksums.crc32c('6789', checksums.crc32c('12345')))
+
+  def test_combine(self):
+    first, second = 'hello ' * 50, 'world' * 77
+    self.assertEquals(
+      checksums.crc32c(first + second),
+      checksums.crc32c_combine(checksums.crc32c(first),
+                               checksums.crc32c(second), len(second)))
+
+  def test_combine_with_empty_range(self):
+    self.assertEquals(123, checksums.crc32c_combine(123, 0, 0))
+
+
+class DecodeGcsTests(base.BlobMigratorTestCase):
+  """
+  Tests for checksums.decode_gcs_crc32c() and checksums.decode_gcs_md5()
+  """
+  def test_crc32c(self):
+    self.assertEquals(checksums.crc32c('hello world'),
+                      checksums.decode_gcs_crc32c('yZRlqg=='))
+
+  def test_md5(self):
+    self.assertEquals(hashlib.md5('hello world').hexdigest(),
+                      checksums.decode_gcs_md5('XrY7u+Ae7tCTyyK7j1rNww=='))
+
+
+class StreamingChecksumTests(base.BlobMigratorTestCase):
+  """
+  Tests for checksums.StreamingChecksum
+  """
+  def test_chunks_checksummed(self):
+    config.config.CHECKSUMS = ['md5', 'crc32c']
+    checksum = checksums.StreamingChecksum()
+    checksum.update('hello ')
+    checksum.update('world')
+    self.assertEquals({
+      'size': 11,
+      'md5': hashlib.md5('hello world').hexdigest(),
+      'crc32c': checksums.crc32c('hello world'),
+    }, checksum.to_dict())
+
+  def test_only_configured_checksums_computed(self):
+    config.config.CHECKSUMS = ['md5']
+    checksum = checksums.StreamingChecksum()
+    checksum.update('hello world')
+    self.assertEquals(None, checksum.crc32c)
+    self.assertEquals(['md5', 'size'], sorted(checksum.to_dict()))
+
+  def test_resumed_checksum_continues_crc32c(self):
+    checksum = checksums.StreamingChecksum.resume(
+        6, checksums.crc32c('hello '))
+    checksum.update('world')
+    self.assertEquals({
+      'size': 11,
+      'crc32c': checksums.crc32c('hello world'),
+    }, checksum.to_dict())
+
+  def test_resumed_checksum_without_crc32c(self):
+    checksum = checksums.StreamingChecksum.resume(6, None)
+    checksum.update('world')
+    self.assertEquals({'size': 11}, checksum.to_dict())
+
+
+class FindMismatchesTests(base.BlobMigratorTestCase):
+  """
+  Tests for checksums.find_mismatches()
+  """
+  def test_matching_checksums(self):
+    copied = {'size': 3, 'md5': 'abc'}
+    self.assertEquals([], checksums.find_mismatches(copied, copied, 'gcs'))
+
+  def test_missing_checksums_not_compared(self):
+    self.assertEquals([], checksums.find_mismatches({'size': 3, 'md5': 'abc'},
+                                                    {'crc32c': 1}, 'gcs'))
+
+  def test_mismatch_described(self):
+    mismatches = checksums.find_mismatches({'size': 3, 'md5': 'abc'},
+                                           {'size': 3, 'md5': 'def'},
+                                           'blobstore')
+    self.assertEquals(["blobstore md5 is 'def', copied 'abc'"], mismatches)
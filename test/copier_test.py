@@ -0,0 +1,235 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for app.copier
+"""
+import cloudstorage
+from google.appengine.api import files
+from google.appengine.api.files import blobstore as files_blobstore
+from google.appengine.ext import blobstore
+
+from app import config
+from app import copier
+
+from test import mock
+from test import base
+
+KiB = 1024
+MiB = 1024 * 1024
+
+
+def _write_blob(data):
+  """Creates a test blob and returns its BlobInfo."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+  blob_key = files_blobstore.get_blob_key(output_filename)
+  return blobstore.BlobInfo.get(blob_key)
+
+
+class CopierTestCase(base.BlobMigratorTestCase):
+  """Resets the instance-wide throughput tracker between tests."""
+
+  def setUp(self):
+    super(CopierTestCase, self).setUp()
+    self.__old_tracker = copier.fetch_throughput
+    copier.fetch_throughput = copier.ThroughputTracker()
+
+  def tearDown(self):
+    super(CopierTestCase, self).tearDown()
+    copier.fetch_throughput = self.__old_tracker
+
+
+class ThroughputTrackerTests(CopierTestCase):
+  """
+  Tests for copier.ThroughputTracker
+  """
+  def test_first_observation_is_used_as_is(self):
+    tracker = copier.ThroughputTracker()
+    tracker.record(1000, 2.0)
+    self.assertEquals(500, tracker.bytes_per_second)
+
+  def test_later_observations_are_averaged(self):
+    tracker = copier.ThroughputTracker(weight=0.5)
+    tracker.record(1000, 1.0)
+    tracker.record(3000, 1.0)
+    self.assertEquals(2000, tracker.bytes_per_second)
+
+  def test_empty_observations_are_ignored(self):
+    tracker = copier.ThroughputTracker()
+    tracker.record(0, 1.0)
+    tracker.record(1000, 0)
+    self.assertIsNone(tracker.bytes_per_second)
+
+
+class GetBufferSizeTests(CopierTestCase):
+  """
+  Tests for copier.get_max_buffer_size() and copier.get_buffer_size()
+  """
+  def test_f1_allows_8mib_chunks(self):
+    config.config.INSTANCE_CLASS = 'F1'
+    self.assertEquals(8 * MiB, copier.get_max_buffer_size())
+
+  def test_larger_instance_class_allows_larger_chunks(self):
+    config.config.INSTANCE_CLASS = 'B4'
+    self.assertEquals(32 * MiB, copier.get_max_buffer_size())
+
+  def test_unknown_instance_class_treated_as_f1(self):
+    config.config.INSTANCE_CLASS = 'X9'
+    self.assertEquals(8 * MiB, copier.get_max_buffer_size())
+
+  def test_configured_max_overrides_instance_class(self):
+    config.config.COPY_BUFFER_MAX_SIZE = 3 * MiB
+    self.assertEquals(3 * MiB, copier.get_max_buffer_size())
+
+  def test_large_blob_uses_max_chunk(self):
+    self.assertEquals(8 * MiB, copier.get_buffer_size(100 * MiB))
+
+  def test_small_blob_uses_min_chunk(self):
+    self.assertEquals(256 * KiB, copier.get_buffer_size(4 * KiB))
+
+  def test_chunk_is_no_larger_than_blob(self):
+    self.assertEquals(2 * MiB, copier.get_buffer_size(2 * MiB - 10))
+
+  def test_chunk_follows_observed_throughput(self):
+    copier.fetch_throughput.record(2 * MiB, 1.0)
+    config.config.COPY_BUFFER_TARGET_SECONDS = 1.0
+    self.assertEquals(2 * MiB, copier.get_buffer_size(100 * MiB))
+
+
+class FetchBlobRangeTests(CopierTestCase):
+  """
+  Tests for copier.fetch_blob_range()
+  """
+  def test_range_is_read(self):
+    blob_info = _write_blob('0123456789')
+    self.assertEquals('2345', copier.fetch_blob_range(blob_info.key(), 2, 6))
+
+  def test_range_larger_than_fetch_limit_is_read(self):
+    data = 'x' * (blobstore.MAX_BLOB_FETCH_SIZE * 2 + 5)
+    blob_info = _write_blob(data)
+    self.assertEquals(data,
+                      copier.fetch_blob_range(blob_info.key(), 0, len(data)))
+
+  def test_throughput_recorded(self):
+    blob_info = _write_blob('0123456789')
+    with mock.patch('time.time', side_effect=[100.0, 100.0, 102.0]):
+      copier.fetch_blob_range(blob_info.key(), 0, 10)
+    self.assertEquals(5, copier.fetch_throughput.bytes_per_second)
+
+  def test_fetch_completed_during_other_work_not_timed(self):
+    blob_info = _write_blob('0123456789')
+    # started at 100, collected at 102 after the caller wrote a chunk
+    with mock.patch('time.time', side_effect=[100.0, 102.0, 102.0]):
+      fetch = copier.BlobRangeFetch(blob_info.key(), 0, 10)
+      self.assertEquals('0123456789', fetch.get_result())
+    self.assertIsNone(copier.fetch_throughput.bytes_per_second)
+
+  def test_fetch_still_in_flight_timed_from_start(self):
+    blob_info = _write_blob('0123456789')
+    # started at 100, collected at 101, in flight until 102
+    with mock.patch('time.time', side_effect=[100.0, 101.0, 102.0]):
+      copier.BlobRangeFetch(blob_info.key(), 0, 10).get_result()
+    self.assertEquals(5, copier.fetch_throughput.bytes_per_second)
+
+
+class _RecordingGcsFile(object):
+  """Records the chunks written to it."""
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(data)
+
+
+class CopyBlobToGcsFileTests(CopierTestCase):
+  """
+  Tests for copier.copy_blob_to_gcs_file()
+  """
+  def test_blob_copied_in_chunks(self):
+    blob_info = _write_blob('0123456789')
+    gcs_file = _RecordingGcsFile()
+    copied = copier.copy_blob_to_gcs_file(blob_info.key(), 10, gcs_file, 4)
+    self.assertEquals(10, copied)
+    self.assertEquals(['0123', '4567', '89'], gcs_file.chunks)
+
+  def test_serial_copy_writes_same_chunks(self):
+    blob_info = _write_blob('0123456789')
+    gcs_file = _RecordingGcsFile()
+    copier.copy_blob_to_gcs_file(blob_info.key(), 10, gcs_file, 4,
+                                 prefetch=False)
+    self.assertEquals(['0123', '4567', '89'], gcs_file.chunks)
+
+  def test_next_chunk_fetched_before_write(self):
+    blob_info = _write_blob('0123456789')
+    events = []
+
+    class EventGcsFile(object):
+      def write(self, data):
+        events.append(('write', data))
+
+    real_fetch = copier.BlobRangeFetch
+    def recording_fetch(blob_key, start, end):
+      events.append(('fetch', start))
+      return real_fetch(blob_key, start, end)
+
+    with mock.patch('app.copier.BlobRangeFetch', side_effect=recording_fetch):
+      copier.copy_blob_to_gcs_file(blob_info.key(), 10, EventGcsFile(), 4)
+    self.assertEquals([('fetch', 0), ('fetch', 4), ('write', '0123'),
+                       ('fetch', 8), ('write', '4567'), ('write', '89')],
+                      events)
+
+  def test_copy_resumed_from_start(self):
+    blob_info = _write_blob('0123456789')
+    gcs_file = _RecordingGcsFile()
+    copied = copier.copy_blob_to_gcs_file(blob_info.key(), 10, gcs_file, 4,
+                                          start=4)
+    self.assertEquals(10, copied)
+    self.assertEquals(['4567', '89'], gcs_file.chunks)
+
+  def test_progress_reported_after_each_write(self):
+    blob_info = _write_blob('0123456789')
+    positions = []
+    copier.copy_blob_to_gcs_file(blob_info.key(), 10, _RecordingGcsFile(), 4,
+                                 progress=positions.append)
+    self.assertEquals([4, 8, 10], positions)
+
+  def test_empty_blob_copies_nothing(self):
+    gcs_file = _RecordingGcsFile()
+    self.assertEquals(0, copier.copy_blob_to_gcs_file('blob-key', 0,
+                                                      gcs_file, 4))
+    self.assertEquals([], gcs_file.chunks)
+
+
+class CopySmallBlobAsyncTests(CopierTestCase):
+  """
+  Tests for copier.copy_small_blob_async()
+  """
+  def test_blob_copied(self):
+    blob_info = _write_blob('0123456789')
+    future = copier.copy_small_blob_async(blob_info.key(), 10, '/my-bucket/a',
+                                          content_type='text/plain')
+    self.assertEquals(10, future.get_result())
+    gcs_file = cloudstorage.open('/my-bucket/a')
+    self.assertEquals('0123456789', gcs_file.read())
+    gcs_file.close()
+
+  def test_blob_larger_than_one_fetch_rejected(self):
+    future = copier.copy_small_blob_async(
+        'blob-key', blobstore.MAX_BLOB_FETCH_SIZE + 1, '/my-bucket/a')
+    with self.assertRaises(ValueError):
+      future.get_result()
@@ -0,0 +1,196 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for app.gcs
+"""
+import cloudstorage
+from google.appengine.ext import ndb
+
+from app import gcs
+
+from test import mock
+from test import base
+
+
+def _write_gcs_file(gcs_filename, data):
+  """Writes a GCS file."""
+  gcs_file = cloudstorage.open(gcs_filename, mode='w')
+  gcs_file.write(data)
+  gcs_file.close()
+
+
+def _urlfetch_result(status_code, headers=None):
+  """Returns a future for a urlfetch result."""
+  future = ndb.Future()
+  future.set_result(mock.Mock(status_code=status_code, headers=headers or {},
+                              content=''))
+  return future
+
+
+class SplitGcsFilenameTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.split_gcs_filename()
+  """
+  def test_bucket_and_object_name_returned(self):
+    self.assertEquals(('my-bucket', 'foo/bar.txt'),
+                      gcs.split_gcs_filename('/my-bucket/foo/bar.txt'))
+
+  def test_leading_slash_is_required(self):
+    with self.assertRaises(ValueError):
+      gcs.split_gcs_filename('my-bucket/foo')
+
+  def test_object_name_is_required(self):
+    with self.assertRaises(ValueError):
+      gcs.split_gcs_filename('/my-bucket/')
+
+
+class ComposeFilesTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.compose_files()
+  """
+  @mock.patch('cloudstorage.compose')
+  def test_object_names_passed_without_bucket(self, compose_mock):
+    gcs.compose_files(['/my-bucket/a', '/my-bucket/b'], '/my-bucket/c',
+                      content_type='text/plain')
+    compose_mock.assert_called_once_with(['a', 'b'], '/my-bucket/c',
+                                         content_type='text/plain')
+
+  def test_files_must_be_in_destination_bucket(self):
+    with self.assertRaises(ValueError):
+      gcs.compose_files(['/other-bucket/a', '/my-bucket/b'], '/my-bucket/c')
+
+  @mock.patch('cloudstorage.compose')
+  def test_many_files_composed_in_rounds(self, compose_mock):
+    parts = ['/my-bucket/part-%d' % num for num in range(40)]
+    gcs.compose_files(parts, '/my-bucket/c')
+    self.assertEquals(3, compose_mock.call_count)
+    first_round = compose_mock.call_args_list[0][0][0]
+    self.assertEquals(['part-%d' % num for num in range(32)], first_round)
+    final_round = compose_mock.call_args_list[2][0][0]
+    self.assertEquals(2, len(final_round))
+    self.assertEquals('/my-bucket/c', compose_mock.call_args_list[2][0][1])
+
+  def test_single_file_is_copied(self):
+    _write_gcs_file('/my-bucket/a', 'abc')
+    gcs.compose_files(['/my-bucket/a'], '/my-bucket/c')
+    gcs_file = cloudstorage.open('/my-bucket/c')
+    self.assertEquals('abc', gcs_file.read())
+    gcs_file.close()
+
+
+class DeleteFilesTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.delete_files()
+  """
+  def test_files_deleted(self):
+    _write_gcs_file('/my-bucket/a', 'abc')
+    gcs.delete_files(['/my-bucket/a'])
+    with self.assertRaises(cloudstorage.NotFoundError):
+      cloudstorage.stat('/my-bucket/a')
+
+  def test_missing_files_ignored(self):
+    gcs.delete_files(['/my-bucket/does-not-exist'])
+
+
+class WriteFileAsyncTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.write_file_async()
+  """
+  def test_file_written(self):
+    future = gcs.write_file_async('/my-bucket/a', 'abc',
+                                  content_type='text/plain',
+                                  options={'content-disposition': 'inline'})
+    self.assertEquals(3, future.get_result())
+    stat = cloudstorage.stat('/my-bucket/a')
+    self.assertEquals(3, stat.st_size)
+    self.assertEquals('text/plain', stat.content_type)
+    self.assertEquals('inline', stat.metadata['content-disposition'])
+    gcs_file = cloudstorage.open('/my-bucket/a')
+    self.assertEquals('abc', gcs_file.read())
+    gcs_file.close()
+
+  def test_empty_file_written(self):
+    gcs.write_file_async('/my-bucket/a', '').get_result()
+    self.assertEquals(0, cloudstorage.stat('/my-bucket/a').st_size)
+
+  @mock.patch('google.appengine.ext.ndb.Context.urlfetch')
+  @mock.patch('google.appengine.api.app_identity.get_access_token')
+  @mock.patch('cloudstorage.common.local_run')
+  def test_upload_sent_to_gcs_outside_dev_appserver(self, local_run_mock,
+                                                    token_mock, urlfetch_mock):
+    local_run_mock.return_value = False
+    token_mock.return_value = ('my-token', 0)
+    urlfetch_mock.side_effect = [
+      _urlfetch_result(201, {'location': 'https://x/my-bucket/a?upload_id=7'}),
+      _urlfetch_result(200),
+    ]
+    future = gcs.write_file_async('/my-bucket/a b', 'abc',
+                                  content_type='text/plain')
+    self.assertEquals(3, future.get_result())
+    start, upload = urlfetch_mock.call_args_list
+    self.assertEquals('https://storage.googleapis.com/my-bucket/a%20b',
+                      start[0][0])
+    self.assertEquals('POST', start[1]['method'])
+    self.assertEquals('start', start[1]['headers']['x-goog-resumable'])
+    self.assertEquals('OAuth my-token', start[1]['headers']['authorization'])
+    self.assertEquals(
+        'https://storage.googleapis.com/my-bucket/a%20b?upload_id=7',
+        upload[0][0])
+    self.assertEquals('PUT', upload[1]['method'])
+    self.assertEquals('abc', upload[1]['payload'])
+    self.assertEquals('bytes 0-2/3', upload[1]['headers']['content-range'])
+
+
+class DeleteFileAsyncTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.delete_file_async()
+  """
+  def test_file_deleted(self):
+    _write_gcs_file('/my-bucket/a', 'abc')
+    self.assertTrue(gcs.delete_file_async('/my-bucket/a').get_result())
+    with self.assertRaises(cloudstorage.NotFoundError):
+      cloudstorage.stat('/my-bucket/a')
+
+  def test_missing_file_ignored(self):
+    self.assertFalse(gcs.delete_file_async('/my-bucket/b').get_result())
+
+
+class ParseObjectChecksumsTests(base.BlobMigratorTestCase):
+  """
+  Tests for gcs.parse_object_checksums()
+  """
+  def test_hashes_parsed(self):
+    checksums = gcs.parse_object_checksums({
+      'content-length': '11',
+      'x-goog-hash': 'crc32c=yZRlqg==, md5=XrY7u+Ae7tCTyyK7j1rNww==',
+    })
+    self.assertEquals({'size': 11, 'crc32c': 3381945770,
+                       'md5': '5eb63bbbe01eeed093cb22bb8f5acdc3'}, checksums)
+
+  def test_md5_etag_used_without_hash_header(self):
+    checksums = gcs.parse_object_checksums({
+      'content-length': '11',
+      'etag': '"5eb63bbbe01eeed093cb22bb8f5acdc3"',
+    })
+    self.assertEquals('5eb63bbbe01eeed093cb22bb8f5acdc3', checksums['md5'])
+
+  def test_composite_etag_is_not_md5(self):
+    checksums = gcs.parse_object_checksums({
+      'content-length': '11',
+      'etag': '"5eb63bbbe01eeed093cb22bb8f5acdc3"',
+      'x-goog-component-count': '2',
+      'x-goog-hash': 'crc32c=yZRlqg==',
+    })
+    self.assertEquals({'size': 11, 'crc32c': 3381945770}, checksums)
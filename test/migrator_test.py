@@ -15,6 +15,9 @@
 """
 Tests for app.migrator
 """
+import datetime
+import hashlib
+import time
 import types
 import uuid
 
@@ -22,10 +25,15 @@ import cloudstorage
 from google.appengine.api import files
 from google.appengine.api.files import blobstore as files_blobstore
 from google.appengine.ext import blobstore
+from mapreduce import model
+from pipeline import common
 
+from app import checksums
 from app import config
+from app import copier
 from app import migrator
 from app import models
+from app import sharded_counters
 
 from test import mock
 from test import base
@@ -220,6 +228,514 @@ class MigrateBlobTests(base.BlobMigratorTestCase):
     self.assertEquals(0, inline_mock.call_count)
     self.assertEquals(1, pipeline_mock.call_count)
 
+  @mock.patch('app.migrator.MigrateSingleBlobPipeline.start')
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_blobs_in_tier_with_queue_start_pipeline_on_that_queue(
+      self, inline_mock=None, pipeline_mock=None):
+    config.config.SIZE_TIERS = [
+      {'name': 'small', 'max_size': 100},
+      {'name': 'large', 'max_size': None, 'queue_name': 'large-blobs'},
+    ]
+    self.call_migrate_blob(_write_blob('1' * 50))
+    self.call_migrate_blob(_write_blob('2' * 200))
+    self.assertEquals(1, inline_mock.call_count)
+    self.assertEquals(1, pipeline_mock.call_count)
+    self.assertEquals('large-blobs', pipeline_mock.call_args[1]['queue_name'])
+
+  def test_mappings_of_other_generations_migrate_again(self):
+    blob_info = _write_blob('1')
+    migrator.store_mapping_entity(blob_info, '/old-bucket/file')
+    self.call_migrate_blob(blob_info)
+    mapping = models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+    self.assertEquals('my-bucket', mapping.generation)
+    self.assertTrue(mapping.gcs_filename.startswith('/my-bucket/'))
+
+  def test_configured_generation_is_current(self):
+    config.config.MIGRATION_GENERATION = 'second-run'
+    blob_info = _write_blob('1')
+    migrator.store_mapping_entity(blob_info, '/my-bucket/file')
+    self.call_migrate_blob(blob_info)
+    mapping = models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+    self.assertEquals('second-run', mapping.generation)
+    self.assertNotEquals('/my-bucket/file', mapping.gcs_filename)
+
+
+class BatchTestCase(base.BlobMigratorTestCase):
+  """Helpers for driving migrator.migrate_blob_batch()."""
+
+  def setUp(self):
+    super(BatchTestCase, self).setUp()
+    self.mapper_params = {
+      'entity_kind': 'google.appengine.ext.blobstore.blobstore.BlobInfo',
+      'bucket_name': 'my-bucket',
+    }
+
+  def call_migrate_blob_batch(self, blob_infos):
+    """Calls the function under test, returning the yielded operations."""
+    generator = migrator.migrate_blob_batch(blob_infos,
+                                            _mapper_params=self.mapper_params)
+    return list(generator)
+
+  def get_counter(self, operations, counter_name):
+    """Sums the deltas of the named counter increments."""
+    return sum(op.delta for op in operations
+               if getattr(op, 'counter_name', None) == counter_name)
+
+
+class MigrateBlobBatchTests(BatchTestCase):
+  """
+  Tests for migrator.migrate_blob_batch()
+  """
+  def setUp(self):
+    super(MigrateBlobBatchTests, self).setUp()
+    config.config.CONCURRENT_MIGRATION_MAX_BLOBS = 1
+
+  def test_all_blobs_in_batch_are_migrated(self):
+    blob_infos = [_write_blob('1'), _write_blob('22'), _write_blob('333')]
+    operations = self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(3, self.get_counter(operations, 'BlobInfo_migrated'))
+    for blob_info in blob_infos:
+      key = models.BlobKeyMapping.build_key(str(blob_info.key()))
+      self.assertIsNotNone(key.get())
+
+  def test_migrated_bytes_counted_by_path_and_size(self):
+    blob_infos = [_write_blob('1'), _write_blob('22'), _write_blob('333')]
+    operations = self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(6, self.get_counter(operations, 'Bytes_migrated'))
+    self.assertEquals(
+        6, self.get_counter(operations, 'Bytes_migrated_within_mapper'))
+    self.assertEquals(1, self.get_counter(operations, 'Size_01_blobs'))
+    self.assertEquals(2, self.get_counter(operations, 'Size_02_blobs'))
+    self.assertEquals(5, self.get_counter(operations, 'Size_02_bytes'))
+
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_previously_migrated_blobs_in_batch_are_skipped(self, inline_mock):
+    migrated = _write_blob('1')
+    migrator.store_mapping_entity(migrated, '/my-bucket/migrated')
+    fresh = _write_blob('22')
+    operations = self.call_migrate_blob_batch([migrated, fresh])
+    self.assertEquals(1, inline_mock.call_count)
+    self.assertEquals(str(fresh.key()),
+                      str(inline_mock.call_args[0][0].key()))
+    self.assertEquals(
+        1, self.get_counter(operations, 'BlobInfo_previously_migrated'))
+
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_mappings_of_other_generations_in_batch_migrate(self, inline_mock):
+    migrated = _write_blob('1')
+    migrator.store_mapping_entity(migrated, '/old-bucket/migrated')
+    operations = self.call_migrate_blob_batch([migrated])
+    self.assertEquals(1, inline_mock.call_count)
+    self.assertEquals(
+        1, self.get_counter(operations,
+                            'BlobInfo_mapped_by_other_generation'))
+
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_mappings_looked_up_with_one_rpc(self, inline_mock):
+    blob_infos = [_write_blob('1'), _write_blob('22'), _write_blob('333')]
+    with mock.patch('google.appengine.ext.ndb.get_multi',
+                    return_value=[None] * 3) as get_multi_mock:
+      operations = self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(1, get_multi_mock.call_count)
+    self.assertEquals(
+        1, self.get_counter(operations, 'BlobKeyMapping_batched_lookups'))
+    self.assertEquals(
+        2, self.get_counter(operations, 'BlobKeyMapping_lookup_rpcs_saved'))
+
+  @mock.patch('app.migrator.MigrateSingleBlobPipeline.start')
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_large_blobs_in_batch_start_pipeline(self, inline_mock,
+                                               pipeline_mock):
+    config.config.DIRECT_MIGRATION_MAX_SIZE = 100
+    blob_infos = [_write_blob('1'), _write_blob('1' * 200)]
+    self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(1, inline_mock.call_count)
+    self.assertEquals(1, pipeline_mock.call_count)
+
+
+class BlobstoreInputReaderTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.BlobstoreInputReader
+  """
+  def setUp(self):
+    super(BlobstoreInputReaderTests, self).setUp()
+    config.config.CHECKSUMS = ['md5', 'crc32c']
+
+  def read_all(self, reader):
+    """Drives the reader to completion, returning the tuples read."""
+    result = []
+    while True:
+      try:
+        result.append(reader.next())
+      except StopIteration:
+        return result
+
+  def test_reader_stops_at_end_position(self):
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 2, 5)
+    self.assertEquals([(2, '234')],
+                      [item[:2] for item in self.read_all(reader)])
+
+  def test_readers_for_split_ranges_cover_blob(self):
+    data = '0123456789'
+    blob_info = _write_blob(data)
+    chunks = []
+    for start, end in migrator.split_byte_range(len(data), 3):
+      reader = migrator.BlobstoreInputReader(str(blob_info.key()), start, end)
+      chunks.extend(item[1] for item in self.read_all(reader))
+    self.assertEquals(data, ''.join(chunks))
+
+  def test_to_json_resumes_from_current_position(self):
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 0, 10)
+    reader.next()
+    state = reader.to_json()
+    self.assertEquals(10, state['start_position'])
+    self.assertEquals(10, state['end_position'])
+
+  def test_last_chunk_carries_crc32c_of_range(self):
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 2, 9)
+    reader.buffer_size = 3
+    items = self.read_all(reader)
+    self.assertEquals([2, 2, 2], [len(item) for item in items[:-1]])
+    self.assertEquals((2, checksums.crc32c('2345678')), items[-1][2])
+
+  def test_crc32c_resumes_from_json(self):
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 0, 10)
+    reader.buffer_size = 4
+    reader.next()
+    reader = migrator.BlobstoreInputReader.from_json(reader.to_json())
+    reader.buffer_size = 4
+    items = self.read_all(reader)
+    self.assertEquals((0, checksums.crc32c('0123456789')), items[-1][2])
+
+  def test_no_crc32c_if_only_md5_configured(self):
+    config.config.CHECKSUMS = ['md5']
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 0, 10)
+    self.assertEquals([(0, '0123456789')], self.read_all(reader))
+
+  def test_no_crc32c_if_disabled(self):
+    config.config.CHECKSUMS = []
+    blob_info = _write_blob('0123456789')
+    reader = migrator.BlobstoreInputReader(str(blob_info.key()), 0, 10)
+    self.assertEquals([(0, '0123456789')], self.read_all(reader))
+
+
+class BlobstoreDatastoreInputReaderTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.BlobstoreDatastoreInputReader
+  """
+  def split_and_read_keys(self, shard_count):
+    """Splits the input through MapReduce and reads every shard."""
+    mapper_spec = model.MapperSpec(
+        'app.migrator.yield_data',
+        'app.migrator.BlobstoreDatastoreInputReader',
+        {'input_reader': {
+          'entity_kind': 'google.appengine.ext.blobstore.blobstore.BlobInfo',
+        }},
+        shard_count)
+    readers = migrator.BlobstoreDatastoreInputReader.split_input(mapper_spec)
+    self.assertTrue(readers)
+    return [str(blob_info.key()) for reader in readers
+            for blob_info in reader]
+
+  def test_split_input_balanced_by_size_covers_every_blob(self):
+    keys = [str(_write_blob('x' * num).key()) for num in range(1, 9)]
+    self.assertEquals(sorted(keys), sorted(self.split_and_read_keys(4)))
+
+  def test_split_input_by_count_covers_every_blob(self):
+    config.config.BALANCE_SHARDS_BY_SIZE = False
+    keys = [str(_write_blob('x' * num).key()) for num in range(1, 9)]
+    self.assertEquals(sorted(keys), sorted(self.split_and_read_keys(4)))
+
+
+class BlobstoreCreationRangeInputReaderTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.BlobstoreCreationRangeInputReader
+  """
+  def read_keys(self, reader):
+    """Drives the reader to completion, returning the blob key strings."""
+    return [str(blob_info.key()) for batch in reader for blob_info in batch]
+
+  def test_reads_blobs_within_window_in_batches(self):
+    config.config.MAPPING_LOOKUP_BATCH_SIZE = 2
+    keys = [str(_write_blob(str(num)).key()) for num in range(3)]
+    now = time.time()
+    reader = migrator.BlobstoreCreationRangeInputReader(now - 60, now + 60)
+    batches = list(reader)
+    self.assertEquals([2, 1], [len(batch) for batch in batches])
+    self.assertEquals(sorted(keys),
+                      sorted(str(blob_info.key())
+                             for batch in batches for blob_info in batch))
+
+  def test_blobs_outside_window_are_skipped(self):
+    _write_blob('1')
+    now = time.time()
+    reader = migrator.BlobstoreCreationRangeInputReader(now + 60, now + 120)
+    self.assertEquals([], self.read_keys(reader))
+
+  def test_to_json_resumes_after_cursor(self):
+    config.config.MAPPING_LOOKUP_BATCH_SIZE = 1
+    keys = [str(_write_blob(str(num)).key()) for num in range(2)]
+    now = time.time()
+    reader = migrator.BlobstoreCreationRangeInputReader(now - 60, now + 60)
+    first = next(iter(reader))
+    resumed = migrator.BlobstoreCreationRangeInputReader.from_json(
+        reader.to_json())
+    read = [str(first[0].key())] + self.read_keys(resumed)
+    self.assertEquals(sorted(keys), sorted(read))
+
+  def test_split_input_divides_window(self):
+    mapper_spec = mock.Mock(shard_count=4, params={
+      'creation_start': 100.0,
+      'creation_end': 200.0,
+    })
+    readers = migrator.BlobstoreCreationRangeInputReader.split_input(
+        mapper_spec)
+    self.assertEquals([(100, 125), (125, 150), (150, 175), (175, 200)],
+                      [(reader.creation_start, reader.creation_end)
+                       for reader in readers])
+
+  def test_split_input_of_empty_window(self):
+    mapper_spec = mock.Mock(shard_count=4, params={
+      'creation_start': 200.0,
+      'creation_end': 200.0,
+    })
+    self.assertEquals(
+      None, migrator.BlobstoreCreationRangeInputReader.split_input(mapper_spec))
+
+  def test_timestamps_round_trip(self):
+    value = datetime.datetime(2015, 6, 1, 12, 30, 15, 250000)
+    self.assertEquals(value,
+                      migrator.from_timestamp(migrator.to_timestamp(value)))
+
+
+class GetExpectedTotalsTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.get_expected_totals()
+  """
+  def test_totals_from_plan(self):
+    models.MigrationPlan(key=models.MigrationPlan.build_key(),
+                         blobs=10, bytes=2000).put()
+    self.assertEquals((10, 2000), migrator.get_expected_totals())
+
+  def test_unknown_totals(self):
+    self.assertEquals((None, None), migrator.get_expected_totals())
+
+
+class AdvanceMigrationWatermarkTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.AdvanceMigrationWatermark
+  """
+  def run_pipeline(self, result_status):
+    """Runs the pipeline's run() directly."""
+    creation_end = migrator.to_timestamp(datetime.datetime(2015, 6, 1))
+    args = ('my-bucket', creation_end, None, result_status)
+    migrator.AdvanceMigrationWatermark(*args).run(*args)
+
+  def test_successful_run_advances_watermark(self):
+    self.run_pipeline('success')
+    watermark = models.MigrationWatermark.build_key('my-bucket').get()
+    self.assertEquals(datetime.datetime(2015, 6, 1), watermark.creation)
+
+  def test_failed_run_does_not_advance_watermark(self):
+    self.run_pipeline('failed')
+    self.assertEquals(None,
+                      models.MigrationWatermark.build_key('my-bucket').get())
+
+
+class SplitByteRangeTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.split_byte_range()
+  """
+  def test_ranges_are_contiguous_and_cover_size(self):
+    ranges = migrator.split_byte_range(10, 3)
+    self.assertEquals([(0, 4), (4, 7), (7, 10)], ranges)
+
+  def test_never_more_ranges_than_bytes(self):
+    ranges = migrator.split_byte_range(2, 8)
+    self.assertEquals([(0, 1), (1, 2)], ranges)
+
+  def test_empty_blob_has_one_empty_range(self):
+    self.assertEquals([(0, 0)], migrator.split_byte_range(0, 4))
+
+
+class ChooseSizeWeightedSplitPointsTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.choose_size_weighted_split_points()
+  """
+  def setUp(self):
+    super(ChooseSizeWeightedSplitPointsTests, self).setUp()
+    self.patcher = mock.patch('app.migrator.SHARD_BALANCE_PER_BLOB_BYTES', 0)
+    self.patcher.start()
+
+  def tearDown(self):
+    self.patcher.stop()
+    super(ChooseSizeWeightedSplitPointsTests, self).tearDown()
+
+  def test_equal_sizes_split_by_count(self):
+    samples = [(key, 10) for key in 'abcdef']
+    self.assertEquals(['c', 'e'],
+                      migrator.choose_size_weighted_split_points(samples, 3))
+
+  def test_large_blob_gets_its_own_range(self):
+    samples = [('a', 1), ('b', 1), ('c', 100), ('d', 1), ('e', 1)]
+    self.assertEquals(['c', 'd'],
+                      migrator.choose_size_weighted_split_points(samples, 3))
+
+  def test_one_shard_has_no_split_points(self):
+    samples = [(key, 10) for key in 'abc']
+    self.assertEquals([],
+                      migrator.choose_size_weighted_split_points(samples, 1))
+
+  def test_never_more_split_points_than_samples(self):
+    samples = [('a', 10), ('b', 10)]
+    self.assertEquals(['b'],
+                      migrator.choose_size_weighted_split_points(samples, 8))
+
+
+class GetCompositePartCountTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.get_composite_part_count()
+  """
+  def setUp(self):
+    super(GetCompositePartCountTests, self).setUp()
+    config.config.COMPOSITE_UPLOAD_PARTS = 8
+    config.config.COMPOSITE_UPLOAD_MIN_PART_SIZE = 100
+
+  def test_unknown_size_uses_one_part(self):
+    self.assertEquals(1, migrator.get_composite_part_count(None))
+
+  def test_small_blob_uses_one_part(self):
+    self.assertEquals(1, migrator.get_composite_part_count(100))
+
+  def test_parts_limited_by_min_part_size(self):
+    self.assertEquals(3, migrator.get_composite_part_count(250))
+
+  def test_parts_limited_by_configuration(self):
+    self.assertEquals(8, migrator.get_composite_part_count(100000))
+
+  def test_parts_limited_by_compose_limit(self):
+    config.config.COMPOSITE_UPLOAD_PARTS = 100
+    self.assertEquals(32, migrator.get_composite_part_count(100000))
+
+
+class ComposeBlobPartsTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.ComposeBlobParts
+  """
+  def test_parts_composed_in_shard_order_and_deleted(self):
+    parts = ['/my-bucket/%s%d' % (migrator.PART_NAME_PREFIX, num)
+             for num in [10, 2, 1]]
+    with mock.patch('app.gcs.compose_files') as compose_mock:
+      with mock.patch('app.gcs.delete_files') as delete_mock:
+        output = migrator.ComposeBlobParts(VALID_BLOB_KEY, None, 'text/plain',
+                                           'my-bucket', parts).run(
+            VALID_BLOB_KEY, None, 'text/plain', 'my-bucket', parts)
+    expected = migrator.build_gcs_filename(VALID_BLOB_KEY,
+                                           bucket_name='my-bucket',
+                                           include_bucket=True,
+                                           include_leading_slash=True)
+    self.assertEquals([expected], output)
+    self.assertEquals([parts[2], parts[1], parts[0]],
+                      compose_mock.call_args[0][0])
+    self.assertEquals(expected, compose_mock.call_args[0][1])
+    delete_mock.assert_called_once_with([parts[2], parts[1], parts[0]])
+
+
+class MigrateSmallBlobsConcurrentlyTests(BatchTestCase):
+  """
+  Tests for migrator.migrate_small_blobs_concurrently() within batches
+  """
+  def setUp(self):
+    super(MigrateSmallBlobsConcurrentlyTests, self).setUp()
+    config.config.CONCURRENT_MIGRATION_MAX_BLOBS = 2
+
+  def count_mappings(self):
+    """Returns the number of stored mapping entities."""
+    return models.BlobKeyMapping.query().count()
+
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_small_blobs_copied_concurrently(self, inline_mock):
+    data = ['1', '22', '333']
+    blob_infos = [_write_blob(d, filename='f%d.txt' % i)
+                  for i, d in enumerate(data)]
+    operations = self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(0, inline_mock.call_count)
+    self.assertEquals(
+        3, self.get_counter(operations, 'BlobInfo_migrated_concurrently'))
+    self.assertEquals(
+        3, self.get_counter(operations, 'BlobInfo_migrated_within_mapper'))
+    self.assertEquals(3, self.get_counter(operations, 'BlobInfo_migrated'))
+    for blob_info, expected in zip(blob_infos, data):
+      mapping = models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+      self.assertEquals(expected,
+                        _get_blob_with_gcs_filename(mapping.gcs_filename))
+      stat = cloudstorage.stat(mapping.gcs_filename)
+      self.assertEquals('attachment; filename=%s' % blob_info.filename,
+                        stat.metadata['content-disposition'])
+
+  def test_window_of_copies_is_bounded(self):
+    blob_infos = [_write_blob(str(i)) for i in range(5)]
+    real_copy = migrator.copier.copy_small_blob_async
+    started = []
+
+    def recording_copy(*args, **kwargs):
+      started.append(args[0])
+      self.assertTrue(len(started) - self.count_mappings() <= 2)
+      return real_copy(*args, **kwargs)
+
+    with mock.patch('app.copier.copy_small_blob_async',
+                    side_effect=recording_copy):
+      self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(5, len(started))
+    self.assertEquals(5, self.count_mappings())
+
+  def test_byte_budget_limits_window(self):
+    config.config.CONCURRENT_MIGRATION_MAX_BYTES = 3
+    blob_infos = [_write_blob('12'), _write_blob('34'), _write_blob('56')]
+    real_copy = migrator.copier.copy_small_blob_async
+    started = []
+
+    def recording_copy(*args, **kwargs):
+      started.append(args[0])
+      self.assertTrue(len(started) - self.count_mappings() <= 1)
+      return real_copy(*args, **kwargs)
+
+    with mock.patch('app.copier.copy_small_blob_async',
+                    side_effect=recording_copy):
+      self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(3, self.count_mappings())
+
+  def test_failed_copy_keeps_mappings_of_completed_copies(self):
+    blob_infos = [_write_blob('1'), _write_blob('22'), _write_blob('333')]
+    real_copy = migrator.copier.copy_small_blob_async
+
+    def failing_copy(*args, **kwargs):
+      if args[1] == 2:
+        raise cloudstorage.TransientError('upload failed')
+      return real_copy(*args, **kwargs)
+
+    with mock.patch('app.copier.copy_small_blob_async',
+                    side_effect=failing_copy):
+      with self.assertRaises(cloudstorage.TransientError):
+        self.call_migrate_blob_batch(blob_infos)
+    mapped = models.BlobKeyMapping.build_key(str(blob_infos[0].key())).get()
+    self.assertIsNotNone(mapped)
+    self.assertEquals(1, self.count_mappings())
+
+  @mock.patch('app.migrator.migrate_single_blob_inline')
+  def test_blobs_over_size_limit_are_streamed(self, inline_mock):
+    config.config.CONCURRENT_MIGRATION_MAX_SIZE = 2
+    blob_infos = [_write_blob('1'), _write_blob('333')]
+    operations = self.call_migrate_blob_batch(blob_infos)
+    self.assertEquals(1, inline_mock.call_count)
+    self.assertEquals(
+        1, self.get_counter(operations, 'BlobInfo_migrated_concurrently'))
+
 
 class YieldDataTests(base.BlobMigratorTestCase):
   """
@@ -239,6 +755,13 @@ class YieldDataTests(base.BlobMigratorTestCase):
     with self.assertRaises(StopIteration):
       next(generator)
 
+  def test_crc32c_of_last_chunk_counted(self):
+    data = (123, 'my-data', (100, 12345))
+    results = list(migrator.yield_data(data))
+    self.assertEquals('my-data', results[0])
+    self.assertEquals('Part_crc32c_at_100', results[1].counter_name)
+    self.assertEquals(12345, results[1].delta)
+
 
 class BuildGCSFilenameTests(base.BlobMigratorTestCase):
   """
@@ -329,6 +852,45 @@ class BuildGCSFilenameTests(base.BlobMigratorTestCase):
                                                  bucket_name='not valid')
 
 
+class ParseGCSFilenameTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.parse_gcs_filename()
+  """
+  def setUp(self):
+    super(ParseGCSFilenameTests, self).setUp()
+    config.config.ROOT_GCS_FOLDER = 'foo'
+
+  def build(self, **kwargs):
+    """Builds a GCS filename in my-bucket for VALID_BLOB_KEY."""
+    return migrator.build_gcs_filename(VALID_BLOB_KEY, bucket_name='my-bucket',
+                                       include_bucket=True,
+                                       include_leading_slash=True, **kwargs)
+
+  def test_reverses_build_gcs_filename(self):
+    self.assertEquals(VALID_BLOB_KEY,
+                      migrator.parse_gcs_filename(self.build()))
+    self.assertEquals(VALID_BLOB_KEY, migrator.parse_gcs_filename(
+        self.build(filename='photo.jpg')))
+
+  def test_part_and_intermediate_files_recognized(self):
+    part = self.build(filename=migrator.PART_NAME_PREFIX + '3')
+    self.assertEquals(VALID_BLOB_KEY, migrator.parse_gcs_filename(part))
+    intermediate = self.build() + '.compose-abc123'
+    self.assertEquals(VALID_BLOB_KEY,
+                      migrator.parse_gcs_filename(intermediate))
+
+  def test_other_files_not_recognized(self):
+    self.assertIsNone(migrator.parse_gcs_filename('/my-bucket/foo/test.txt'))
+    self.assertIsNone(migrator.parse_gcs_filename('/my-bucket/bar/a/b/c/d/e'))
+    self.assertIsNone(migrator.parse_gcs_filename(
+        '/my-bucket/foo/a/b/c/d/' + VALID_BLOB_KEY))
+
+  def test_root_folder_can_be_empty(self):
+    config.config.ROOT_GCS_FOLDER = ''
+    self.assertEquals(VALID_BLOB_KEY,
+                      migrator.parse_gcs_filename(self.build()))
+
+
 class BuildContentDispositionTests(base.BlobMigratorTestCase):
   """
   Tests for migrator.build_content_disposition()
@@ -355,12 +917,20 @@ class MigrateSingleBlobInlineTests(base.BlobMigratorTestCase):
     self.assertEquals('1', contents)
 
   def test_large_blob_written_to_gcs(self):
-    data = '1' * (migrator.BLOB_BUFFER_SIZE + 2)  # force larger than buffer
+    data = '1' * (copier.get_max_buffer_size() + 2)  # force larger than buffer
     blob_info = _write_blob(data)
     gcs_filename = migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
     contents = _get_blob_with_gcs_filename(gcs_filename)
     self.assertEquals(data, contents)
 
+  def test_blob_copied_in_many_small_chunks(self):
+    data = ''.join(chr(ord('a') + i % 26) for i in range(1000))
+    blob_info = _write_blob(data)
+    gcs_filename = migrator.migrate_single_blob_inline(blob_info, 'my-bucket',
+                                                       buffer_size=64)
+    contents = _get_blob_with_gcs_filename(gcs_filename)
+    self.assertEquals(data, contents)
+
   def test_content_disposition_set_if_filename_on_blob(self):
     blob_info = _write_blob('1', filename='my-file.txt')
     gcs_filename = migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
@@ -396,6 +966,180 @@ class MigrateSingleBlobInlineTests(base.BlobMigratorTestCase):
     self.assertEquals(str(blob_info.key()), entity.old_blob_key)
 
 
+class ExistingCopyTests(base.BlobMigratorTestCase):
+  """
+  Tests for skipping copies that are already in GCS
+  """
+  def setUp(self):
+    super(ExistingCopyTests, self).setUp()
+    self.blob_info = _write_blob('0123456789')
+    self.key = models.BlobKeyMapping.build_key(str(self.blob_info.key()))
+    self.gcs_filename = migrator._build_inline_gcs_filename(self.blob_info,
+                                                            'my-bucket')
+
+  def test_matching_copy_not_copied_again(self):
+    _write_gcs_file('0123456789', filename=self.gcs_filename.split('/', 2)[2])
+    with mock.patch('app.copier.copy_blob_to_gcs_file') as copy_mock:
+      gcs_filename = migrator.migrate_single_blob_inline(self.blob_info,
+                                                         'my-bucket')
+    self.assertEquals(0, copy_mock.call_count)
+    self.assertEquals(self.gcs_filename, gcs_filename)
+    self.assertEquals(10, self.key.get().size)
+
+  def test_different_copy_copied_again(self):
+    _write_gcs_file('012345678x', filename=self.gcs_filename.split('/', 2)[2])
+    gcs_filename = migrator.migrate_single_blob_inline(self.blob_info,
+                                                       'my-bucket')
+    self.assertEquals('0123456789', _get_blob_with_gcs_filename(gcs_filename))
+
+  def test_find_existing_copy(self):
+    self.assertIsNone(migrator.find_existing_copy(self.blob_info,
+                                                  self.gcs_filename))
+    _write_gcs_file('0123456789', filename=self.gcs_filename.split('/', 2)[2])
+    existing = migrator.find_existing_copy(self.blob_info, self.gcs_filename)
+    self.assertEquals(10, existing['size'])
+    self.assertEquals(self.blob_info.md5_hash, existing['md5'])
+
+  @mock.patch('app.migrator.mapreduce_pipeline.MapperPipeline')
+  def test_pipeline_stores_mapping_of_matching_copy(self, mapper_mock):
+    _write_gcs_file('0123456789', filename=self.gcs_filename.split('/', 2)[2])
+    args = (str(self.blob_info.key()), None, 'text/plain', 'my-bucket', 10,
+            'root-1')
+    list(migrator.MigrateSingleBlobPipeline(*args).run(*args))
+    self.assertEquals(0, mapper_mock.call_count)
+    self.assertEquals(self.gcs_filename, self.key.get().gcs_filename)
+    totals = sharded_counters.get_totals('root-1')
+    self.assertEquals(1, totals['completed_blobs'])
+    self.assertEquals(10, totals['skipped_bytes'])
+
+  @mock.patch('cloudstorage.stat')
+  @mock.patch('app.gcs.get_object_checksums')
+  @mock.patch('app.migrator.mapreduce_pipeline.MapperPipeline')
+  def test_pipeline_skips_composed_copy_with_source_md5(self, mapper_mock,
+                                                        checksums_mock,
+                                                        stat_mock):
+    config.config.COMPOSITE_UPLOAD_PARTS = 4
+    config.config.COMPOSITE_UPLOAD_MIN_PART_SIZE = 2
+    checksums_mock.return_value = {'size': 10, 'md5': None, 'crc32c': 7}
+    stat_mock.return_value = mock.Mock(metadata={
+      migrator.SOURCE_MD5_METADATA: self.blob_info.md5_hash,
+    })
+    args = (str(self.blob_info.key()), None, 'text/plain', 'my-bucket', 10,
+            'root-1')
+    self.assertEquals(4, migrator.get_composite_part_count(10))
+    list(migrator.MigrateSingleBlobPipeline(*args).run(*args))
+    self.assertEquals(0, mapper_mock.call_count)
+    self.assertEquals(self.gcs_filename, self.key.get().gcs_filename)
+    totals = sharded_counters.get_totals('root-1')
+    self.assertEquals(10, totals['skipped_bytes'])
+
+  @mock.patch('cloudstorage.stat')
+  @mock.patch('app.gcs.get_object_checksums')
+  def test_composed_copy_without_source_md5_not_matched(self, checksums_mock,
+                                                        stat_mock):
+    checksums_mock.return_value = {'size': 10, 'md5': None, 'crc32c': 7}
+    stat_mock.return_value = mock.Mock(metadata={})
+    self.assertIsNone(migrator.find_existing_copy(self.blob_info,
+                                                  self.gcs_filename))
+
+  @mock.patch('app.gcs.get_object_checksums')
+  @mock.patch('cloudstorage.copy2')
+  def test_verified_composed_copy_records_source_md5(self, copy_mock,
+                                                     checksums_mock):
+    checksums_mock.return_value = {'size': 10}
+    args = (str(self.blob_info.key()), [self.gcs_filename], 'root-1', 10, {},
+            4)
+    migrator.StoreMappingEntity(*args).run(*args)
+    metadata = copy_mock.call_args[1]['metadata']
+    self.assertEquals(self.blob_info.md5_hash,
+                      metadata[migrator.SOURCE_MD5_METADATA])
+    self.assertEquals(self.blob_info.content_type, metadata['content-type'])
+    self.assertIsNotNone(self.key.get())
+
+
+class _Interrupted(Exception):
+  """Stands in for a task deadline in the middle of a copy."""
+
+
+def _interrupt_copy_at(position_limit):
+  """Patches the copier to fail once a copy has reached a position."""
+  real_copy = copier.copy_blob_to_gcs_file
+  def interrupted_copy(*args, **kwargs):
+    progress = kwargs['progress']
+    def interrupting_progress(position):
+      progress(position)
+      if position >= position_limit:
+        raise _Interrupted()
+    kwargs['progress'] = interrupting_progress
+    return real_copy(*args, **kwargs)
+  return mock.patch('app.copier.copy_blob_to_gcs_file',
+                    side_effect=interrupted_copy)
+
+
+class CopyCheckpointTests(base.BlobMigratorTestCase):
+  """
+  Tests for resuming inline copies from a CopyCheckpoint
+  """
+  CHUNK = 256 * 1024
+
+  def setUp(self):
+    super(CopyCheckpointTests, self).setUp()
+    config.config.COPY_CHECKPOINT_INTERVAL = self.CHUNK
+    config.config.CHECKSUMS = ['md5', 'crc32c']
+    self.data = ''.join(chr(i % 251) for i in xrange(4 * self.CHUNK))
+    self.blob_info = _write_blob(self.data)
+    self.key = models.CopyCheckpoint.build_key(str(self.blob_info.key()))
+
+  def _migrate(self):
+    return migrator.migrate_single_blob_inline(self.blob_info, 'my-bucket',
+                                               buffer_size=self.CHUNK)
+
+  def _interrupt(self, position):
+    with _interrupt_copy_at(position):
+      self.assertRaises(_Interrupted, self._migrate)
+
+  def test_interrupted_copy_leaves_checkpoint(self):
+    self._interrupt(2 * self.CHUNK)
+    checkpoint = self.key.get()
+    self.assertEquals(2 * self.CHUNK, checkpoint.offset)
+    self.assertEquals(checksums.crc32c(self.data[:2 * self.CHUNK]),
+                      checkpoint.crc32c)
+    self.assertIsNone(models.BlobKeyMapping.build_key(
+        str(self.blob_info.key())).get())
+
+  @mock.patch('app.migrator._count_copy_progress')
+  def test_retried_copy_resumes_from_checkpoint(self, count_mock):
+    self._interrupt(2 * self.CHUNK)
+    real_copy = copier.copy_blob_to_gcs_file
+    with mock.patch('app.copier.copy_blob_to_gcs_file',
+                    side_effect=real_copy) as copy_mock:
+      gcs_filename = self._migrate()
+    self.assertEquals(2 * self.CHUNK, copy_mock.call_args[1]['start'])
+    count_mock.assert_called_once_with('Bytes_resumed', 2 * self.CHUNK)
+    self.assertEquals(self.data, _get_blob_with_gcs_filename(gcs_filename))
+    self.assertIsNone(self.key.get())
+    mapping = models.BlobKeyMapping.build_key(str(self.blob_info.key())).get()
+    self.assertEquals(checksums.crc32c(self.data), mapping.crc32c)
+
+  @mock.patch('app.migrator._count_copy_progress')
+  def test_checkpoint_of_other_file_discarded(self, count_mock):
+    models.CopyCheckpoint(key=self.key, gcs_filename='/other-bucket/file',
+                          offset=self.CHUNK).put()
+    gcs_filename = self._migrate()
+    count_mock.assert_called_once_with('Bytes_recopied', self.CHUNK)
+    self.assertEquals(self.data, _get_blob_with_gcs_filename(gcs_filename))
+    self.assertIsNone(self.key.get())
+
+  def test_completed_copy_leaves_no_checkpoint(self):
+    self._migrate()
+    self.assertIsNone(self.key.get())
+
+  def test_no_checkpoint_when_disabled(self):
+    config.config.COPY_CHECKPOINT_INTERVAL = 0
+    self._interrupt(2 * self.CHUNK)
+    self.assertIsNone(self.key.get())
+
+
 class WriteTestFileTests(base.BlobMigratorTestCase):
   """
   Tests for migrator.write_test_file()
@@ -414,6 +1158,258 @@ class WriteTestFileTests(base.BlobMigratorTestCase):
       migrator.write_test_file('unauthed-bucket')
 
 
+class SecondaryPipelineCountsTests(base.BlobMigratorTestCase):
+  """
+  Tests for the aggregated counts of secondary pipelines
+  """
+  @mock.patch('app.migrator.MigrateSingleBlobPipeline.start')
+  def test_started_pipeline_is_counted(self, pipeline_mock):
+    config.config.DIRECT_MIGRATION_MAX_SIZE = 100
+    blob_info = _write_blob('1' * 200)
+    operations = list(migrator._migrate_unmapped_blob(blob_info, 'my-bucket',
+                                                      'root-1'))
+    totals = sharded_counters.get_totals('root-1')
+    self.assertEquals(1, totals['started_blobs'])
+    self.assertEquals(200, totals['started_bytes'])
+    counted = dict((op.counter_name, op.delta) for op in operations)
+    self.assertEquals(200, counted['Bytes_handed_to_secondary_pipeline'])
+    self.assertNotIn('Bytes_migrated', counted)
+
+  def test_stored_mapping_counts_completed_pipeline(self):
+    args = (VALID_BLOB_KEY, ['/my-bucket/file'], 'root-1', 300)
+    migrator.StoreMappingEntity(*args).run(*args)
+    totals = sharded_counters.get_totals('root-1')
+    self.assertEquals(1, totals['completed_blobs'])
+    self.assertEquals(300, totals['completed_bytes'])
+    self.assertEquals(300, totals['Mapper_Bytes_migrated'])
+    self.assertEquals(
+        1, totals['Mapper_BlobInfo_migrated_via_secondary_pipeline'])
+
+  def test_aborted_pipeline_recorded_as_failure(self):
+    args = (VALID_BLOB_KEY, 'file.txt', 'text/plain', 'my-bucket', 300,
+            'root-1')
+    pipeline = migrator.MigrateSingleBlobPipeline(*args)
+    pipeline.was_aborted = True
+    pipeline.finalized()
+    failure = models.MigrationFailure.build_key(VALID_BLOB_KEY).get()
+    self.assertEquals(migrator.COPY_ABORTED, failure.reason)
+    self.assertTrue(failure.gcs_filename.startswith('/my-bucket/'))
+    self.assertEquals(1, sharded_counters.get_totals('root-1')['failed_blobs'])
+
+  def test_aborted_parallel_copy_deletes_part_files(self):
+    config.config.COMPOSITE_UPLOAD_PARTS = 2
+    config.config.COMPOSITE_UPLOAD_MIN_PART_SIZE = 2
+    part_format = migrator.build_gcs_part_name_format(VALID_BLOB_KEY)
+    for num in range(2):
+      _write_gcs_file('x', filename=part_format.replace('$num', str(num)))
+    _write_gcs_file('x', filename='other-file')
+    args = (VALID_BLOB_KEY, None, 'text/plain', 'my-bucket', 4, 'root-1')
+    pipeline = migrator.MigrateSingleBlobPipeline(*args)
+    pipeline.was_aborted = True
+    pipeline.finalized()
+    self.assertEquals(['/my-bucket/other-file'],
+                      [stat.filename
+                       for stat in cloudstorage.listbucket('/my-bucket/')])
+
+  def test_nothing_counted_without_root_pipeline(self):
+    with mock.patch('app.sharded_counters.increment') as increment_mock:
+      migrator.record_secondary_pipeline(None, 'failed', 100)
+    self.assertEquals(0, increment_mock.call_count)
+
+
+class ChecksumVerificationTests(base.BlobMigratorTestCase):
+  """
+  Tests for the checksums computed and verified while copying
+  """
+  def count_operations(self, operations, counter_name):
+    """Sums the deltas of the named counter increments."""
+    return sum(op.delta for op in operations
+               if getattr(op, 'counter_name', None) == counter_name)
+
+  def test_mapping_stores_checksums(self):
+    blob_info = _write_blob('0123456789')
+    migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
+    mapping = models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+    self.assertEquals(10, mapping.size)
+    self.assertEquals(hashlib.md5('0123456789').hexdigest(), mapping.md5_hash)
+    self.assertIsNone(mapping.crc32c)
+
+  def test_mapping_stores_configured_crc32c(self):
+    config.config.CHECKSUMS = ['md5', 'crc32c']
+    blob_info = _write_blob('0123456789')
+    migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
+    mapping = models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+    self.assertEquals(checksums.crc32c('0123456789'), mapping.crc32c)
+
+  @mock.patch('app.gcs.get_object_checksums')
+  def test_gcs_mismatch_records_failure_instead_of_mapping(self, gcs_mock):
+    gcs_mock.return_value = {'size': 10, 'md5': 'not-the-md5'}
+    blob_info = _write_blob('0123456789')
+    self.assertEquals(None, migrator.migrate_single_blob_inline(blob_info,
+                                                                'my-bucket'))
+    key_str = str(blob_info.key())
+    self.assertEquals(None, models.BlobKeyMapping.build_key(key_str).get())
+    failure = models.MigrationFailure.build_key(key_str).get()
+    self.assertEquals(migrator.CHECKSUM_MISMATCH, failure.reason)
+    self.assertEquals(1, len(failure.details))
+
+  @mock.patch('app.gcs.get_object_checksums')
+  def test_mismatch_counted_not_migrated(self, gcs_mock):
+    gcs_mock.return_value = {'size': 9}
+    blob_info = _write_blob('0123456789')
+    operations = list(migrator._migrate_unmapped_blob(blob_info, 'my-bucket'))
+    self.assertEquals(1, self.count_operations(operations,
+                                               'BlobInfo_checksum_mismatch'))
+    self.assertEquals(0, self.count_operations(operations,
+                                               'BlobInfo_migrated'))
+
+  def test_part_crc32cs_combined(self):
+    data = 'abcdefghij'
+    mapper_counters = dict(
+        (migrator.PART_CRC32C_COUNTER_FORMAT % start,
+         checksums.crc32c(data[start:end]))
+        for start, end in migrator.split_byte_range(len(data), 3))
+    self.assertEquals(checksums.crc32c(data),
+                      migrator.combine_part_crc32cs(mapper_counters, 10, 3))
+    del mapper_counters[migrator.PART_CRC32C_COUNTER_FORMAT % 0]
+    self.assertEquals(None,
+                      migrator.combine_part_crc32cs(mapper_counters, 10, 3))
+
+  @mock.patch('app.gcs.get_object_checksums')
+  def test_pipeline_mismatch_counts_failed_pipeline(self, gcs_mock):
+    gcs_mock.return_value = {'size': 10, 'crc32c': 1}
+    mapper_counters = {migrator.PART_CRC32C_COUNTER_FORMAT % 0: 2}
+    args = (VALID_BLOB_KEY, ['/my-bucket/file'], 'root-1', 10,
+            mapper_counters, 1)
+    migrator.StoreMappingEntity(*args).run(*args)
+    mapping_key = models.BlobKeyMapping.build_key(VALID_BLOB_KEY)
+    self.assertEquals(None, mapping_key.get())
+    totals = sharded_counters.get_totals('root-1')
+    self.assertEquals(1, totals['failed_blobs'])
+    self.assertEquals(1, totals['mismatched_blobs'])
+
+  @mock.patch('app.gcs.get_object_checksums')
+  def test_pipeline_match_stores_crc32c(self, gcs_mock):
+    gcs_mock.return_value = {'size': 10, 'crc32c': 2}
+    mapper_counters = {migrator.PART_CRC32C_COUNTER_FORMAT % 0: 2}
+    args = (VALID_BLOB_KEY, ['/my-bucket/file'], 'root-1', 10,
+            mapper_counters, 1)
+    migrator.StoreMappingEntity(*args).run(*args)
+    mapping = models.BlobKeyMapping.build_key(VALID_BLOB_KEY).get()
+    self.assertEquals(2, mapping.crc32c)
+    self.assertEquals(None, mapping.md5_hash)
+
+
+class DeleteStaleMappingsTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.delete_stale_mappings()
+  """
+  def delete(self, mappings):
+    """Runs the mapper over a page of mappings, returning its operations."""
+    pairs = [(mapping, blobstore.BlobInfo.get(
+                 blobstore.BlobKey(mapping.old_blob_key)))
+             for mapping in mappings]
+    return list(migrator.delete_stale_mappings(
+        pairs, _mapper_params={'generation': 'new-bucket'}))
+
+  def test_only_stale_mappings_deleted(self):
+    stale = migrator.store_mapping_entity(_write_blob('1'), '/old-bucket/a')
+    current = migrator.store_mapping_entity(_write_blob('2'), '/new-bucket/b')
+    operations = self.delete([stale, current])
+    self.assertIsNone(stale.key.get())
+    self.assertIsNotNone(current.key.get())
+    self.assertEquals(1, self.get_counter(operations,
+                                          'Stale_mappings_deleted'))
+
+  def test_mappings_without_source_blob_kept(self):
+    stale = migrator.store_mapping_entity(VALID_BLOB_KEY, '/old-bucket/a')
+    operations = self.delete([stale])
+    self.assertIsNotNone(stale.key.get())
+    self.assertEquals(
+        1, self.get_counter(operations,
+                            'Stale_mappings_kept_without_source_blob'))
+
+  def test_replaced_mapping_not_deleted(self):
+    blob_info = _write_blob('1')
+    stale = migrator.store_mapping_entity(blob_info, '/old-bucket/a')
+    migrator.store_mapping_entity(blob_info, '/new-bucket/a')
+    self.delete([stale])
+    self.assertEquals('new-bucket', stale.key.get().generation)
+
+  def test_mappings_of_failed_copies_kept(self):
+    stale = migrator.store_mapping_entity(_write_blob('1'), '/old-bucket/a')
+    models.MigrationFailure.record(stale.old_blob_key, '/new-bucket/a',
+                                   migrator.CHECKSUM_MISMATCH, [])
+    operations = self.delete([stale])
+    self.assertIsNotNone(stale.key.get())
+    self.assertEquals(
+        1, self.get_counter(operations,
+                            'Stale_mappings_kept_after_failed_copy'))
+
+  def test_failures_of_other_generations_ignored(self):
+    stale = migrator.store_mapping_entity(_write_blob('1'), '/old-bucket/a')
+    models.MigrationFailure.record(stale.old_blob_key, '/old-bucket/a',
+                                   migrator.CHECKSUM_MISMATCH, [])
+    self.delete([stale])
+    self.assertIsNone(stale.key.get())
+
+  def get_counter(self, operations, counter_name):
+    """Sums the deltas of the named counter increments."""
+    return sum(op.delta for op in operations
+               if getattr(op, 'counter_name', None) == counter_name)
+
+
+class CollectStaleMappingsTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.CollectStaleMappings
+  """
+  def collect(self, *args):
+    """Runs the pipeline step."""
+    migrator.CollectStaleMappings(*args).run(*args)
+
+  @mock.patch('app.migrator.DeleteStaleMappingsPipeline.start')
+  def test_started_after_successful_migration(self, start_mock):
+    self.collect('bucket', 'success',
+                 {'BlobInfo_mapped_by_other_generation': 3})
+    self.assertEquals(1, start_mock.call_count)
+
+  @mock.patch('app.migrator.DeleteStaleMappingsPipeline.start')
+  def test_not_started_without_stale_mappings(self, start_mock):
+    self.collect('bucket', 'success', {})
+    self.assertEquals(0, start_mock.call_count)
+
+  @mock.patch('app.migrator.DeleteStaleMappingsPipeline.start')
+  def test_not_started_after_failed_migration(self, start_mock):
+    self.collect('bucket', 'failed',
+                 {'BlobInfo_mapped_by_other_generation': 3})
+    self.assertEquals(0, start_mock.call_count)
+
+
+class DeleteStaleMappingsPipelineTests(base.BlobMigratorTestCase):
+  """
+  Tests for migrator.DeleteStaleMappingsPipeline
+  """
+  @mock.patch('mapreduce.mapreduce_pipeline.MapperPipeline')
+  def test_waits_for_secondary_pipelines(self, mapper_mock):
+    migrator.record_secondary_pipeline('root', 'started', 10)
+    args = ('new-bucket', 'root')
+    run = migrator.DeleteStaleMappingsPipeline(*args).run(*args)
+    delay = next(run)
+    self.assertIsInstance(delay, common.Delay)
+    again = run.send(delay.outputs)
+    self.assertIsInstance(again, migrator.DeleteStaleMappingsPipeline)
+    self.assertEquals(args, tuple(again.args))
+    self.assertEquals(0, mapper_mock.call_count)
+
+  @mock.patch('mapreduce.mapreduce_pipeline.MapperPipeline')
+  def test_starts_once_secondary_pipelines_finished(self, mapper_mock):
+    migrator.record_secondary_pipeline('root', 'started', 10)
+    migrator.record_secondary_pipeline('root', 'failed', 10)
+    args = ('new-bucket', 'root')
+    list(migrator.DeleteStaleMappingsPipeline(*args).run(*args))
+    self.assertEquals(1, mapper_mock.call_count)
+
+
 class StoreMappingEntityTests(base.BlobMigratorTestCase):
   """
   Tests for migrator.store_mapping_entity()
@@ -465,6 +1461,15 @@ class StoreMappingEntityTests(base.BlobMigratorTestCase):
     lookup = entity.key.get()
     self.assertEquals('/bucket/filename', lookup.gcs_filename)
 
+  def test_generation_stored(self):
+    entity = migrator.store_mapping_entity(VALID_BLOB_KEY, '/bucket/filename')
+    self.assertEquals('bucket', entity.key.get().generation)
+
+  def test_configured_generation_stored(self):
+    config.config.MIGRATION_GENERATION = 'second-run'
+    entity = migrator.store_mapping_entity(VALID_BLOB_KEY, '/bucket/filename')
+    self.assertEquals('second-run', entity.key.get().generation)
+
   def test_new_blob_key_str_stored(self):
     entity = migrator.store_mapping_entity(VALID_BLOB_KEY, '/bucket/filename')
     lookup = entity.key.get()
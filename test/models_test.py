@@ -15,6 +15,8 @@
 """
 Tests for app.models
 """
+import datetime
+
 from app import config
 from app import models
 
@@ -42,3 +44,55 @@ class BlobKeyMappingTests(base.BlobMigratorTestCase):
       models.BlobKeyMapping.build_key('')
     with self.assertRaises(ValueError):
       models.BlobKeyMapping.build_key(None)
+
+  def test_get_generation_uses_stored_generation(self):
+    mapping = models.BlobKeyMapping(gcs_filename='/bucket/file',
+                                    generation='second-run')
+    self.assertEquals('second-run', mapping.get_generation())
+
+  def test_get_generation_defaults_to_bucket(self):
+    mapping = models.BlobKeyMapping(gcs_filename='/bucket/file')
+    self.assertEquals('bucket', mapping.get_generation())
+
+
+class MigrationWatermarkTests(base.BlobMigratorTestCase):
+  """
+  Tests for MigrationWatermark
+  """
+  def setUp(self):
+    super(MigrationWatermarkTests, self).setUp()
+    self.key = models.MigrationWatermark.build_key('my-bucket')
+    self.june = datetime.datetime(2015, 6, 1)
+    self.july = datetime.datetime(2015, 7, 1)
+
+  def test_first_run_scans_everything(self):
+    models.MigrationWatermark.record_pipeline('my-bucket', 'pipeline-1')
+    watermark = self.key.get()
+    self.assertEquals('pipeline-1', watermark.pipeline_id)
+    self.assertEquals(None, watermark.get_scan_start())
+
+  def test_advance_sets_scan_start(self):
+    models.MigrationWatermark.advance('my-bucket', self.july, None)
+    self.assertEquals(self.july, self.key.get().get_scan_start())
+
+  def test_rewind_moves_scan_start_back(self):
+    models.MigrationWatermark.advance('my-bucket', self.july, None)
+    models.MigrationWatermark.rewind('my-bucket', self.june)
+    self.assertEquals(self.june, self.key.get().get_scan_start())
+
+  def test_advance_clears_retry_from_that_was_scanned(self):
+    models.MigrationWatermark.advance('my-bucket', self.june, None)
+    models.MigrationWatermark.rewind('my-bucket', self.june)
+    models.MigrationWatermark.advance('my-bucket', self.july, self.june)
+    self.assertEquals(self.july, self.key.get().get_scan_start())
+
+  def test_advance_keeps_failure_during_run(self):
+    models.MigrationWatermark.record_pipeline('my-bucket', 'pipeline-1')
+    # a blob of the run in progress fails before the run completes
+    models.MigrationWatermark.rewind('my-bucket', self.june)
+    models.MigrationWatermark.advance('my-bucket', self.july, None)
+    self.assertEquals(self.june, self.key.get().get_scan_start())
+
+  def test_rewind_without_watermark_does_nothing(self):
+    models.MigrationWatermark.rewind('my-bucket', self.june)
+    self.assertEquals(None, self.key.get())
@@ -0,0 +1,165 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.planner
+"""
+from google.appengine.api import files
+from google.appengine.ext import blobstore
+
+from app import config
+from app import models
+from app import planner
+
+from test import base
+from test import mock
+
+
+def _write_blob(data):
+  """Creates a test blob."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+
+
+def _get_counters(operations):
+  """Sums the deltas of counter increments by name."""
+  result = {}
+  for op in operations:
+    result[op.counter_name] = result.get(op.counter_name, 0) + op.delta
+  return result
+
+
+class BlobSizeInputReaderTests(base.BlobMigratorTestCase):
+  """
+  Tests for planner.BlobSizeInputReader
+  """
+  def test_reads_sizes_within_range(self):
+    for data in ['1', '22', '4444', '88888888']:
+      _write_blob(data)
+    reader = planner.BlobSizeInputReader(2, 8)
+    self.assertEquals([2, 4], [size for page in reader for size in page])
+
+  def test_unbounded_range(self):
+    for data in ['1', '88888888']:
+      _write_blob(data)
+    reader = planner.BlobSizeInputReader(2, None)
+    self.assertEquals([8], [size for page in reader for size in page])
+
+  @mock.patch('app.planner.PLAN_PAGE_SIZE', 1)
+  def test_to_json_resumes_after_cursor(self):
+    for data in ['1', '22', '333']:
+      _write_blob(data)
+    reader = planner.BlobSizeInputReader(0, None)
+    first = next(iter(reader))
+    resumed = planner.BlobSizeInputReader.from_json(reader.to_json())
+    self.assertEquals([1, 2, 3],
+                      first + [size for page in resumed for size in page])
+
+  def test_split_input_covers_all_sizes(self):
+    mapper_spec = mock.Mock(shard_count=4)
+    readers = planner.BlobSizeInputReader.split_input(mapper_spec)
+    self.assertEquals(4, len(readers))
+    self.assertEquals(0, readers[0].min_size)
+    self.assertEquals(None, readers[-1].max_size)
+    for reader, next_reader in zip(readers, readers[1:]):
+      self.assertEquals(reader.max_size, next_reader.min_size)
+
+  @mock.patch('app.planner._sample_blob_sizes')
+  def test_split_input_at_sampled_quantiles(self, sample):
+    sample.return_value = [10] * 6 + [1000, 2000]
+    mapper_spec = mock.Mock(shard_count=4)
+    readers = planner.BlobSizeInputReader.split_input(mapper_spec)
+    self.assertEquals([(0, 10), (10, 1000), (1000, None)],
+                      [(r.min_size, r.max_size) for r in readers])
+    sample.assert_called_once_with(
+      4 * planner.migrator.SHARD_BALANCE_SAMPLES_PER_SHARD)
+
+
+class ChooseSizeBoundariesTests(base.BlobMigratorTestCase):
+  """
+  Tests for planner.choose_size_boundaries
+  """
+  def test_quantiles(self):
+    sizes = [8, 1, 2, 7, 3, 6, 4, 5]
+    self.assertEquals([0, 3, 5, 7, None],
+                      planner.choose_size_boundaries(sizes, 4))
+
+  def test_skewed_sizes_split_small_blobs(self):
+    sizes = range(1, 97) + [2 ** 30] * 4
+    self.assertEquals([0, 26, 51, 76, None],
+                      planner.choose_size_boundaries(sizes, 4))
+
+  def test_equal_quantiles_merged(self):
+    self.assertEquals([0, 5, None],
+                      planner.choose_size_boundaries([5] * 10, 4))
+
+  def test_no_sizes(self):
+    self.assertEquals([], planner.choose_size_boundaries([], 4))
+
+
+class PlanBlobSizesTests(base.BlobMigratorTestCase):
+  """
+  Tests for planner.plan_blob_sizes()
+  """
+  def test_counts_by_path_and_bucket(self):
+    config.config.DIRECT_MIGRATION_MAX_SIZE = 1000
+    counters = _get_counters(planner.plan_blob_sizes([0, 1000, 1001, 1500]))
+    self.assertEquals(4, counters['Plan_blobs'])
+    self.assertEquals(3501, counters['Plan_bytes'])
+    self.assertEquals(2, counters['Plan_inline_blobs'])
+    self.assertEquals(1000, counters['Plan_inline_bytes'])
+    self.assertEquals(2, counters['Plan_pipeline_blobs'])
+    self.assertEquals(2501, counters['Plan_pipeline_bytes'])
+    self.assertEquals(1, counters['Plan_Size_00_blobs'])
+    self.assertEquals(2, counters['Plan_Size_10_blobs'])
+    self.assertEquals(2001, counters['Plan_Size_10_bytes'])
+    self.assertEquals(1, counters['Plan_Size_11_blobs'])
+    self.assertEquals(1500, counters['Plan_Size_11_bytes'])
+
+
+class BuildPlanTests(base.BlobMigratorTestCase):
+  """
+  Tests for planner.build_plan() and planner.estimate_seconds()
+  """
+  def setUp(self):
+    super(BuildPlanTests, self).setUp()
+    config.config.ESTIMATED_SHARD_THROUGHPUT = 100
+    config.config.ESTIMATED_SECONDS_PER_BLOB = 1
+    config.config.CONCURRENT_MIGRATION_MAX_BLOBS = 10
+    config.config.COMPOSITE_UPLOAD_PARTS = 4
+
+  def test_estimate_seconds(self):
+    # 20 blobs: (10000 / 100 + 20 * 1 / 10) / 2 shards = 51 seconds
+    self.assertEquals(51, planner.estimate_seconds(20, 10000, 0, 0, 2))
+    # 1 large blob: 40000 / (100 * 4) + 60 = 160 seconds
+    self.assertEquals(160, planner.estimate_seconds(0, 0, 1, 40000, 2))
+
+  def test_build_plan_from_counters(self):
+    counters = {
+      'Plan_blobs': 3, 'Plan_bytes': 2048,
+      'Plan_inline_blobs': 3, 'Plan_inline_bytes': 2048,
+      'Plan_Size_11_blobs': 2, 'Plan_Size_11_bytes': 2048,
+      'Plan_Size_00_blobs': 1, 'Plan_Size_00_bytes': 0,
+    }
+    plan = planner.build_plan(counters, 4)
+    self.assertEquals(models.MigrationPlan.build_key(), plan.key)
+    self.assertEquals(3, plan.blobs)
+    self.assertEquals(0, plan.pipeline_blobs)
+    self.assertEquals([0, 11], [row['bucket'] for row in plan.histogram])
+    self.assertEquals(4, plan.num_shards)
+    self.assertEquals(planner.estimate_seconds(3, 2048, 0, 0, 4),
+                      plan.estimated_seconds)
@@ -0,0 +1,189 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for app.pools
+"""
+from google.appengine.api import files
+from google.appengine.api.files import blobstore as files_blobstore
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from app import models
+from app import pools
+
+from test import mock
+from test import base
+
+
+def _write_blob(data):
+  """Creates a test blob and returns its BlobInfo."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+  blob_key = files_blobstore.get_blob_key(output_filename)
+  return blobstore.BlobInfo.get(blob_key)
+
+
+class _FakeDeleteRpc(object):
+  """A delete RPC that fails if any of its keys was in `failing`."""
+
+  def __init__(self, blob_keys, failing, calls):
+    self.blob_keys = [str(blob_key) for blob_key in blob_keys]
+    self.fails = any(blob_key in failing for blob_key in self.blob_keys)
+    calls.append(self.blob_keys)
+
+  def get_result(self):
+    if self.fails:
+      raise blobstore.Error('Cannot delete.')
+
+
+def _build_mapping(key_str):
+  """Builds an unsaved mapping entity."""
+  return models.BlobKeyMapping(key=models.BlobKeyMapping.build_key(key_str),
+                               gcs_filename='/my-bucket/%s' % key_str,
+                               new_blob_key='new-%s' % key_str)
+
+
+class MappingPutPoolTests(base.BlobMigratorTestCase):
+  """
+  Tests for pools.MappingPutPool
+  """
+  def assertStored(self, key_strs):
+    """Asserts that mappings exist for all the key strings."""
+    keys = [models.BlobKeyMapping.build_key(k) for k in key_strs]
+    self.assertTrue(all(ndb.get_multi(keys)))
+
+  def assertNotStored(self, key_strs):
+    """Asserts that no mappings exist for the key strings."""
+    keys = [models.BlobKeyMapping.build_key(k) for k in key_strs]
+    self.assertFalse(any(ndb.get_multi(keys)))
+
+  def test_entities_buffered_below_threshold(self):
+    pool = pools.MappingPutPool(max_entities=3)
+    pool.put(_build_mapping('a'))
+    pool.put(_build_mapping('b'))
+    self.assertNotStored(['a', 'b'])
+
+  def test_flush_writes_buffered_entities(self):
+    pool = pools.MappingPutPool(max_entities=3)
+    pool.put(_build_mapping('a'))
+    pool.put(_build_mapping('b'))
+    pool.flush()
+    self.assertStored(['a', 'b'])
+
+  def test_threshold_starts_write_without_flush(self):
+    pool = pools.MappingPutPool(max_entities=2)
+    pool.put(_build_mapping('a'))
+    pool.put(_build_mapping('b'))
+    self.assertEquals(2, len(pool._futures))
+
+  def test_next_batch_waits_for_previous_batch(self):
+    pool = pools.MappingPutPool(max_entities=2)
+    for key_str in ['a', 'b', 'c', 'd']:
+      pool.put(_build_mapping(key_str))
+    self.assertStored(['a', 'b'])
+    self.assertEquals(2, len(pool._futures))
+
+  def test_flush_waits_for_in_flight_batch(self):
+    pool = pools.MappingPutPool(max_entities=2)
+    for key_str in ['a', 'b', 'c']:
+      pool.put(_build_mapping(key_str))
+    pool.flush()
+    self.assertStored(['a', 'b', 'c'])
+    self.assertEquals([], pool._futures)
+
+  def test_flush_is_safe_to_repeat(self):
+    pool = pools.MappingPutPool(max_entities=2)
+    pool.flush()
+    pool.put(_build_mapping('a'))
+    pool.flush()
+    pool.flush()
+    self.assertStored(['a'])
+
+  def test_no_pool_outside_of_mapper(self):
+    self.assertIsNone(pools.get_mapping_put_pool())
+
+
+class BlobDeletePoolTests(base.BlobMigratorTestCase):
+  """
+  Tests for pools.BlobDeletePool
+  """
+  def setUp(self):
+    super(BlobDeletePoolTests, self).setUp()
+    self.calls = []
+    self.failing = set()
+    self.patcher = mock.patch(
+        'google.appengine.ext.blobstore.delete_async',
+        side_effect=lambda blob_keys: _FakeDeleteRpc(blob_keys, self.failing,
+                                                     self.calls))
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(BlobDeletePoolTests, self).tearDown()
+
+  def test_blobs_deleted_and_bytes_counted(self):
+    blob_infos = [_write_blob('abc'), _write_blob('defgh')]
+    pool = pools.BlobDeletePool(batch_size=10)
+    for blob_info in blob_infos:
+      pool.delete(blob_info.key())
+    pool.flush()
+    self.assertEquals([None, None],
+                      blobstore.BlobInfo.get([b.key() for b in blob_infos]))
+    self.assertEquals(2, pool.blobs_deleted)
+    self.assertEquals(8, pool.bytes_freed)
+
+  def test_keys_deleted_in_batches(self):
+    self.patcher.start()
+    pool = pools.BlobDeletePool(batch_size=2)
+    for key_str in ['a', 'b', 'c', 'd', 'e']:
+      pool.delete(key_str, 1)
+    self.assertEquals(2, len(self.calls))
+    pool.flush()
+    self.assertEquals([['a', 'b'], ['c', 'd'], ['e']], self.calls)
+    self.assertEquals(5, pool.bytes_freed)
+
+  def test_in_flight_calls_are_bounded(self):
+    self.patcher.start()
+    pool = pools.BlobDeletePool(batch_size=1, max_in_flight=2)
+    for key_str in ['a', 'b', 'c', 'd']:
+      pool.delete(key_str, 1)
+      self.assertTrue(len(pool._in_flight) <= 2)
+    self.assertEquals(2, pool.blobs_deleted)
+
+  def test_failed_batch_split_and_retried(self):
+    self.patcher.start()
+    self.failing.add('d')
+    pool = pools.BlobDeletePool(batch_size=4, max_attempts=3)
+    for key_str in ['a', 'b', 'c', 'd']:
+      pool.delete(key_str, 1)
+    with self.assertRaises(blobstore.Error):
+      pool.flush()
+    self.assertEquals([['a', 'b', 'c', 'd'], ['a', 'b'], ['c', 'd'],
+                       ['c'], ['d']], self.calls)
+    self.assertEquals(3, pool.blobs_deleted)
+
+  def test_transient_failure_retried(self):
+    self.patcher.start()
+    self.failing.add('b')
+    pool = pools.BlobDeletePool(batch_size=2, max_attempts=2)
+    pool.delete('a', 1)
+    pool.delete('b', 1)
+    self.failing.clear()
+    pool.flush()
+    self.assertEquals(2, pool.blobs_deleted)
+
+  def test_no_pool_outside_of_mapper(self):
+    self.assertIsNone(pools.get_blob_delete_pool())
@@ -0,0 +1,339 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.progress
+"""
+from google.appengine.api import memcache
+
+from app import config
+from app import progress
+from app import sharded_counters
+
+from test import base
+from test import mock
+
+
+class ComputeSkewTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.compute_skew()
+  """
+  def test_balanced_shards(self):
+    self.assertEquals(1.0, progress.compute_skew([10, 10, 10]))
+
+  def test_unbalanced_shards(self):
+    self.assertEquals(2.5, progress.compute_skew([50, 10, 0, 20, 20]))
+
+  def test_no_work_has_no_skew(self):
+    self.assertEquals(None, progress.compute_skew([0, 0]))
+    self.assertEquals(None, progress.compute_skew([]))
+
+
+class GetTierBreakdownTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_tier_breakdown()
+  """
+  def test_bytes_per_second_by_tier(self):
+    config.config.SIZE_TIERS = [
+      {'name': 'small', 'max_size': 100},
+      {'name': 'large', 'max_size': None, 'queue_name': 'large-blobs'},
+    ]
+    counters = {
+      'Tier_small_blobs': 3, 'Tier_small_bytes': 150,
+      'Tier_large_blobs': 1, 'Tier_large_bytes': 1000,
+    }
+    breakdown = progress.get_tier_breakdown(counters, 10)
+    self.assertEquals(['small', 'large'], [tier['name'] for tier in breakdown])
+    self.assertEquals(15, breakdown[0]['bytes_per_second'])
+    self.assertEquals(3, breakdown[0]['blobs'])
+    self.assertEquals(100, breakdown[1]['bytes_per_second'])
+    self.assertEquals('large-blobs', breakdown[1]['queue_name'])
+
+  def test_no_elapsed_time_has_no_throughput(self):
+    breakdown = progress.get_tier_breakdown({}, 0)
+    self.assertEquals([0] * len(breakdown),
+                      [tier['bytes_per_second'] for tier in breakdown])
+
+
+class GetThroughputTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_throughput()
+  """
+  def get_throughput(self, now, num_bytes, blobs, active=True):
+    """Calls the function under test at a given time."""
+    counters = {'Bytes_migrated': num_bytes, 'BlobInfo_migrated': blobs}
+    with mock.patch('time.time', return_value=now):
+      return progress.get_throughput('job-1', counters, 100, active)
+
+  def test_rolling_throughput_between_samples(self):
+    self.get_throughput(1000.0, 1000, 10)
+    throughput = self.get_throughput(1010.0, 6000, 20)
+    self.assertEquals(500, throughput['bytes_per_second'])
+    self.assertEquals(1, throughput['blobs_per_second'])
+    self.assertEquals(10, throughput['window_seconds'])
+    self.assertEquals(60, throughput['average_bytes_per_second'])
+
+  def test_first_sample_uses_average(self):
+    throughput = self.get_throughput(1000.0, 1000, 10)
+    self.assertEquals(10, throughput['bytes_per_second'])
+
+  def test_finished_job_has_no_rolling_throughput(self):
+    throughput = self.get_throughput(1000.0, 1000, 10, active=False)
+    self.assertEquals(0, throughput['bytes_per_second'])
+    self.assertEquals(10, throughput['average_bytes_per_second'])
+
+
+class TrimSamplesTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.trim_samples()
+  """
+  def test_keeps_newest_sample_before_window(self):
+    samples = [(10,), (20,), (30,), (45,)]
+    self.assertEquals([(20,), (30,), (45,)],
+                      progress.trim_samples(samples, 50, 30))
+
+  def test_keeps_all_samples_within_window(self):
+    samples = [(30,), (45,)]
+    self.assertEquals(samples, progress.trim_samples(samples, 50, 30))
+
+
+class GetPathBreakdownTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_path_breakdown()
+  """
+  def test_breakdown(self):
+    breakdown = progress.get_path_breakdown({
+      'BlobInfo_migrated_within_mapper': 2,
+      'Bytes_migrated_within_mapper': 30,
+    })
+    self.assertEquals(progress.COPY_PATHS,
+                      [path['path'] for path in breakdown])
+    self.assertEquals(30, breakdown[0]['bytes'])
+    self.assertEquals(0, breakdown[2]['blobs'])
+
+
+class GetStatusTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_status()
+  """
+  def get_status(self, root_status, children=None):
+    """Gets the status of a pipeline tree with the given root status."""
+    pipelines = dict(children or {})
+    pipelines['p1'] = {'status': root_status, 'classPath': 'app.Root'}
+    with mock.patch('pipeline.get_status_tree',
+                    return_value={'pipelines': pipelines}):
+      return progress.get_status('p1')
+
+  def test_finished_pipeline_without_mapper_job_is_done(self):
+    status = self.get_status('done')
+    self.assertEquals('done', status['pipeline_status'])
+    self.assertFalse(status['mapreduce_active'])
+    self.assertEquals(progress.NO_MAPREDUCE_RESULT_STATUS,
+                      status['mapreduce_result_status'])
+    self.assertEquals({}, status['mapreduce_counters'])
+    self.assertEquals(progress.FINISHED_STATUS_CACHE_SECONDS,
+                      progress.get_cache_seconds(status))
+
+  def test_aborted_pipeline_without_mapper_job_failed(self):
+    status = self.get_status('aborted')
+    self.assertEquals('aborted', status['pipeline_status'])
+    self.assertEquals('failed', status['mapreduce_result_status'])
+    self.assertEquals(progress.FINISHED_STATUS_CACHE_SECONDS,
+                      progress.get_cache_seconds(status))
+
+  def test_running_pipeline_without_mapper_job_has_no_status_yet(self):
+    self.assertNotIn('pipeline_status', self.get_status('run'))
+
+  def test_mapper_pipeline_status_reported(self):
+    status = self.get_status('run', {'c1': {
+      'status': 'run',
+      'classPath': 'mapreduce.mapper_pipeline.MapperPipeline',
+    }})
+    self.assertEquals('run', status['pipeline_status'])
+
+
+class GetCachedStatusTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_cached_status()
+  """
+  def setUp(self):
+    super(GetCachedStatusTests, self).setUp()
+    self.patcher = mock.patch('app.progress.get_status')
+    self.get_status_mock = self.patcher.start()
+    self.get_status_mock.return_value = {'pipeline_id': 'p1',
+                                         'pipeline_status': 'run'}
+
+  def tearDown(self):
+    self.patcher.stop()
+    super(GetCachedStatusTests, self).tearDown()
+
+  def test_status_is_computed_once_while_cached(self):
+    progress.get_cached_status('p1')
+    status = progress.get_cached_status('p1')
+    self.assertEquals(1, self.get_status_mock.call_count)
+    self.assertEquals('run', status['pipeline_status'])
+
+  def test_stale_status_served_while_another_request_recomputes(self):
+    progress.get_cached_status('p1')
+    memcache.delete(progress._STATUS_KEY % 'p1')
+    memcache.add(progress._STATUS_LOCK_KEY % 'p1', 1)
+    status = progress.get_cached_status('p1')
+    self.assertEquals(1, self.get_status_mock.call_count)
+    self.assertEquals('run', status['pipeline_status'])
+
+  @mock.patch('app.progress.STATUS_WAIT_SECONDS', 0)
+  def test_status_recomputed_if_lock_holder_never_stores_it(self):
+    memcache.add(progress._STATUS_LOCK_KEY % 'p1', 1)
+    progress.get_cached_status('p1')
+    self.assertEquals(1, self.get_status_mock.call_count)
+
+  def test_lock_is_released(self):
+    progress.get_cached_status('p1')
+    self.assertEquals(None, memcache.get(progress._STATUS_LOCK_KEY % 'p1'))
+
+  def test_finished_status_cached_longer(self):
+    self.assertEquals(progress.FINISHED_STATUS_CACHE_SECONDS,
+                      progress.get_cache_seconds({
+                        'pipeline_status': 'done',
+                        'mapreduce_active': False,
+                      }))
+    self.assertEquals(progress.STATUS_CACHE_SECONDS,
+                      progress.get_cache_seconds({
+                        'pipeline_status': 'done',
+                        'mapreduce_active': True,
+                      }))
+
+
+class GetSecondaryPipelinesTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_secondary_pipelines()
+  """
+  def test_in_flight_pipelines(self):
+    sharded_counters.increment('root-1', {'started_blobs': 3,
+                                          'started_bytes': 300})
+    sharded_counters.increment('root-1', {'completed_blobs': 1,
+                                          'completed_bytes': 100})
+    sharded_counters.increment('root-1', {'failed_blobs': 1,
+                                          'failed_bytes': 50})
+    summary = progress.get_secondary_pipelines('root-1')
+    self.assertEquals(1, summary['in_flight_blobs'])
+    self.assertEquals(150, summary['in_flight_bytes'])
+    self.assertEquals(1, summary['failed_blobs'])
+
+  def test_completed_pipelines_added_to_counters(self):
+    counters = progress.add_secondary_counters(
+        {'Bytes_migrated': 10, 'Other': 1},
+        {'Mapper_Bytes_migrated': 300, 'completed_bytes': 300})
+    self.assertEquals({'Bytes_migrated': 310, 'Other': 1}, counters)
+
+  def test_finished_run_with_pipelines_in_flight_is_not_cached_long(self):
+    self.assertEquals(progress.STATUS_CACHE_SECONDS,
+                      progress.get_cache_seconds({
+                        'pipeline_status': 'done',
+                        'mapreduce_active': False,
+                        'secondary_pipelines': {'in_flight_blobs': 2},
+                      }))
+
+
+class GetCompletionTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_completion()
+  """
+  def build_job(self, active=True, **params):
+    """Builds a stand-in for a MapreduceState."""
+    mr_job = mock.Mock(active=active)
+    mr_job.mapreduce_spec.mapper.params = params
+    return mr_job
+
+  def get_completion(self, now, mr_job, done_bytes, in_flight_bytes=0):
+    """Calls the function under test at a given time."""
+    counters = {'Bytes_considered_for_migration': done_bytes,
+                'BlobInfo_considered_for_migration': done_bytes // 10}
+    secondary = {'in_flight_bytes': in_flight_bytes,
+                 'in_flight_blobs': 1 if in_flight_bytes else 0}
+    with mock.patch('time.time', return_value=now):
+      return progress.get_completion('job-1', mr_job, counters, secondary, 100)
+
+  def test_percent_complete_excludes_bytes_in_flight(self):
+    mr_job = self.build_job(expected_blobs=100, expected_bytes=1000)
+    completion = self.get_completion(1000.0, mr_job, 600, in_flight_bytes=100)
+    self.assertEquals(50.0, completion['percent_bytes'])
+    self.assertEquals(59.0, completion['percent_blobs'])
+
+  def test_eta_from_average_then_window(self):
+    mr_job = self.build_job(expected_bytes=1000)
+    # 200 bytes in 100 seconds; 800 bytes left
+    self.assertEquals(400, self.get_completion(1000.0, mr_job,
+                                               200)['eta_seconds'])
+    # 100 more bytes in 50 seconds: 700 bytes left at 2 bytes/sec = 350
+    # seconds, blended with the previous estimate aged to 350 seconds
+    self.assertEquals(350, self.get_completion(1050.0, mr_job,
+                                               300)['eta_seconds'])
+
+  def test_unknown_totals_have_no_eta(self):
+    completion = self.get_completion(1000.0, self.build_job(), 200)
+    self.assertEquals(None, completion['percent_bytes'])
+    self.assertEquals(None, completion['eta_seconds'])
+
+  def test_finished_job_has_no_time_left(self):
+    mr_job = self.build_job(active=False, expected_bytes=1000)
+    self.assertEquals(0, self.get_completion(1000.0, mr_job,
+                                             1000)['eta_seconds'])
+
+
+class SmoothEtaTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.smooth_eta()
+  """
+  def test_first_estimate_is_used_as_is(self):
+    self.assertEquals((10, 500), progress.smooth_eta(None, 500, 10))
+
+  def test_burst_moves_eta_only_partially(self):
+    # the previous ETA of 1000 seconds, 100 seconds later, predicts 900
+    now, eta = progress.smooth_eta((0, 1000), 100, 100)
+    self.assertEquals(100, now)
+    self.assertAlmostEquals(0.3 * 100 + 0.7 * 900, eta)
+
+  def test_unknown_estimate_ages_previous(self):
+    self.assertEquals((100, 900), progress.smooth_eta((0, 1000), None, 100))
+    self.assertEquals(None, progress.smooth_eta(None, None, 100))
+
+
+class StatusVersionTests(base.BlobMigratorTestCase):
+  """
+  Tests for progress.get_status_version()
+  """
+  def test_version_is_stable_and_tracks_changes(self):
+    status = {'pipeline_status': 'run', 'mapreduce_counters': {'a': 1}}
+    self.assertEquals(progress.get_status_version(status),
+                      progress.get_status_version(dict(status)))
+    self.assertNotEquals(
+      progress.get_status_version(status),
+      progress.get_status_version(dict(status, pipeline_status='done')))
+    self.assertNotEquals(
+      progress.get_status_version(status),
+      progress.get_status_version(dict(status,
+                                       mapreduce_counters={'a': 2})))
+
+  def test_version_ignores_values_derived_from_clock(self):
+    status = {'pipeline_status': 'run', 'mapreduce_counters': {'a': 1},
+              'completion': {'eta_seconds': 10},
+              'throughput': {'bytes_per_second': 5, 'window_seconds': 60},
+              'shard_balance': {'per_second': [1.0]}}
+    later = dict(status, completion={'eta_seconds': 5},
+                 throughput={'bytes_per_second': 4, 'window_seconds': 55},
+                 shard_balance={'per_second': [0.9]})
+    self.assertEquals(progress.get_status_version(status),
+                      progress.get_status_version(later))
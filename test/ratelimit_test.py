@@ -0,0 +1,81 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Tests for app.ratelimit
+"""
+from app import ratelimit
+
+from test import base
+from test import mock
+
+
+class AcquireTests(base.BlobMigratorTestCase):
+  """
+  Tests for ratelimit.acquire()
+  """
+  def setUp(self):
+    super(AcquireTests, self).setUp()
+    self.now = [1000.0]
+    self.sleeps = []
+    self.time_patch = mock.patch('time.time', lambda: self.now[0])
+    self.sleep_patch = mock.patch('time.sleep', self.sleep)
+    self.time_patch.start()
+    self.sleep_patch.start()
+
+  def tearDown(self):
+    self.sleep_patch.stop()
+    self.time_patch.stop()
+    super(AcquireTests, self).tearDown()
+
+  def sleep(self, seconds):
+    """Advances the fake clock."""
+    self.sleeps.append(seconds)
+    self.now[0] += seconds
+
+  def test_no_limit(self):
+    self.assertEquals(0, ratelimit.acquire('job', 1000, 0))
+    self.assertEquals(0, ratelimit.acquire('job', 1000, None))
+    self.assertEquals([], self.sleeps)
+
+  def test_within_budget(self):
+    self.assertEquals(0, ratelimit.acquire('job', 40, 100))
+    self.assertEquals(0, ratelimit.acquire('job', 60, 100))
+    self.assertEquals([], self.sleeps)
+
+  def test_waits_for_next_second(self):
+    ratelimit.acquire('job', 80, 100)
+    self.now[0] += 0.25
+    waited = ratelimit.acquire('job', 40, 100)
+    self.assertEquals([0.75], self.sleeps)
+    self.assertEquals(0.75, waited)
+
+  def test_limits_are_separate(self):
+    ratelimit.acquire('job', 100, 100)
+    self.assertEquals(0, ratelimit.acquire('other-job', 100, 100))
+
+  def test_large_request_split_over_seconds(self):
+    self.assertEquals(4.0, ratelimit.acquire('job', 500, 100))
+    self.assertEquals([1.0] * 4, self.sleeps)
+    ratelimit.acquire('job', 1, 100)
+    self.assertEquals([1.0] * 5, self.sleeps)
+
+  def test_rejected_request_returns_its_budget(self):
+    ratelimit.acquire('job', 80, 100)
+    self.now[0] += 0.5
+    ratelimit.acquire('job', 40, 100)
+    self.now[0] -= 1  # back in the first second, the 40 ops do not count
+    self.assertEquals(0, ratelimit.acquire('job', 20, 100))
@@ -0,0 +1,266 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Tests for app.reconciler
+"""
+import hashlib
+
+import cloudstorage
+from google.appengine.api import files
+from google.appengine.api.files import blobstore as files_blobstore
+from google.appengine.ext import blobstore
+
+from app import config
+from app import gcs
+from app import migrator
+from app import models
+from app import reconciler
+
+from test import base
+
+BLOB_KEYS = [
+  'AMIfv94aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+  'AMIfv94bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb',
+  'AMIfv95cccccccccccccccccccccccccccccccccc',
+]
+
+
+def _write_gcs_file(gcs_filename, data='1'):
+  """Writes a GCS file and returns its name."""
+  gcs_file = cloudstorage.open(gcs_filename, mode='w')
+  gcs_file.write(data)
+  gcs_file.close()
+  return gcs_filename
+
+
+def _build_gcs_filename(blob_key_str, filename=None):
+  """Builds the name of a migrated file in my-bucket."""
+  return migrator.build_gcs_filename(blob_key_str, filename=filename,
+                                     bucket_name='my-bucket',
+                                     include_bucket=True,
+                                     include_leading_slash=True)
+
+
+def _write_blob(data):
+  """Creates a test blob and returns its blob key string."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+  return str(files_blobstore.get_blob_key(output_filename))
+
+
+def _get_counter(operations, counter_name):
+  """Sums the deltas of the named counter increments."""
+  return sum(op.delta for op in operations
+             if getattr(op, 'counter_name', None) == counter_name)
+
+
+class ListGcsPrefixesTests(base.BlobMigratorTestCase):
+  """
+  Tests for reconciler.list_gcs_prefixes()
+  """
+  def test_lists_key_character_directories(self):
+    for blob_key_str in BLOB_KEYS:
+      _write_gcs_file(_build_gcs_filename(blob_key_str))
+    _write_gcs_file('/my-bucket/other/file')
+    root = config.config.ROOT_GCS_FOLDER
+    self.assertEquals(['%s/AMIfv94a/aa/' % root, '%s/AMIfv94b/bb/' % root,
+                       '%s/AMIfv95c/cc/' % root],
+                      reconciler.list_gcs_prefixes('my-bucket'))
+
+
+class GcsPrefixInputReaderTests(base.BlobMigratorTestCase):
+  """
+  Tests for reconciler.GcsPrefixInputReader
+  """
+  def setUp(self):
+    super(GcsPrefixInputReaderTests, self).setUp()
+    config.config.GCS_LISTING_PAGE_SIZE = 2
+    self.filenames = [_write_gcs_file(_build_gcs_filename(BLOB_KEYS[0], name))
+                      for name in ['a', 'b', 'c']]
+    self.filenames.append(_write_gcs_file(_build_gcs_filename(BLOB_KEYS[2])))
+    self.prefixes = reconciler.list_gcs_prefixes('my-bucket')
+
+  def test_lists_every_prefix_in_pages(self):
+    reader = reconciler.GcsPrefixInputReader('my-bucket', self.prefixes)
+    pages = [[stat.filename for stat in page] for page in reader]
+    self.assertEquals([self.filenames[0:2], self.filenames[2:3],
+                       self.filenames[3:4]], pages)
+
+  def test_resumes_from_state(self):
+    reader = reconciler.GcsPrefixInputReader('my-bucket', self.prefixes)
+    iter(reader).next()
+    reader = reconciler.GcsPrefixInputReader.from_json(reader.to_json())
+    filenames = [stat.filename for page in reader for stat in page]
+    self.assertEquals(self.filenames[2:], filenames)
+
+
+class ReconcileGcsFilesTests(base.BlobMigratorTestCase):
+  """
+  Tests for reconciler.reconcile_gcs_files()
+  """
+  def setUp(self):
+    super(ReconcileGcsFilesTests, self).setUp()
+    config.config.ORPHAN_GRACE_PERIOD = 0
+    self.mapped = _write_gcs_file(_build_gcs_filename(BLOB_KEYS[0]))
+    migrator.store_mapping_entity(BLOB_KEYS[0], self.mapped)
+    self.unmapped = _write_gcs_file(_build_gcs_filename(BLOB_KEYS[1]))
+    self.retried = _write_gcs_file(_build_gcs_filename(BLOB_KEYS[0], 'x'))
+
+  def reconcile(self, delete=False):
+    """Runs the mapper over the bucket, returning its operations."""
+    stats = list(cloudstorage.listbucket('/my-bucket'))
+    params = {'bucket_name': 'my-bucket', 'delete': delete}
+    return list(reconciler.reconcile_gcs_files(stats, _mapper_params=params))
+
+  def exists(self, gcs_filename):
+    """Checks if a GCS file exists."""
+    try:
+      cloudstorage.stat(gcs_filename)
+      return True
+    except cloudstorage.NotFoundError:
+      return False
+
+  def test_reports_orphans(self):
+    operations = self.reconcile()
+    self.assertEquals(1, _get_counter(operations, 'Objects_mapped'))
+    self.assertEquals(1, _get_counter(operations, 'Orphaned_objects'))
+    self.assertEquals(1, _get_counter(operations, 'Orphaned_bytes'))
+    self.assertTrue(self.exists(self.retried))
+
+  def test_deletes_orphans(self):
+    operations = self.reconcile(delete=True)
+    self.assertEquals(1, _get_counter(operations, 'Orphaned_objects_deleted'))
+    self.assertTrue(self.exists(self.mapped))
+    self.assertFalse(self.exists(self.retried))
+
+  def test_unmapped_files_of_deleted_blobs_kept(self):
+    operations = self.reconcile(delete=True)
+    self.assertEquals(
+        1, _get_counter(operations, 'Objects_unmapped_source_missing'))
+    self.assertTrue(self.exists(self.unmapped))
+
+  def test_unmapped_files_of_existing_blobs_deleted(self):
+    blob_key_str = _write_blob('abc')
+    unmapped = _write_gcs_file(_build_gcs_filename(blob_key_str))
+    operations = self.reconcile(delete=True)
+    self.assertEquals(2, _get_counter(operations, 'Orphaned_objects_deleted'))
+    self.assertFalse(self.exists(unmapped))
+    self.assertTrue(self.exists(self.unmapped))
+
+  def test_unmapped_intermediate_files_deleted(self):
+    intermediate = _write_gcs_file(
+        _build_gcs_filename(BLOB_KEYS[2]) + gcs.COMPOSE_SUFFIX + 'abc')
+    self.reconcile(delete=True)
+    self.assertFalse(self.exists(intermediate))
+
+  def test_young_files_skipped(self):
+    config.config.ORPHAN_GRACE_PERIOD = 3600
+    operations = self.reconcile(delete=True)
+    self.assertEquals(3, _get_counter(operations,
+                                      'Objects_within_grace_period'))
+    self.assertTrue(self.exists(self.retried))
+
+  def test_files_mapped_to_other_bucket_kept(self):
+    migrator.store_mapping_entity(BLOB_KEYS[1], '/other-bucket/file')
+    operations = self.reconcile(delete=True)
+    self.assertEquals(
+        1, _get_counter(operations, 'Objects_mapped_to_other_bucket'))
+    self.assertTrue(self.exists(self.unmapped))
+
+
+class RebuildMappingsTests(base.BlobMigratorTestCase):
+  """
+  Tests for reconciler.rebuild_mappings()
+  """
+  def rebuild(self):
+    """Runs the mapper over the bucket, returning its operations."""
+    stats = list(cloudstorage.listbucket('/my-bucket'))
+    return list(reconciler.rebuild_mappings(stats, _mapper_params={}))
+
+  def get_mapping(self, blob_key_str):
+    """Returns the stored mapping of a blob key."""
+    return models.BlobKeyMapping.build_key(blob_key_str).get()
+
+  def test_missing_mappings_rebuilt(self):
+    gcs_filename = _write_gcs_file(_build_gcs_filename(BLOB_KEYS[0], 'a.txt'),
+                                   data='abc')
+    operations = self.rebuild()
+    mapping = self.get_mapping(BLOB_KEYS[0])
+    self.assertEquals(gcs_filename, mapping.gcs_filename)
+    self.assertEquals(blobstore.create_gs_key('/gs' + gcs_filename),
+                      mapping.new_blob_key)
+    self.assertEquals(3, mapping.size)
+    self.assertEquals('my-bucket', mapping.generation)
+    self.assertEquals(1, _get_counter(operations, 'Mappings_rebuilt'))
+
+  def test_existing_mappings_kept(self):
+    _write_gcs_file(_build_gcs_filename(BLOB_KEYS[0]))
+    migrator.store_mapping_entity(BLOB_KEYS[0], '/my-bucket/elsewhere')
+    operations = self.rebuild()
+    self.assertEquals('/my-bucket/elsewhere',
+                      self.get_mapping(BLOB_KEYS[0]).gcs_filename)
+    self.assertEquals(1, _get_counter(operations, 'Mappings_already_present'))
+
+  def test_files_matching_source_blob_rebuilt(self):
+    blob_key_str = _write_blob('abc')
+    _write_gcs_file(_build_gcs_filename(blob_key_str), data='abc')
+    self.rebuild()
+    mapping = self.get_mapping(blob_key_str)
+    self.assertEquals(3, mapping.size)
+    self.assertEquals(hashlib.md5('abc').hexdigest(), mapping.md5_hash)
+
+  def test_files_not_matching_source_blob_skipped(self):
+    blob_key_str = _write_blob('abc')
+    _write_gcs_file(_build_gcs_filename(blob_key_str), data='abd')
+    operations = self.rebuild()
+    self.assertIsNone(self.get_mapping(blob_key_str))
+    self.assertEquals(1, _get_counter(operations,
+                                      'Objects_not_matching_source'))
+
+  def test_files_of_failed_copies_skipped(self):
+    gcs_filename = _write_gcs_file(_build_gcs_filename(BLOB_KEYS[0]))
+    models.MigrationFailure.record(BLOB_KEYS[0], gcs_filename,
+                                   migrator.CHECKSUM_MISMATCH, [])
+    operations = self.rebuild()
+    self.assertIsNone(self.get_mapping(BLOB_KEYS[0]))
+    self.assertEquals(1, _get_counter(operations,
+                                      'Objects_with_migration_failure'))
+
+  def test_newest_file_mapped_across_pages(self):
+    older = cloudstorage.GCSFileStat(_build_gcs_filename(BLOB_KEYS[0], 'a'),
+                                     1, None, 100.0)
+    newer = cloudstorage.GCSFileStat(_build_gcs_filename(BLOB_KEYS[0], 'b'),
+                                     1, None, 200.0)
+    for pages in [[older], [newer]], [[newer], [older]]:
+      models.BlobKeyMapping.build_key(BLOB_KEYS[0]).delete()
+      for page in pages:
+        list(reconciler.rebuild_mappings(page, _mapper_params={}))
+      self.assertEquals(newer.filename,
+                        self.get_mapping(BLOB_KEYS[0]).gcs_filename)
+
+  def test_intermediate_files_not_mapped(self):
+    _write_gcs_file(_build_gcs_filename(
+        BLOB_KEYS[0], migrator.PART_NAME_PREFIX + '0'))
+    _write_gcs_file(_build_gcs_filename(BLOB_KEYS[1]) + '.compose-abc')
+    _write_gcs_file('/my-bucket/other/file')
+    operations = self.rebuild()
+    self.assertIsNone(self.get_mapping(BLOB_KEYS[0]))
+    self.assertIsNone(self.get_mapping(BLOB_KEYS[1]))
+    self.assertEquals(3, _get_counter(operations,
+                                      'Objects_not_named_by_migration'))
@@ -0,0 +1,112 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmarks the batched Blobstore deletes of the scrubbing pass against one
+delete per key.
+
+The testbed blobstore stub answers every RPC instantly, so the benchmark
+simulates the latency of a delete call: a call completes a fixed time after
+it was made, however many keys it carries.
+
+Run with:  ./build.sh benchmark
+"""
+import time
+
+from google.appengine.ext import blobstore
+
+from app import config
+from app import pools
+from app import scrubber
+
+from test import mock
+from test import base
+
+DELETE_LATENCY = 0.01
+NUM_BLOBS = 500
+
+
+class _DelayedRpc(object):
+  """A delete RPC that completes DELETE_LATENCY after it was made."""
+
+  def __init__(self):
+    self.ready_at = time.time() + DELETE_LATENCY
+
+  def get_result(self):
+    remaining = self.ready_at - time.time()
+    if remaining > 0:
+      time.sleep(remaining)
+
+
+class DeleteBlobsBenchmark(base.BlobMigratorTestCase):
+  """
+  Compares scrubber.delete_blobstore_blobs() with one delete per key.
+  """
+  def setUp(self):
+    super(DeleteBlobsBenchmark, self).setUp()
+    page_size = config.config.VERIFICATION_BATCH_SIZE
+    pairs = [(_FakeMapping('blob-%d' % num), _FakeBlobInfo())
+             for num in range(NUM_BLOBS)]
+    self.pages = [pairs[start:start + page_size]
+                  for start in range(0, NUM_BLOBS, page_size)]
+
+  def time_per_key_deletes(self):
+    """Deletes each blob with its own call, returning blobs/sec."""
+    def delete(blob_key):
+      _DelayedRpc().get_result()
+
+    with mock.patch('google.appengine.ext.blobstore.delete',
+                    side_effect=delete):
+      started = time.time()
+      for page in self.pages:
+        for mapping, _ in page:
+          blobstore.delete(blobstore.BlobKey(mapping.old_blob_key))
+      elapsed = time.time() - started
+    return NUM_BLOBS / elapsed
+
+  def time_pooled_deletes(self):
+    """Deletes the pages as a scrubbing slice does, returning blobs/sec."""
+    pool = pools.BlobDeletePool()
+    params = {scrubber.ScrubInputReader.SCOPE_PARAM: {}}
+    with mock.patch('google.appengine.ext.blobstore.delete_async',
+                    side_effect=lambda blob_keys: _DelayedRpc()):
+      with mock.patch('app.pools.get_blob_delete_pool', return_value=pool):
+        started = time.time()
+        for page in self.pages:
+          list(scrubber.delete_blobstore_blobs(page, _mapper_params=params))
+        pool.flush()
+        elapsed = time.time() - started
+    self.assertEquals(NUM_BLOBS, pool.blobs_deleted)
+    return NUM_BLOBS / elapsed
+
+  def test_pooled_deletes_outperform_per_key_deletes(self):
+    per_key_rate = self.time_per_key_deletes()
+    pooled_rate = self.time_pooled_deletes()
+    print('\nper key: %8.1f blobs/s\npooled:  %8.1f blobs/s\nspeedup: '
+          '%8.2fx' % (per_key_rate, pooled_rate, pooled_rate / per_key_rate))
+    self.assertTrue(pooled_rate > per_key_rate * 10)
+
+
+class _FakeMapping(object):
+  """Stands in for a BlobKeyMapping entity."""
+
+  def __init__(self, old_blob_key):
+    self.old_blob_key = old_blob_key
+    self.verified = None
+
+
+class _FakeBlobInfo(object):
+  """Stands in for the BlobInfo of a mapping."""
+  size = 1
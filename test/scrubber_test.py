@@ -0,0 +1,191 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.scrubber
+"""
+import datetime
+
+import cloudstorage
+from google.appengine.api import files
+from google.appengine.api.files import blobstore as files_blobstore
+from google.appengine.ext import blobstore
+
+from app import migrator
+from app import models
+from app import scrubber
+
+from test import base
+from test import mock
+
+
+def _write_blob(data):
+  """Creates a test blob and returns its BlobInfo."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+  blob_key = files_blobstore.get_blob_key(output_filename)
+  return blobstore.BlobInfo.get(blob_key)
+
+
+def _get_counter(operations, counter_name):
+  """Sums the deltas of the named counter increments."""
+  return sum(op.delta for op in operations
+             if getattr(op, 'counter_name', None) == counter_name)
+
+
+def _migrate(data):
+  """Migrates a blob and returns its key string and mapping."""
+  blob_info = _write_blob(data)
+  migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
+  key_str = str(blob_info.key())
+  return key_str, models.BlobKeyMapping.build_key(key_str).get()
+
+
+def _get_pairs(mappings):
+  """Pairs mappings with their BlobInfos, as ScrubInputReader does."""
+  return [(mapping, blobstore.BlobInfo.get(
+               blobstore.BlobKey(mapping.old_blob_key)))
+          for mapping in mappings]
+
+
+class InScopeTests(base.BlobMigratorTestCase):
+  """
+  Tests for scrubber.in_scope()
+  """
+  def setUp(self):
+    super(InScopeTests, self).setUp()
+    self.mapping = models.BlobKeyMapping(old_blob_key='m-key',
+                                         gcs_filename='/bucket/file')
+    self.blob_info = mock.Mock(creation=datetime.datetime(2015, 6, 1))
+
+  def test_empty_scope(self):
+    self.assertTrue(scrubber.in_scope(self.mapping, None,
+                                      scrubber.build_scope()))
+
+  def test_key_range(self):
+    self.assertTrue(scrubber.in_scope(
+        self.mapping, None, scrubber.build_scope(key_start='m-key')))
+    self.assertFalse(scrubber.in_scope(
+        self.mapping, None, scrubber.build_scope(key_start='n')))
+    self.assertFalse(scrubber.in_scope(
+        self.mapping, None, scrubber.build_scope(key_end='m-key')))
+    self.assertTrue(scrubber.in_scope(
+        self.mapping, None, scrubber.build_scope(key_start='a', key_end='n')))
+
+  def test_creation_window(self):
+    scope = scrubber.build_scope(
+        created_start=datetime.datetime(2015, 1, 1),
+        created_end=datetime.datetime(2015, 7, 1))
+    self.assertTrue(scrubber.in_scope(self.mapping, self.blob_info, scope))
+    self.blob_info.creation = datetime.datetime(2015, 7, 1)
+    self.assertFalse(scrubber.in_scope(self.mapping, self.blob_info, scope))
+    self.blob_info.creation = datetime.datetime(2014, 12, 31)
+    self.assertFalse(scrubber.in_scope(self.mapping, self.blob_info, scope))
+
+  def test_creation_window_excludes_deleted_blobs(self):
+    scope = scrubber.build_scope(created_end=datetime.datetime(2015, 7, 1))
+    self.assertFalse(scrubber.in_scope(self.mapping, None, scope))
+
+
+class DeleteMappingEntitiesTests(base.BlobMigratorTestCase):
+  """
+  Tests for scrubber.delete_mapping_entities()
+  """
+  def delete(self, pairs, dry_run=False):
+    """Runs the mapper over a page, returning its operations."""
+    params = {'scope': scrubber.build_scope(dry_run=dry_run)}
+    return list(scrubber.delete_mapping_entities(pairs,
+                                                 _mapper_params=params))
+
+  def test_deletes_mappings(self):
+    _, mapping = _migrate('abc')
+    operations = self.delete(_get_pairs([mapping]))
+    self.assertIsNone(mapping.key.get())
+    self.assertEquals(1, _get_counter(operations, 'Mapping_entities_deleted'))
+    self.assertEquals(3, _get_counter(operations, 'Bytes_in_scope'))
+
+  def test_dry_run_only_counts(self):
+    _, mapping = _migrate('abc')
+    operations = self.delete(_get_pairs([mapping]), dry_run=True)
+    self.assertIsNotNone(mapping.key.get())
+    self.assertEquals(0, _get_counter(operations, 'Mapping_entities_deleted'))
+    self.assertEquals(1, _get_counter(operations, 'Mappings_in_scope'))
+    self.assertEquals(3, _get_counter(operations, 'Bytes_in_scope'))
+
+
+class DeleteBlobstoreBlobsTests(base.BlobMigratorTestCase):
+  """
+  Tests for scrubber.delete_blobstore_blobs()
+  """
+  def delete(self, mappings, verified_only=True, dry_run=False):
+    """Runs the mapper over a page of mappings, returning its operations."""
+    params = {
+      'root_pipeline_id': 'delete-1',
+      'verified_only': verified_only,
+      'scope': scrubber.build_scope(dry_run=dry_run),
+    }
+    return list(scrubber.delete_blobstore_blobs(_get_pairs(mappings),
+                                                _mapper_params=params))
+
+  def blob_exists(self, key_str):
+    """Checks if the source blob still exists."""
+    return blobstore.BlobInfo.get(blobstore.BlobKey(key_str)) is not None
+
+  def test_verified_blob_deleted_without_check(self):
+    key_str, mapping = _migrate('abc')
+    mapping.verified = datetime.datetime.utcnow()
+    cloudstorage.delete(mapping.gcs_filename)  # not checked again
+    operations = self.delete([mapping])
+    self.assertFalse(self.blob_exists(key_str))
+    self.assertEquals(1, _get_counter(operations, 'Blobs_deleted'))
+    self.assertEquals(0, _get_counter(operations, 'Mappings_verified'))
+
+  def test_unverified_blob_checked_then_deleted(self):
+    key_str, mapping = _migrate('abc')
+    operations = self.delete([mapping])
+    self.assertFalse(self.blob_exists(key_str))
+    self.assertEquals(1, _get_counter(operations, 'Mappings_verified'))
+    self.assertTrue(mapping.key.get().verified)
+
+  def test_blob_with_missing_copy_kept(self):
+    key_str, mapping = _migrate('abc')
+    other_key_str, other_mapping = _migrate('defg')
+    cloudstorage.delete(mapping.gcs_filename)
+    operations = self.delete([mapping, other_mapping])
+    self.assertTrue(self.blob_exists(key_str))
+    self.assertFalse(self.blob_exists(other_key_str))
+    self.assertEquals(1, _get_counter(operations,
+                                      'Blobs_not_deleted_unverified'))
+    self.assertEquals(1, _get_counter(operations, 'Blobs_deleted'))
+    self.assertTrue(models.VerificationFailure.build_key(key_str).get())
+
+  def test_unverified_blob_deleted_without_verified_only(self):
+    key_str, mapping = _migrate('abc')
+    cloudstorage.delete(mapping.gcs_filename)
+    operations = self.delete([mapping], verified_only=False)
+    self.assertFalse(self.blob_exists(key_str))
+    self.assertEquals(0, _get_counter(operations, 'Mappings_verified'))
+    self.assertEquals(1, _get_counter(operations, 'Blobs_deleted'))
+
+  def test_dry_run_only_counts(self):
+    key_str, mapping = _migrate('abc')
+    operations = self.delete([mapping], dry_run=True)
+    self.assertTrue(self.blob_exists(key_str))
+    self.assertIsNone(mapping.key.get().verified)
+    self.assertEquals(0, _get_counter(operations, 'Blobs_deleted'))
+    self.assertEquals(1, _get_counter(operations, 'Blobs_in_scope'))
+    self.assertEquals(3, _get_counter(operations, 'Bytes_in_scope'))
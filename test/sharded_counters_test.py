@@ -0,0 +1,38 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.sharded_counters
+"""
+from app import sharded_counters
+
+from test import base
+from test import mock
+
+
+class ShardedCountersTests(base.BlobMigratorTestCase):
+  """
+  Tests for sharded_counters.increment() and sharded_counters.get_totals()
+  """
+  def test_totals_sum_all_shards(self):
+    with mock.patch('random.randint', side_effect=[0, 5, 5]):
+      sharded_counters.increment('group', {'a': 1, 'b': 10})
+      sharded_counters.increment('group', {'a': 2})
+      sharded_counters.increment('group', {'b': 5})
+    self.assertEquals({'a': 3, 'b': 15}, sharded_counters.get_totals('group'))
+
+  def test_groups_are_separate(self):
+    sharded_counters.increment('group-1', {'a': 1})
+    self.assertEquals({}, sharded_counters.get_totals('group-2'))
@@ -0,0 +1,72 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.stats
+"""
+from app import stats
+
+from test import base
+
+
+class SizeBucketTests(base.BlobMigratorTestCase):
+  """
+  Tests for stats.size_bucket() and stats.size_bucket_label()
+  """
+  def test_buckets_are_powers_of_two(self):
+    self.assertEquals(0, stats.size_bucket(0))
+    self.assertEquals(1, stats.size_bucket(1))
+    self.assertEquals(11, stats.size_bucket(1024))
+    self.assertEquals(11, stats.size_bucket(2047))
+    self.assertEquals(12, stats.size_bucket(2048))
+
+  def test_labels(self):
+    self.assertEquals('0 B', stats.size_bucket_label(0))
+    self.assertEquals('1.0 KiB - 2.0 KiB', stats.size_bucket_label(11))
+    self.assertEquals('2 B - 3 B', stats.size_bucket_label(2))
+
+
+class FormatBytesTests(base.BlobMigratorTestCase):
+  """
+  Tests for stats.format_bytes()
+  """
+  def test_units(self):
+    self.assertEquals('512 B', stats.format_bytes(512))
+    self.assertEquals('1.5 MiB', stats.format_bytes(1536 * 1024))
+    self.assertEquals('2048.0 PiB', stats.format_bytes(2 ** 61))
+
+
+class GetSizeHistogramTests(base.BlobMigratorTestCase):
+  """
+  Tests for stats.get_size_histogram()
+  """
+  def test_histogram_from_bucket_counters(self):
+    counters = {}
+    for size in [0, 1500, 2000, 2 ** 40]:
+      for name, delta in zip(stats.get_size_bucket_counter_names(size), [1, size]):
+        counters[name] = counters.get(name, 0) + delta
+    histogram = stats.get_size_histogram(counters)
+    self.assertEquals([0, 11, stats.MAX_SIZE_BUCKET],
+                      [row['bucket'] for row in histogram])
+    self.assertEquals(2, histogram[1]['blobs'])
+    self.assertEquals(3500, histogram[1]['bytes'])
+    self.assertEquals('2.0 GiB and larger', histogram[2]['label'])
+
+  def test_prefixed_counters(self):
+    counters = dict(zip(stats.get_size_bucket_counter_names(1, prefix='Plan_'),
+                        [1, 1]))
+    self.assertEquals([], stats.get_size_histogram(counters))
+    self.assertEquals(1, len(stats.get_size_histogram(counters,
+                                                      prefix='Plan_')))
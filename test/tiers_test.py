@@ -0,0 +1,61 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.tiers
+"""
+from app import config
+from app import tiers
+
+from test import base
+
+
+class GetSizeTierTests(base.BlobMigratorTestCase):
+  """
+  Tests for tiers.get_size_tier()
+  """
+  def setUp(self):
+    super(GetSizeTierTests, self).setUp()
+    config.config.SIZE_TIERS = [
+      {'name': 'large', 'max_size': None, 'queue_name': 'large-blobs',
+       'target': 'backend'},
+      {'name': 'small', 'max_size': 100},
+    ]
+
+  def test_tiers_are_ordered_by_size(self):
+    self.assertEquals(['small', 'large'],
+                      [tier['name'] for tier in tiers.get_size_tiers()])
+
+  def test_blob_belongs_to_smallest_tier_that_fits(self):
+    self.assertEquals('small', tiers.get_size_tier(100)['name'])
+    large = tiers.get_size_tier(101)
+    self.assertEquals('large', large['name'])
+    self.assertEquals('large-blobs', tiers.get_queue_name(large))
+    self.assertEquals('backend', large['target'])
+
+  def test_tier_without_queue_uses_default_queue(self):
+    config.config.QUEUE_NAME = 'migration'
+    self.assertEquals('migration',
+                      tiers.get_queue_name(tiers.get_size_tier(1)))
+
+  def test_unbounded_tier_is_added_when_missing(self):
+    config.config.SIZE_TIERS = [{'name': 'small', 'max_size': 100}]
+    self.assertEquals(tiers.DEFAULT_TIER_NAME,
+                      tiers.get_size_tier(101)['name'])
+
+  def test_no_tiers_uses_a_single_tier(self):
+    config.config.SIZE_TIERS = []
+    self.assertEquals([tiers.DEFAULT_TIER_NAME],
+                      [tier['name'] for tier in tiers.get_size_tiers()])
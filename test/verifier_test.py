@@ -0,0 +1,160 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for app.verifier
+"""
+import cloudstorage
+from google.appengine.api import files
+from google.appengine.api.files import blobstore as files_blobstore
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from app import migrator
+from app import models
+from app import verifier
+
+from test import mock
+from test import base
+
+
+def _write_blob(data):
+  """Creates a test blob and returns its BlobInfo."""
+  output_filename = files.blobstore.create()
+  with files.open(output_filename, 'a') as outfile:
+    outfile.write(data)
+  files.finalize(output_filename)
+  blob_key = files_blobstore.get_blob_key(output_filename)
+  return blobstore.BlobInfo.get(blob_key)
+
+
+def _get_counter(operations, counter_name):
+  """Sums the deltas of the named counter increments."""
+  return sum(op.delta for op in operations
+             if getattr(op, 'counter_name', None) == counter_name)
+
+
+class IsSampledTests(base.BlobMigratorTestCase):
+  """
+  Tests for verifier.is_sampled()
+  """
+  def test_full_and_empty_samples(self):
+    self.assertTrue(verifier.is_sampled('key', 1.0))
+    self.assertFalse(verifier.is_sampled('key', 0))
+
+  def test_sample_is_about_the_rate(self):
+    sampled = sum(1 for num in range(2000)
+                  if verifier.is_sampled('key-%d' % num, 0.25))
+    self.assertTrue(400 < sampled < 600)
+
+  def test_sample_is_repeatable(self):
+    self.assertEquals(
+      [verifier.is_sampled('key-%d' % num, 0.5) for num in range(50)],
+      [verifier.is_sampled('key-%d' % num, 0.5) for num in range(50)])
+
+
+class CheckMappingTests(base.BlobMigratorTestCase):
+  """
+  Tests for verifier.check_mapping()
+  """
+  def setUp(self):
+    super(CheckMappingTests, self).setUp()
+    self.blob_info = _write_blob('0123456789')
+    self.mapping = models.BlobKeyMapping(gcs_filename='/my-bucket/file',
+                                         new_blob_key='new-key',
+                                         size=10, crc32c=5)
+
+  def test_missing_file(self):
+    self.assertEquals(['gcs file does not exist'],
+                      verifier.check_mapping(self.mapping, self.blob_info,
+                                             None))
+
+  def test_matching_file(self):
+    self.assertEquals([], verifier.check_mapping(
+        self.mapping, self.blob_info, {'size': 10, 'crc32c': 5}))
+
+  def test_size_compared_with_blob_info(self):
+    self.assertEquals(2, len(verifier.check_mapping(
+        self.mapping, self.blob_info, {'size': 9})))
+
+  def test_checksums_compared_with_mapping_without_blob_info(self):
+    self.assertEquals(1, len(verifier.check_mapping(
+        self.mapping, None, {'size': 10, 'crc32c': 6})))
+
+
+class VerifyMappingBatchTests(base.BlobMigratorTestCase):
+  """
+  Tests for verifier.verify_mapping_batch()
+  """
+  def migrate(self, data):
+    """Migrates a blob and returns its mapping."""
+    blob_info = _write_blob(data)
+    migrator.migrate_single_blob_inline(blob_info, 'my-bucket')
+    return models.BlobKeyMapping.build_key(str(blob_info.key())).get()
+
+  def verify(self, mappings, sample_rate=1.0):
+    """Verifies mappings, returning the counter operations."""
+    return list(verifier.verify_mapping_batch(
+        mappings, _mapper_params={'sample_rate': sample_rate,
+                                  'root_pipeline_id': 'verify-1'}))
+
+  def test_matching_mappings_marked_verified(self):
+    mappings = [self.migrate('abc'), self.migrate('defg')]
+    operations = self.verify(mappings)
+    self.assertEquals(2, _get_counter(operations, 'Mappings_verified'))
+    self.assertEquals(7, _get_counter(operations, 'Bytes_verified'))
+    self.assertEquals(0, _get_counter(operations, 'Mappings_mismatched'))
+    for mapping in ndb.get_multi([mapping.key for mapping in mappings]):
+      self.assertTrue(mapping.verified)
+
+  def test_missing_file_reported(self):
+    mapping = self.migrate('abc')
+    cloudstorage.delete(mapping.gcs_filename)
+    operations = self.verify([mapping])
+    self.assertEquals(1, _get_counter(operations, 'Mappings_mismatched'))
+    failure = models.VerificationFailure.build_key(
+        mapping.old_blob_key).get()
+    self.assertEquals('verify-1', failure.pipeline_id)
+    self.assertEquals(['gcs file does not exist'], failure.details)
+    self.assertEquals(None, mapping.key.get().verified)
+
+  def test_unsampled_mappings_not_checked(self):
+    mapping = self.migrate('abc')
+    with mock.patch('app.gcs.get_object_checksums_async') as stat_mock:
+      operations = self.verify([mapping], sample_rate=0)
+    self.assertEquals(0, stat_mock.call_count)
+    self.assertEquals(1, _get_counter(operations, 'Mappings_considered'))
+    self.assertEquals(0, _get_counter(operations, 'Mappings_verified'))
+
+
+class VerificationSummaryTests(base.BlobMigratorTestCase):
+  """
+  Tests for verifier.get_verification_summary()
+  """
+  def test_full_verification_rate_is_exact(self):
+    summary = verifier.get_verification_summary(
+        {'Mappings_verified': 200, 'Mappings_mismatched': 2}, 1.0)
+    self.assertEquals(0.01, summary['mismatch_rate'])
+    self.assertEquals(0.01, summary['mismatch_rate_upper_bound'])
+
+  def test_sampled_verification_has_upper_bound(self):
+    summary = verifier.get_verification_summary(
+        {'Mappings_verified': 100, 'Mappings_mismatched': 0}, 0.01)
+    self.assertEquals(0, summary['mismatch_rate'])
+    self.assertAlmostEquals(0.037, summary['mismatch_rate_upper_bound'], 3)
+
+  def test_nothing_verified(self):
+    summary = verifier.get_verification_summary({}, 0.5)
+    self.assertEquals(None, summary['mismatch_rate'])
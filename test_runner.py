@@ -49,11 +49,14 @@ def _fix_path():
 _fix_path()
 
 
-def run_tests():
-  """Run all unit tests."""
-  suite = unittest.TestLoader().discover(TEST_DIR, pattern='*_test.py')
-  unittest.TextTestRunner(verbosity=1).run(suite)
+def run_tests(pattern='*_test.py', verbosity=1):
+  """Run all unit tests (or, given another pattern, the benchmarks)."""
+  suite = unittest.TestLoader().discover(TEST_DIR, pattern=pattern)
+  unittest.TextTestRunner(verbosity=verbosity).run(suite)
 
 
 if __name__ == '__main__':
-  run_tests()
+  if sys.argv[1:] == ['--benchmark']:
+    run_tests(pattern='*_benchmark.py', verbosity=2)
+  else:
+    run_tests()